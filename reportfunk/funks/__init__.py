@@ -6,4 +6,16 @@ __all__ = ["custom_logger",
             "tree_functions",
             "report_functions",
             "prep_data_functions",
-            "class_definitions"]
\ No newline at end of file
+            "class_definitions",
+            "figure_functions",
+            "svg_functions",
+            "metadata_functions",
+            "store_functions",
+            "date_functions",
+            "stage_functions",
+            "pipeline_functions",
+            "join_functions",
+            "preflight_functions",
+            "filter_functions",
+            "bitmap_functions",
+            "fasta_functions"]
\ No newline at end of file
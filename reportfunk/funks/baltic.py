@@ -1,8 +1,12 @@
 from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba_array
+import numpy as np
 import re,copy,math,json,sys
 import datetime as dt
 from functools import reduce
 
+import reportfunk.funks.date_functions as date_functions
+
 sys.setrecursionlimit(9001)
 
 def decimalDate(date,fmt="%Y-%m-%d",variable=False):
@@ -23,6 +27,9 @@ def decimalDate(date,fmt="%Y-%m-%d",variable=False):
         elif dateL==1:
             fmt=delimit.join(fmt.split(delimit)[:-2])
 
+    if fmt=="%Y-%m-%d" and date_functions.cached_date(date) is not None: ## full dates are cached per distinct string
+        return date_functions.decimal_date(date)
+
     adatetime=dt.datetime.strptime(date,fmt) ## convert to datetime object
     year = adatetime.year ## get year
     boy = dt.datetime(year, 1, 1) ## get beginning of the year
@@ -873,48 +880,53 @@ class tree: ## tree class
 
         if inwardSpace<0: inwardSpace-=self.treeHeight
 
-        branches=[]
-        colours=[]
-        linewidths=[]
-
         circ_s=circStart*math.pi*2
         circ=circFrac*math.pi*2
 
-        normaliseHeight=lambda value,values: (value-min(values))/(max(values)-min(values))
-        linspace=lambda start,stop,n: list(start+((stop-start)/(n-1))*i for i in range(n)) if n>1 else stop
+        value_range=np.array(list(map(x_attr,self.Objects)),dtype=float)
+        value_min=value_range.min()
+        value_span=value_range.max()-value_min
+        normaliseHeight=lambda values: (values+inwardSpace-value_min)/value_span ## normalise all heights at once
 
-        value_range=list(map(x_attr,self.Objects))
-        for k in filter(target,self.Objects): ## iterate over branches
-            x=normaliseHeight(x_attr(k)+inwardSpace,value_range) ## get branch x position
-            xp=normaliseHeight(x_attr(k.parent)+inwardSpace,value_range) if k.parent.parent else x ## get parent x position
-            y=y_attr(k) ## get y position
+        targets=list(filter(target,self.Objects))
 
+        colours=[]
+        for k in targets: ## iterate over branches
             try:
                 colours.append(colour_function(k))
             except KeyError:
                 colours.append((0.7,0.7,0.7))
-            linewidths.append(branchWidth(k))
-
-            y=circ_s+circ*y/self.ySpan
-            X=math.sin(y)
-            Y=math.cos(y)
-            branches.append(((X*xp,Y*xp),(X*x,Y*x)))
-
-            if k.branchType=='node':
-                yl,yr=y_attr(k.children[0]),y_attr(k.children[-1]) ## get leftmost and rightmost children's y coordinates
-                yl=circ_s+circ*yl/self.ySpan ## transform y into a fraction of total y
-                yr=circ_s+circ*yr/self.ySpan
-                ybar=linspace(yl,yr,precision) ## what used to be vertical node bar is now a curved line
-
-                xs=[yx*x for yx in map(math.sin,ybar)] ## convert to polar coordinates
-                ys=[yy*x for yy in map(math.cos,ybar)]
-
-                branches+=tuple(zip(zip(xs,ys),zip(xs[1:],ys[1:]))) ## add curved segment
-
-                linewidths+=[linewidths[-1] for q in zip(ys,ys[1:])] ## repeat linewidths
-                colours+=[colours[-1] for q in zip(ys,ys[1:])] ## repeat colours
+        colours=to_rgba_array(colours)
+        linewidths=np.array([branchWidth(k) for k in targets],dtype=float)
+
+        x=normaliseHeight(np.array([x_attr(k) for k in targets],dtype=float)) ## branch x positions
+        xp=normaliseHeight(np.array([x_attr(k.parent) if k.parent and k.parent.parent else np.nan for k in targets],dtype=float)) ## parent x positions
+        xp=np.where(np.isnan(xp),x,xp) ## root has no parent branch
+        y=circ_s+circ*np.array([y_attr(k) for k in targets],dtype=float)/self.ySpan ## y as a fraction of total y
+
+        X=np.sin(y)
+        Y=np.cos(y)
+        radial=np.stack([np.stack([X*xp,Y*xp],axis=-1),np.stack([X*x,Y*x],axis=-1)],axis=1) ## (branches, 2 points, xy)
+
+        nodes=np.array([i for i,k in enumerate(targets) if k.branchType=='node'],dtype=int)
+        if len(nodes)>0 and precision>1:
+            yl=circ_s+circ*np.array([y_attr(targets[i].children[0]) for i in nodes],dtype=float)/self.ySpan ## leftmost and rightmost children's y coordinates
+            yr=circ_s+circ*np.array([y_attr(targets[i].children[-1]) for i in nodes],dtype=float)/self.ySpan
+            ybar=np.linspace(yl,yr,precision,axis=1) ## what used to be vertical node bar is now a curved line
+
+            xs=np.sin(ybar)*x[nodes,None] ## convert to polar coordinates
+            ys=np.cos(ybar)*x[nodes,None]
+            points=np.stack([xs,ys],axis=-1)
+            arcs=np.stack([points[:,:-1],points[:,1:]],axis=2).reshape(-1,2,2) ## curved segments
+
+            arc_owner=np.repeat(nodes,precision-1) ## repeat colours and linewidths for each curved segment
+            segments=np.concatenate([radial,arcs])
+            colours=np.concatenate([colours,colours[arc_owner]])
+            linewidths=np.concatenate([linewidths,linewidths[arc_owner]])
+        else:
+            segments=radial
 
-        line_segments = LineCollection(branches,lw=linewidths,ls='-',color=colours,capstyle='projecting',zorder=1) ## create line segments
+        line_segments = LineCollection(segments,lw=linewidths,ls='-',color=colours,capstyle='projecting',zorder=1) ## create line segments
         ax.add_collection(line_segments) ## add collection to axes
 
         return ax
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+import os
+import io
+import csv
+import json
+import mmap
+import zlib
+import zipfile
+from array import array
+
+import numpy as np
+
+import reportfunk.funks.metadata_functions as metadata_functions
+import reportfunk.funks.date_functions as date_functions
+
+BITMAP_INDEX_VERSION = "1"
+BITMAP_COLUMNS = ["country", "adm1", "adm2", "lineage"] #low cardinality columns, given a bitmap per value
+DATE_COLUMNS = ["sample_date"] #given a sorted index of dates
+MAX_BITMAP_VALUES = 4096 #columns with more distinct values than this aren't worth a bitmap each
+READ_BATCH_SIZE = 4096 #matching rows read out of the csv at a time
+
+open_bitmap_indexes = {}
+
+def bitmap_bytes(row_ids, row_count):
+    #bit i is set if row i (counting data rows from 0) is in row_ids
+    bits = np.zeros(row_count, dtype=bool)
+    bits[row_ids] = True
+    return np.packbits(bits, bitorder="little").tobytes()
+
+def bitmap_from_rows(row_ids, row_count):
+    return int.from_bytes(bitmap_bytes(row_ids, row_count), "little")
+
+def rows_from_bitmap(bitmap, row_count):
+    data = np.frombuffer(bitmap.to_bytes((row_count + 7)//8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(data, bitorder="little")[:row_count])
+
+def bitmap_index_path(metadata_file):
+    return f"{metadata_file}.bitmaps"
+
+def scan_records(metadata_file):
+    #(byte offset, length, fields) of each record, in one pass over the raw bytes
+    with open(metadata_file, "rb") as f:
+        header = next(csv.reader([f.readline().decode("utf-8")]))
+        yield header
+        offset = f.tell()
+
+        for line in f:
+            while b'"' in line and line.count(b'"') % 2 == 1:
+                next_line = f.readline()
+                if not next_line:
+                    break
+                line += next_line
+
+            if line.strip(b"\r\n") != b"":
+                text = line.decode("utf-8")
+                if '"' in text:
+                    fields = next(csv.reader(io.StringIO(text)))
+                else:
+                    fields = text.rstrip("\r\n").split(",")
+                yield offset, len(line), fields
+
+            offset += len(line)
+
+def build_bitmap_index(metadata_file, columns=BITMAP_COLUMNS, date_columns=DATE_COLUMNS):
+    """
+    Reads a metadata csv once, building a bitmap of the rows with each (upper cased) value of the
+    bitmap columns, and for the date columns, the days of the rows with valid dates sorted by day.
+    Also notes where each row is in the file, so the rows a query ends up with can be read straight out.
+    """
+    records = scan_records(metadata_file)
+    header = next(records)
+    positions = metadata_functions.column_positions(header)
+
+    columns = [column for column in columns if column in positions]
+    date_columns = [column for column in date_columns if column in positions]
+
+    value_codes = {column:{} for column in columns}
+    codes = {column:array("i") for column in columns}
+    days = {column:array("i") for column in date_columns}
+    invalid_dates = {column:[] for column in date_columns}
+    offsets, lengths = array("Q"), array("I")
+
+    for row_id, (offset, length, fields) in enumerate(records):
+        offsets.append(offset)
+        lengths.append(length)
+
+        for column in list(value_codes):
+            position = positions[column]
+            if position >= len(fields):
+                codes[column].append(-1)
+                continue
+            column_codes = value_codes[column]
+            value = fields[position].upper()
+            if value not in column_codes:
+                if len(column_codes) == MAX_BITMAP_VALUES: #too many values to be worth it
+                    del value_codes[column], codes[column]
+                    continue
+                column_codes[value] = len(column_codes)
+            codes[column].append(column_codes[value])
+
+        for column in date_columns:
+            value = fields[positions[column]] if positions[column] < len(fields) else None
+            date = date_functions.cached_date(value)
+            if date is None:
+                if value not in ("", "NA"):
+                    invalid_dates[column].append((value, row_id + 1))
+                days[column].append(-1)
+            else:
+                days[column].append(date.toordinal())
+
+    row_count = len(offsets)
+
+    bitmaps = {}
+    for column, column_codes in value_codes.items():
+        column_array = np.frombuffer(codes[column], dtype=np.int32)
+        order = np.argsort(column_array, kind="stable")
+        bounds = np.searchsorted(column_array[order], np.arange(len(column_codes) + 1))
+        bitmaps[column] = {value:zlib.compress(bitmap_bytes(order[bounds[code]:bounds[code+1]], row_count)) for value, code in column_codes.items()}
+
+    date_index = {}
+    for column in date_columns:
+        column_days = np.frombuffer(days[column], dtype=np.int32)
+        dated = np.flatnonzero(column_days >= 0)
+        order = np.argsort(column_days[dated], kind="stable")
+        date_index[column] = (column_days[dated][order], dated[order].astype(np.uint32))
+
+    return BitmapIndex(metadata_file, header, np.frombuffer(offsets, dtype=np.uint64), np.frombuffer(lengths, dtype=np.uint32), bitmaps, date_index, invalid_dates)
+
+class BitmapIndex():
+    """
+    Compressed bitmaps of the rows with each value of the low cardinality columns of a metadata csv,
+    and a sorted index of its dates, so --from-metadata style filters on those columns can be answered
+    by intersecting bitmaps and binary searching dates rather than reading the whole file.
+    """
+    def __init__(self, metadata_file, header, offsets, lengths, bitmaps, date_index, invalid_dates):
+        self.metadata_file = metadata_file
+        self.header = header
+        self.offsets = offsets
+        self.lengths = lengths
+        self.bitmaps = bitmaps #column -> value -> zlib compressed bitmap
+        self.date_index = date_index #column -> (days, row ids) sorted by day
+        self.invalid_dates = invalid_dates #column -> (value, row number) of the values that aren't dates
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def covers(self, metadata_filter):
+        if metadata_filter.is_date_range():
+            return metadata_filter.column in self.date_index
+        return metadata_filter.column in self.bitmaps
+
+    def value_bitmap(self, column, value):
+        data = self.bitmaps[column].get(value)
+        return int.from_bytes(zlib.decompress(data), "little") if data else 0
+
+    def date_range_bitmap(self, column, start, end):
+        days, row_ids = self.date_index[column]
+        first = np.searchsorted(days, start.toordinal(), side="left")
+        last = np.searchsorted(days, end.toordinal(), side="right")
+        return bitmap_from_rows(row_ids[first:last], len(self))
+
+    def invalid_date_bitmap(self, column):
+        row_ids = [row_number - 1 for value, row_number in self.invalid_dates[column]]
+        return bitmap_from_rows(row_ids, len(self)) if row_ids else 0
+
+    def filter_bitmap(self, metadata_filter):
+        if not metadata_filter.is_date_range():
+            return self.value_bitmap(metadata_filter.column, metadata_filter.value)
+        return self.date_range_bitmap(metadata_filter.column, metadata_filter.start, metadata_filter.end)
+
+    def read_rows(self, row_ids):
+        #(row number, fields) of each row, read a batch at a time from a memory map of the csv
+        if len(row_ids) == 0:
+            return
+        all_columns = range(len(self.header))
+        with open(self.metadata_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for start in range(0, len(row_ids), READ_BATCH_SIZE):
+                batch = row_ids[start:start+READ_BATCH_SIZE]
+                text = b"".join(mm[offset:offset+length] for offset, length in zip(self.offsets[batch].tolist(), self.lengths[batch].tolist())).decode("utf-8")
+                rows = metadata_functions.projected_rows(io.StringIO(text, newline=""), self.header, all_columns)
+                yield from zip((batch + 1).tolist(), rows)
+
+    def candidates(self, filters, invalid_date=None):
+        """
+        Rows passing every filter the index covers, found by intersecting their bitmaps, as (row number,
+        fields) pairs, and the filters left for them to pass. None if the index covers none of them.
+        With invalid_date, rows with bad dates in a date range column are kept in and the range left for
+        filter_rows, so they're only reported if they pass the other filters, as without the index.
+        """
+        covered = [metadata_filter for metadata_filter in filters if self.covers(metadata_filter)]
+        if not covered:
+            return None
+        rest = [metadata_filter for metadata_filter in filters if not self.covers(metadata_filter)]
+
+        bitmap = -1 #every row
+        for metadata_filter in sorted(covered, key=lambda metadata_filter: metadata_filter.is_date_range()):
+            filter_bitmap = self.filter_bitmap(metadata_filter)
+            if invalid_date and metadata_filter.is_date_range():
+                invalid = bitmap & self.invalid_date_bitmap(metadata_filter.column)
+                if invalid:
+                    filter_bitmap |= invalid
+                    rest.append(metadata_filter)
+            bitmap &= filter_bitmap
+            if not bitmap:
+                break
+
+        return self.read_rows(rows_from_bitmap(bitmap, len(self)) if bitmap else []), rest
+
+def write_bitmap_index(index, index_file, stat):
+    catalog = []
+    blobs = []
+    position = 0
+    for column, values in index.bitmaps.items():
+        for value, data in values.items():
+            catalog.append([column, value, position, len(data)])
+            blobs.append(data)
+            position += len(data)
+
+    arrays = {"info": np.array(json.dumps({"version": BITMAP_INDEX_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                                            "header": index.header, "bitmaps": catalog, "date_columns": list(index.date_index),
+                                            "invalid_dates": index.invalid_dates})),
+            "offsets": index.offsets,
+            "lengths": index.lengths,
+            "bitmap_data": np.frombuffer(b"".join(blobs), dtype=np.uint8)}
+    for i, (days, row_ids) in enumerate(index.date_index.values()):
+        arrays[f"days_{i}"] = days
+        arrays[f"date_rows_{i}"] = row_ids
+
+    tmp_file = f"{index_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as fw:
+        np.savez(fw, **arrays)
+    os.replace(tmp_file, index_file)
+
+def read_bitmap_index(metadata_file, index_file, stat):
+    #the saved index if it was built from this version of the csv, otherwise None
+    try:
+        with np.load(index_file, allow_pickle=False) as saved:
+            info = json.loads(str(saved["info"]))
+            if info["version"] != BITMAP_INDEX_VERSION or info["size"] != stat.st_size or info["mtime_ns"] != stat.st_mtime_ns:
+                return None
+
+            data = saved["bitmap_data"].tobytes()
+            bitmaps = {}
+            for column, value, position, length in info["bitmaps"]:
+                bitmaps.setdefault(column, {})[value] = data[position:position+length]
+
+            date_index = {column:(saved[f"days_{i}"], saved[f"date_rows_{i}"]) for i, column in enumerate(info["date_columns"])}
+            invalid_dates = {column:[tuple(invalid) for invalid in values] for column, values in info["invalid_dates"].items()}
+
+            return BitmapIndex(metadata_file, info["header"], saved["offsets"], saved["lengths"], bitmaps, date_index, invalid_dates)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+def get_bitmap_index(metadata_file):
+    """
+    Loads the sidecar bitmap index for a metadata csv, building and saving it beside the csv first if
+    it's missing or out of date. If it can't be saved there it's just kept in memory.
+    """
+    stat = os.stat(metadata_file)
+    key = (metadata_file, stat.st_size, stat.st_mtime_ns)
+    if key in open_bitmap_indexes:
+        return open_bitmap_indexes[key]
+
+    index_file = bitmap_index_path(metadata_file)
+    index = read_bitmap_index(metadata_file, index_file, stat)
+    if index is None:
+        index = build_bitmap_index(metadata_file)
+        try:
+            write_bitmap_index(index, index_file, stat)
+        except OSError:
+            pass
+
+    open_bitmap_indexes[key] = index
+    return index
@@ -1,14 +1,153 @@
 
-import datetime as dt
+import sys
+from collections import defaultdict
+from collections.abc import MutableMapping
 
+import numpy as np
+import pandas as pd
+
+import reportfunk.funks.date_functions as date_functions
 
 def convert_date(date_string):
-    bits = date_string.split("-")
-    date_dt = dt.date(int(bits[0]),int(bits[1]), int(bits[2]))
-    
-    return date_dt
+    return date_functions.parse_date(date_string)
+
+class Marker():
+    #placeholder values that stay the same object when taxa are pickled
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __reduce__(self):
+        return self.name
+
+    def __repr__(self):
+        return self.name
+
+MISSING = Marker("MISSING") #marks a field a taxon has no value for
+DELETED = Marker("DELETED") #marks a default field that's been deleted, so it no longer reads back as "NA"
+
+field_schemas = {} #shared by every taxon made with the same fields in a run
+
+def shared_value(value):
+    #one copy of each string value, rather than a fresh string per metadata row. Interned strings are freed once nothing holds them
+    if type(value) is str:
+        return sys.intern(value)
+    return value
+
+class FieldSchema():
+    """
+    Positions of the fields held for a set of taxa. The first n_defaults fields are the ones every
+    taxon starts out with as "NA", anything set later gets a position on the end.
+    """
+    __slots__ = ("positions", "fields", "n_defaults")
+
+    def __init__(self, default_fields):
+        self.fields = list(dict.fromkeys(default_fields))
+        self.positions = {field:position for position, field in enumerate(self.fields)}
+        self.n_defaults = len(self.fields)
+
+    def position(self, field):
+        if field not in self.positions:
+            self.positions[field] = len(self.fields)
+            self.fields.append(field)
+        return self.positions[field]
+
+def taxon_schema(label_fields, tree_fields, table_fields):
+    #attribute and table schemas for taxa made with these fields
+    key = (tuple(label_fields), tuple(tree_fields), tuple(table_fields))
+    if key not in field_schemas:
+        attribute_fields = [i.replace(" ","") for i in label_fields] + [i.replace(" ","") for i in tree_fields] + ["context_table_summary_field"]
+        field_schemas[key] = (FieldSchema(attribute_fields), FieldSchema([i.replace(" ","") for i in table_fields]))
+    return field_schemas[key]
+
+class FieldView(MutableMapping):
+    """
+    Dict-style access to one set of a taxon's field values (see taxon.attribute_dict), so callers
+    can keep treating them as the dicts they used to be.
+    """
+    __slots__ = ("taxon", "slot", "schema")
+
+    def __init__(self, taxon, slot, schema):
+        self.taxon = taxon
+        self.slot = slot
+        self.schema = schema
+
+    def lookup(self, field):
+        position = self.schema.positions.get(field)
+        if position is None:
+            return MISSING
+
+        values = getattr(self.taxon, self.slot)
+        if values is not None and position < len(values):
+            value = values[position]
+            if value is DELETED:
+                return MISSING
+            if value is not MISSING:
+                return value
+
+        if position < self.schema.n_defaults:
+            return "NA"
+        return MISSING
+
+    def __getitem__(self, field):
+        value = self.lookup(field)
+        if value is MISSING:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field):
+        return self.lookup(field) is not MISSING
+
+    def __setitem__(self, field, value):
+        schema = self.schema
+        position = schema.positions.get(field)
+        if position is None:
+            position = schema.position(field)
+
+        if type(value) is str:
+            if value == "NA" and position < schema.n_defaults: #already what it reads back as
+                value = MISSING
+            else:
+                value = sys.intern(value)
+
+        values = getattr(self.taxon, self.slot)
+        if values is None:
+            values = []
+            setattr(self.taxon, self.slot, values)
+        if position >= len(values):
+            values.extend([MISSING]*(position + 1 - len(values)))
+        values[position] = value
+
+    def __delitem__(self, field):
+        if field not in self:
+            raise KeyError(field)
+        self[field] = DELETED
+
+    def __iter__(self):
+        return (field for field in list(self.schema.fields) if field in self)
+
+    def __len__(self):
+        return sum(1 for field in self)
+
+    def copy(self):
+        return dict(self)
+
+    def __repr__(self):
+        return repr(dict(self))
 
 class taxon():
+    """
+    Attribute and table values are held in lists indexed by a FieldSchema shared across the run,
+    rather than a dict per taxon, with "NA" for the starting fields left implicit. attribute_dict and
+    table_dict give the same dict-style access as before. date_dict is only made for taxa that have
+    dates, which are only ever queries.
+    """
+    #attributes that used to be added on the fly have slots too. __dict__ is only made for anything else set on a taxon
+    __slots__ = ("name", "input_display_name", "display_name", "sample_date", "epiweek", "protected", "country", "in_db", "tree",
+                "closest", "closest_distance", "snps", "query_id", "node_summary", "date_dt", "global_lin", "uk_lin",
+                "schema", "attribute_values", "table_values", "date_values", "dates_seen", "__dict__")
+
     #will need to change the args here to make data parsing general
     def __init__(self, name, country, label_fields, tree_fields, table_fields, context_table_summary_field="NA", global_lineage="NA", uk_lineage="NA",phylotype="NA"):
         self.name = name
@@ -18,22 +157,19 @@ class taxon():
         self.sample_date = "NA"
         self.epiweek = "NA"
 
-        self.date_dict = {}
-        self.table_dict = {}       
-        self.attribute_dict = {}
+        self.schema = taxon_schema(label_fields, tree_fields, table_fields)
+
+        self.attribute_values = None
+        self.table_values = None
+        self.date_values = None
+        self.dates_seen = None
 
         self.protected = False
 
-        self.country = country
+        self.country = shared_value(country)
        
         self.in_db = False
  
-        for i in label_fields:
-            self.attribute_dict[i.replace(" ","")] = "NA"
-        for i in tree_fields:
-            self.attribute_dict[i.replace(" ","")] = "NA"
-        for i in table_fields:
-            self.table_dict[i.replace(" ","")] = "NA"
             # if i == "lineage":
             #     self.table_dict["lineage"] = global_lineage
             # if i == "uk_lineage":
@@ -41,7 +177,8 @@ class taxon():
             # if i == "phylotype":
             #     self.table_dict["phylotype"] = phylotype
         
-        self.attribute_dict["context_table_summary_field"] = context_table_summary_field
+        if context_table_summary_field != "NA":
+            self.attribute_dict["context_table_summary_field"] = context_table_summary_field
         
         self.tree = "NA"
 
@@ -52,23 +189,206 @@ class taxon():
         # self.uk_lineage = uk_lineage
         # self.phylotype = phylotype
 
+    @property
+    def attribute_dict(self):
+        return FieldView(self, "attribute_values", self.schema[0])
+
+    @attribute_dict.setter
+    def attribute_dict(self, values):
+        self.attribute_values = None
+        self.attribute_dict.update(values)
+
+    @property
+    def table_dict(self):
+        return FieldView(self, "table_values", self.schema[1])
+
+    @table_dict.setter
+    def table_dict(self, values):
+        self.table_values = None
+        self.table_dict.update(values)
+
+    @property
+    def date_dict(self):
+        if self.date_values is None:
+            self.date_values = {}
+        return self.date_values
+
+    @date_dict.setter
+    def date_dict(self, values):
+        self.date_values = values
+
+    @property
+    def all_dates(self):
+        if self.dates_seen is None:
+            self.dates_seen = []
+        return self.dates_seen
+
+    @all_dates.setter
+    def all_dates(self, values):
+        self.dates_seen = values
+
 
 class lineage():
     
-    def __init__(self, name, taxa):
+    def __init__(self, name, taxa, dates=None, global_lins=None):
         
         self.name = name
         self.taxa = taxa
         self.dates = []
         self.global_lins = set()
         
-        for tax in taxa:
-            if tax.sample_date != "NA":
-                tax.date_dt = convert_date(tax.sample_date)
-                self.dates.append(tax.date_dt)
-            self.global_lins.add(tax.global_lin)
+        if dates is not None: #already worked out from a TaxonTable
+            self.dates = dates
+            self.global_lins = global_lins
+        else:
+            for tax in taxa:
+                if tax.sample_date != "NA":
+                    tax.date_dt = convert_date(tax.sample_date)
+                    self.dates.append(tax.date_dt)
+                self.global_lins.add(tax.global_lin)
                 
         if self.dates == []:
             self.first_date = "NA"
         else:
-            self.first_date = min(self.dates)
\ No newline at end of file
+            self.first_date = min(self.dates)
+
+
+class TreeTipIndex():
+    """
+    Where every sequence sits in the catchment trees, as built by parse_tree_tips. 
+    Membership is held in sets so the background metadata can be checked row by row in constant time.
+    Unpacks the same way as the old parse_tree_tips return value.
+    """
+    def __init__(self):
+
+        self.present_in_tree = set() #for pulling out the correct sequences from the background metadata to make objects
+        self.protected_sequences = set() #tips shown in the tree rather than hidden in a collapsed node
+
+        self.tip_to_tree = {} #for finding which subtree the queries are in
+        self.tip_to_collapsed_node = {} #for finding which collapsed or inserted node a sequence is hidden in
+        self.tree_to_all_tip = defaultdict(list) #for summarising trees when they are too big
+        self.inserted_node_dict = defaultdict(dict) #for node summaries
+
+    def __contains__(self, name):
+        return name in self.present_in_tree
+
+    def __iter__(self):
+        return iter((self.present_in_tree, self.tip_to_tree, self.tree_to_all_tip, self.inserted_node_dict, self.protected_sequences))
+
+    def is_protected(self, name):
+        return name in self.protected_sequences
+
+    def tree_of(self, name):
+        return self.tip_to_tree.get(name, "NA")
+
+    def collapsed_node_of(self, name):
+        return self.tip_to_collapsed_node.get(name, "NA")
+
+def stored_value(values, position, n_defaults):
+    #what a FieldView would hand back for the field at position, without making the view
+    if values is not None and position < len(values):
+        value = values[position]
+        if value is DELETED:
+            return MISSING
+        if value is not MISSING:
+            return value
+    if position < n_defaults:
+        return "NA"
+    return MISSING
+
+def field_reader(schema, field):
+    """
+    Function reading a field from taxa with this schema, from the attribute dict first and then the
+    table dict, "NA" if it's in neither. Reads the value lists directly, for going over lots of taxa.
+    """
+    attribute_schema, table_schema = schema
+    attribute_position = attribute_schema.positions.get(field)
+    table_position = table_schema.positions.get(field)
+
+    def read(tax):
+        if attribute_position is not None:
+            value = stored_value(tax.attribute_values, attribute_position, attribute_schema.n_defaults)
+            if value is not MISSING:
+                return value
+        if table_position is not None:
+            value = stored_value(tax.table_values, table_position, table_schema.n_defaults)
+            if value is not MISSING:
+                return value
+        return "NA"
+
+    return read
+
+class TaxonTable():
+    """
+    Column by column copy of a set of taxa, for summaries that would otherwise loop over every taxon object.
+    frame is a DataFrame with a row per taxon, indexed by name. Values are kept as the strings the taxa hold
+    ("NA" included), with the repetitive ones as categoricals, and sample dates are held as whole days since
+    1970-01-01, missing where there's no valid date.
+    """
+    categorical_columns = ["country", "adm1", "adm2", "node_summary", "tree", "context_table_summary_field", "uk_lineage", "global_lineage"]
+
+    def __init__(self, frame):
+        self.frame = frame
+
+    @classmethod
+    def from_taxa(cls, taxa_dict, query_dict=None):
+        rows = []
+        readers = {} #taxa almost always share one schema, so the field positions are only looked up once
+        for name, tax in taxa_dict.items():
+            schema = tax.schema
+            if id(schema) not in readers:
+                readers[id(schema)] = [field_reader(schema, field) for field in ("adm1", "adm2", "context_table_summary_field", "uk_lineage", "lineage")]
+            adm1, adm2, summary_field, uk_lineage, global_lineage = readers[id(schema)]
+
+            rows.append((name, tax.sample_date, tax.country, adm1(tax), adm2(tax), getattr(tax, "node_summary", "NA"), tax.tree, summary_field(tax),
+                        getattr(tax, "uk_lin", None) or uk_lineage(tax), getattr(tax, "global_lin", None) or global_lineage(tax),
+                        tax.in_db, query_dict is not None and query_dict.get(name) is tax))
+
+        names, sample_dates, *categories, in_db, query = zip(*rows) if rows else [()]*(len(cls.categorical_columns) + 4)
+
+        frame = pd.DataFrame({column:pd.Categorical(values) for column, values in zip(cls.categorical_columns, categories)})
+        frame["date"] = cls.to_days(sample_dates)
+        frame["in_db"] = np.array(in_db, dtype=bool)
+        frame["query"] = np.array(query, dtype=bool)
+        frame.index = pd.Index(names, name="name", dtype=object)
+
+        return cls(frame)
+
+    @staticmethod
+    def to_days(date_strings):
+        days = date_functions.parse_dates(date_strings)
+        missing = np.isnat(days)
+        return pd.arrays.IntegerArray(np.where(missing, 0, days.astype("int64")).astype("int32"), missing)
+
+    @staticmethod
+    def day_number(date):
+        #days since 1970-01-01 for a datetime.date, to compare with the date column
+        return int(np.datetime64(date, "D").astype("int64"))
+
+    @staticmethod
+    def to_dates(days):
+        #datetime.dates for a date column, None where it's missing
+        missing = days.isna().to_numpy()
+        dates = days.fillna(0).to_numpy("int64").astype("datetime64[D]").astype(object)
+        dates[missing] = None
+        return dates.tolist()
+
+    @staticmethod
+    def date_string(days):
+        #YYYY-MM-DD for a number of days, as str() gives for a datetime.date
+        return str(np.datetime64(int(days), "D"))
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __contains__(self, name):
+        return name in self.frame.index
+
+    def row_numbers(self, names):
+        #row of each name, -1 for names that aren't in the table
+        return self.frame.index.get_indexer(list(names))
+
+    def rows(self, names):
+        #rows for names, in the order given. Raises KeyError for any that aren't in the table, as the dict lookup would
+        return self.frame.loc[list(names)]
+
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import re
+import datetime as dt
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from epiweeks import Week
+
+DATE_CACHE_SIZE = 8192 #distinct date strings kept. Metadata has a few hundred dates spread over millions of rows
+
+DATE_PATTERN = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})", re.ASCII) #what strptime accepts for %Y-%m-%d
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def cached_date(date_string):
+    #None for anything that isn't YYYY-MM-DD, so bad strings are only looked at once too
+    if not isinstance(date_string, str):
+        return None
+    match = DATE_PATTERN.fullmatch(date_string)
+    if not match:
+        return None
+    try:
+        return dt.date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+    except ValueError:
+        return None
+
+def parse_date(date_string):
+    date = cached_date(date_string)
+    if date is None:
+        raise ValueError(f"{date_string} is not a YYYY-MM-DD date")
+    return date
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def epiweek(date_string):
+    return Week.fromdate(parse_date(date_string))
+
+def invalid_dates(values, valid=None):
+    """
+    Positions in a column of date strings of the values that aren't YYYY-MM-DD dates, empty and
+    NA being fine. Only the distinct strings are looked at. valid is a set of strings already known
+    to be fine, which is added to, so strings seen in earlier batches or columns aren't checked again.
+    """
+    if valid is None:
+        valid = set()
+
+    unknown = set(values).difference(valid)
+    if not unknown:
+        return []
+
+    invalid = set()
+    for value in unknown:
+        if value == "" or value == "NA" or cached_date(value) is not None:
+            valid.add(value)
+        else:
+            invalid.add(value)
+
+    if not invalid:
+        return []
+    return [position for position, value in enumerate(values) if value in invalid]
+
+def date_to_decimal(date):
+    #fraction of the year gone by the start of the day, as baltic.decimalDate does
+    days_in_year = (dt.date(date.year + 1, 1, 1) - dt.date(date.year, 1, 1)).days
+    return date.year + (date.timetuple().tm_yday - 1)/days_in_year
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def decimal_date(date_string):
+    return date_to_decimal(parse_date(date_string))
+
+def parse_dates(date_strings):
+    """
+    Parses a column of date strings into a datetime64[D] array, with NaT where there's no valid date.
+    Each distinct string is only parsed once.
+    """
+    codes, distinct = pd.factorize(np.asarray(date_strings, dtype=object))
+
+    parsed = np.array([cached_date(date_string) or np.datetime64("NaT") for date_string in distinct] + [np.datetime64("NaT")], dtype="datetime64[D]")
+    return parsed[codes] #codes of -1 (missing values) pick up the NaT on the end
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import os
+import mmap
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+FASTA_CHUNK_SIZE = 64*1024*1024 #bytes of fasta handed to a worker at a time
+FASTA_LINE_WIDTH = 60 #sequence line length, as SeqIO.write has it
+SEQUENCE_WHITESPACE = b" \t\r\n" #taken out of sequences, as SeqIO.parse does
+
+@contextmanager
+def mapped_fasta(fasta):
+    #memory map of a fasta file, or empty bytes for an empty one as that can't be mapped
+    if os.path.getsize(fasta) == 0:
+        yield b""
+        return
+    with open(fasta, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        yield data
+
+def record_starts(data, start, end):
+    #offsets of the ">" starting each record that starts in data[start:end]
+    if start == 0 and data[:1] == b">":
+        yield 0
+    position = data.find(b"\n>", max(start - 1, 0), end)
+    while position != -1:
+        yield position + 1
+        position = data.find(b"\n>", position + 1, end)
+
+def record_title(data, offset):
+    #the header line without the ">", and where the sequence starts
+    line_end = data.find(b"\n", offset)
+    if line_end == -1:
+        line_end = len(data)
+    return data[offset+1:line_end].rstrip().decode("utf-8"), line_end + 1
+
+def record_sequence(data, offset, record_end):
+    sequence_start = record_title(data, offset)[1]
+    return data[sequence_start:record_end].translate(None, SEQUENCE_WHITESPACE)
+
+def record_stats(data, start, end):
+    """
+    (offset, end, title, length, N count) of each record starting in data[start:end], counted
+    straight off the bytes. The N count includes lower case ns.
+    """
+    starts = list(record_starts(data, start, end))
+    if not starts:
+        return
+    following = data.find(b"\n>", end - 1) if end < len(data) else -1
+    ends = starts[1:] + [following + 1 if following != -1 else len(data)]
+
+    for offset, record_end in zip(starts, ends):
+        title, sequence_start = record_title(data, offset)
+        sequence = data[sequence_start:record_end].translate(None, SEQUENCE_WHITESPACE)
+        yield offset, record_end, title, len(sequence), sequence.count(b"N") + sequence.count(b"n")
+
+def chunk_record_stats(fasta, start, end):
+    #worker job: stats for the records starting in one chunk of the file
+    with mapped_fasta(fasta) as data:
+        return list(record_stats(data, start, end))
+
+def fasta_chunks(data, size, chunk_size):
+    #byte ranges of about chunk_size, each moved on to start at a record
+    bounds = [0]
+    position = chunk_size
+    while position < size:
+        record_start = data.find(b"\n>", position - 1)
+        if record_start == -1:
+            break
+        if record_start + 1 > bounds[-1]:
+            bounds.append(record_start + 1)
+        position = record_start + 1 + chunk_size
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def fasta_record_stats(fasta, threads=1, chunk_size=FASTA_CHUNK_SIZE):
+    """
+    Streams (offset, end, title, length, N count) for each record of a fasta file, in file order,
+    without making a SeqRecord of each one. With threads > 1, files bigger than chunk_size are split
+    into chunks at record boundaries and the stats worked out in that many processes.
+    Raises ValueError if the file doesn't start with a record, as SeqIO.parse does.
+    """
+    size = os.path.getsize(fasta)
+
+    with mapped_fasta(fasta) as data:
+        if size and data[:1] != b">":
+            raise ValueError(f"{fasta} doesn't start with a '>' record header")
+
+        if threads > 1 and size > chunk_size:
+            chunks = fasta_chunks(data, size, chunk_size)
+            with ProcessPoolExecutor(max_workers=threads) as pool:
+                for stats in pool.map(chunk_record_stats, [fasta]*len(chunks), *zip(*chunks)):
+                    yield from stats
+        else:
+            yield from record_stats(data, 0, size)
+
+def write_fasta_record(fw, title, sequence, width=FASTA_LINE_WIDTH):
+    #same layout as SeqIO.write
+    fw.write(f">{title}\n")
+    sequence = sequence.decode("ascii")
+    for i in range(0, len(sequence), width):
+        fw.write(sequence[i:i+width] + "\n")
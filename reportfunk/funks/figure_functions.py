@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+from contextlib import contextmanager
+
+import matplotlib as mpl
+from matplotlib import pyplot as plt
+
+from reportfunk.funks.stage_functions import figure_stats, resident_memory_mb
+
+def record_figure(stage):
+
+    stats = figure_stats[stage]
+
+    stats["figures"] = stats.get("figures", 0) + 1
+    stats["peak_open_figures"] = max(stats.get("peak_open_figures", 0), len(plt.get_fignums()))
+    stats["peak_memory_mb"] = max(stats.get("peak_memory_mb", 0.0), resident_memory_mb())
+
+def display_figure(fig):
+    #notebooks only render figures that are still open when the cell finishes, so flush it before it gets closed
+    if "inline" in mpl.get_backend():
+        plt.show()
+
+@contextmanager
+def managed_figure(stage, *subplot_args, savefile=None, fig_format="svg", axes=True, **subplot_kwargs):
+    """
+    Wraps plt.subplots so the figure is always closed once it has been saved (or displayed,
+    if there's no savefile). Stops pyplot holding on to every figure made during a run.
+    With axes=False it's an empty plt.figure, for callers adding their own subplots.
+    """
+    if axes:
+        fig, ax = plt.subplots(*subplot_args, **subplot_kwargs)
+    else:
+        fig, ax = plt.figure(*subplot_args, **subplot_kwargs), None
+    try:
+        yield fig, ax
+
+        if savefile:
+            fig.savefig(savefile, format=fig_format)
+        else:
+            display_figure(fig)
+    finally:
+        record_figure(stage)
+        plt.close(fig)
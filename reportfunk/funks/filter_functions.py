@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import reportfunk.funks.metadata_functions as metadata_functions
+import reportfunk.funks.date_functions as date_functions
+
+class MetadataFilter():
+    """
+    One column=value filter from --from-metadata or protect, worked out once before any rows are read.
+    A value that's two YYYY-MM-DD dates separated by a colon is a date range, which includes both ends.
+    Anything else has to match the column exactly, ignoring case.
+    """
+    __slots__ = ("column", "value", "start", "end")
+
+    def __init__(self, column, value):
+        self.column = column
+        self.value = value.upper()
+        self.start = self.end = None
+
+        if value.count(":") == 1:
+            start, end = value.split(":")
+            start, end = date_functions.cached_date(start), date_functions.cached_date(end)
+            if start and end:
+                self.start, self.end = start, end
+
+    def __repr__(self):
+        return f"MetadataFilter({self.column!r}, {self.value!r})"
+
+    def is_date_range(self):
+        return self.start is not None
+
+    def in_range(self, value):
+        date = date_functions.cached_date(value)
+        return date is not None and self.start <= date <= self.end
+
+    def predicate(self, position, invalid_date=None):
+        """
+        Function of (row number, row) saying whether the value at position in the row passes. For a
+        date range, invalid_date(value, row number, column) is called for values that aren't dates.
+        """
+        if not self.is_date_range():
+            target = self.value
+            return lambda row_number, row: row[position] is not None and row[position].upper() == target
+
+        passes = {} #dates repeat over a lot of rows, so each distinct one is only looked at once
+        def matches(row_number, row):
+            value = row[position]
+            if value not in passes:
+                if invalid_date and value not in ("", "NA") and date_functions.cached_date(value) is None:
+                    invalid_date(value, row_number, self.column)
+                passes[value] = self.in_range(value)
+            return passes[value]
+        return matches
+
+def filter_rows(numbered_rows, header, filters, invalid_date=None):
+    """
+    The (row, row number) pairs for rows that pass every filter, in a single pass over (row number, row)
+    pairs with fields in header order. Exact matches are tried before date ranges, and each row is
+    dropped at the first filter it fails.
+    """
+    positions = metadata_functions.column_positions(header)
+    ordered = sorted(filters, key=lambda metadata_filter: metadata_filter.is_date_range())
+    predicates = [metadata_filter.predicate(positions[metadata_filter.column], invalid_date) for metadata_filter in ordered]
+
+    for row_number, row in numbered_rows:
+        for matches in predicates:
+            if not matches(row_number, row):
+                break
+        else:
+            yield row, row_number
+
+def store_candidates(store, filters, invalid_date=None):
+    """
+    Rows of the store that pass one of the filters, looked up with its index on that column, and
+    the filters left for them to pass. Exact matches are used ahead of date ranges.
+    """
+    ordered = sorted(filters, key=lambda metadata_filter: metadata_filter.is_date_range())
+    first, rest = ordered[0], ordered[1:]
+
+    if first.is_date_range():
+        in_range = []
+        for value, row_number in store.distinct_values(first.column):
+            if invalid_date and value not in ("", "NA") and date_functions.cached_date(value) is None:
+                invalid_date(value, row_number, first.column)
+            if first.in_range(value):
+                in_range.append(value)
+        rows = store.rows_in(first.column, in_range)
+    else:
+        rows = store.rows_matching(first.column, first.value)
+
+    return ((row_number, row) for row, row_number in rows), rest
+
+def matching_rows(metadata_file, filters, store=None, invalid_date=None, bitmap_index=None):
+    """
+    Streams the rows of a metadata csv that pass every filter, as (row, row number) with the row's
+    fields in header order, so they can be written out without being held. Returns the header too.
+    With a bitmap index, only the rows passing the filters it covers are read.
+    """
+    if bitmap_index and filters:
+        found = bitmap_index.candidates(filters, invalid_date)
+        if found:
+            numbered_rows, filters = found
+            return bitmap_index.header, filter_rows(numbered_rows, bitmap_index.header, filters, invalid_date)
+
+    if store and filters:
+        numbered_rows, filters = store_candidates(store, filters, invalid_date)
+        return store.header, filter_rows(numbered_rows, store.header, filters, invalid_date)
+
+    f, header = metadata_functions.open_metadata(metadata_file)
+
+    def numbered_rows():
+        with f:
+            yield from enumerate(metadata_functions.projected_rows(f, header, range(len(header))), 1)
+
+    return header, filter_rows(numbered_rows(), header, filters, invalid_date)
@@ -11,6 +11,14 @@ import tempfile
 import pkg_resources
 import yaml
 
+import reportfunk.funks.store_functions as store_functions
+import reportfunk.funks.date_functions as date_functions
+import reportfunk.funks.metadata_functions as metadata_functions
+import reportfunk.funks.bitmap_functions as bitmap_functions
+import reportfunk.funks.fasta_functions as fasta_functions
+from reportfunk.funks.preflight_functions import Preflight
+from reportfunk.funks.filter_functions import MetadataFilter, matching_rows
+
 END_FORMATTING = '\033[0m'
 BOLD = '\033[1m'
 UNDERLINE = '\033[4m'
@@ -123,21 +131,137 @@ def check_query_file(query, cwd, config):
         sys.stderr.write(cyan(f"Error: cannot find query file at {queryfile}\nCheck if the file exists, or if you're inputting a set of ids in config (e.g. EPI12345,EPI23456) please provide them under keyword `ids`\n."))
         sys.exit(-1)
 
+def get_metadata_store(config, metadata=None):
+    #indexed copy of the background metadata, if it's switched on with metadata_store in the config
+    if not metadata:
+        metadata = config["background_metadata"]
+    if config.get("metadata_store"):
+        return store_functions.get_store(metadata, config.get("metadata_store_dir"), config.get("threads", 1), config.get("metadata_store_incremental", True))
+    return None
+
+preflight_summaries = {} #what the preflight saw of a query csv and background metadata, so later checks don't read them again
+
+def file_signature(path):
+    #changes if the file is rewritten, e.g. a query csv made from ids
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+def preflight_ready(config):
+    #the preflight needs the query csv, which isn't known yet for the first checks of some tools
+    query = config.get("query")
+    return bool(query) and os.path.exists(query) and bool(config.get("input_column")) and bool(config.get("data_column"))
+
+def config_date_columns(config):
+    #the date columns asked for in the config, before they've been checked against the headers
+    date_columns = []
+
+    date_fields = config.get("date_fields")
+    if date_fields and type(date_fields) != bool:
+        if not type(date_fields) is list:
+            date_fields = date_fields.split(",")
+        date_columns += [field.replace(" ","") for field in date_fields]
+
+    if config.get("sample_date_column"):
+        date_columns.append(config["sample_date_column"])
+
+    return list(dict.fromkeys(date_columns))
+
+def add_date_checks(preflight, columns, valid):
+    #valid is the set of strings already found to be valid dates, shared between files, so each is only parsed once
+    for column in columns:
+        def check(first_row, values, column=column):
+            for position in date_functions.invalid_dates(values, valid):
+                preflight.problem(f"Metadata field `{values[position]}` [at column: {column}, row: {first_row + position}] contains unaccepted date format")
+        preflight.add_check(column, check)
+
+def date_preflights(config, date_columns, valid=None):
+    #checks the date columns of the query csv and background metadata, a single pass over each, returning the problems found
+    if valid is None:
+        valid = set()
+
+    query_preflight = Preflight("query metadata")
+    add_date_checks(query_preflight, date_columns, valid)
+    query_preflight.run_file(config["query"])
+
+    background_preflight = Preflight("metadata")
+    add_date_checks(background_preflight, date_columns, valid)
+    store = get_metadata_store(config)
+    if store: #each distinct value only needs checking once, then the rows of the bad ones are looked up
+        background_preflight.run_distinct(store.header, store.distinct_values, store.value_rows)
+    else:
+        background_preflight.run_file(config["background_metadata"])
+
+    return query_preflight.problems + background_preflight.problems
+
+def report_problems(problems):
+    #every problem found, rather than just the first, then exits
+    if not problems:
+        return
+
+    sys.stderr.write(cyan(f"Error: {len(problems)} problem{'s' if len(problems) > 1 else ''} found in the input files\n"))
+    for problem in problems:
+        sys.stderr.write(f"    - {problem}\n")
+    if any("date format" in problem for problem in problems):
+        sys.stderr.write(f"Please use format %Y-%m-%d, i.e. `YYYY-MM-DD` for dates\n")
+    sys.exit(-1)
+
+def preflight_inputs(config):
+    """
+    Checks the query csv and background metadata before any parsing, in a single pass over each:
+    the search columns are there, which queries are in the background metadata, and that the date
+    columns hold valid dates. Every problem found is reported together before exiting. What it saw
+    of the files is returned and kept, for the checks after it to use rather than reading them again.
+    """
+    input_column = config["input_column"]
+    data_column = config["data_column"]
+
+    key = (file_signature(config["query"]), file_signature(config["background_metadata"]), input_column, data_column)
+    if key in preflight_summaries:
+        return preflight_summaries[key]
+
+    date_columns = config_date_columns(config)
+    valid_dates = set()
+
+    query_preflight = Preflight("query metadata")
+    queries = []
+    query_preflight.add_check(input_column, lambda first_row, names: queries.extend(names), required=True)
+    add_date_checks(query_preflight, date_columns, valid_dates)
+    query_summary = query_preflight.run_file(config["query"])
+
+    query_set = set(queries)
+    in_background = set()
+
+    background_preflight = Preflight("metadata")
+    add_date_checks(background_preflight, date_columns, valid_dates)
+    store = get_metadata_store(config)
+    if store:
+        background_preflight.add_check(data_column, required=True)
+        background_summary = background_preflight.run_distinct(store.header, store.distinct_values, store.value_rows)
+        if data_column in store.header:
+            in_background.update(store.names_present(data_column, query_set))
+    else:
+        background_preflight.add_check(data_column, lambda first_row, names: in_background.update(query_set.intersection(names)), required=True)
+        background_summary = background_preflight.run_file(config["background_metadata"])
+
+    report_problems(query_preflight.problems + background_preflight.problems)
+
+    summary = {"query_header": query_summary["header"],
+                "query_rows": query_summary["rows"],
+                "queries": queries,
+                "background_header": background_summary["header"],
+                "background_rows": background_summary.get("rows"),
+                "queries_in_background": in_background,
+                "date_columns": date_columns}
+
+    preflight_summaries[key] = summary
+    return summary
+
 def check_background_for_queries(config):
 
     data_column = config["data_column"]
     input_column = config["input_column"]
-    queries = []
-    with open(config["query"],"r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            queries.append(row[input_column])
-    c = 0
-    with open(config["background_metadata"], "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row[data_column] in queries:
-                c +=1
+
+    c = len(preflight_inputs(config)["queries_in_background"])
     if c == 0:
         sys.stderr.write(cyan(f'Error: no valid queries to process.\n') + f'\
 0 queries from `{input_column}` column matched in background metadata to `{data_column}`.\nUse `--data-column` to change the default search column in the database.\n')
@@ -347,9 +471,8 @@ def check_date_format(date_string,row_number=None,column_name=None):
     date_format = '%Y-%m-%d'
     check_date= ""
     if date_string != "" and date_string != "NA":
-        try:
-            check_date = datetime.strptime(date_string, date_format).date()
-        except:
+        check_date = date_functions.cached_date(date_string)
+        if check_date is None:
             if row_number and column_name:
                 sys.stderr.write(cyan(f"Error: Metadata field `{date_string}` [at column: {column_name}, row: {row_number}] contains unaccepted date format\nPlease use format {date_format}, i.e. `YYYY-MM-DD`\n"))
             else:
@@ -362,41 +485,30 @@ def check_date_format(date_string,row_number=None,column_name=None):
 
 def check_date_columns(config, date_column_list):
 
-    metadata_header = config["background_metadata_header"]
-    query = config["query"]
-    query_header = config["query_metadata_header"]
-    metadata = config["background_metadata"]
+    if preflight_ready(config): #columns the preflight has already checked don't need doing again
+        checked = preflight_inputs(config)["date_columns"]
+        date_column_list = [col for col in date_column_list if col not in checked]
 
-    with open(query) as f:
-        reader = csv.DictReader(f)
-        data = [r for r in reader]
-        for col in date_column_list:
-            if col in query_header:
-                row_num = 0
-                for line in data:
-                    row_num +=1
-                    check_date_format(line[col],row_num, col)
-
-    with open(metadata, "r", encoding = "utf-8") as f:
-        reader = csv.DictReader(f)
-        data = [r for r in reader]
-        for col in date_column_list:
-            if col in metadata_header:
-                row_num = 0
-                for line in data:
-                    row_num +=1
-                    check_date_format(line[col],row_num, col)
+    if date_column_list:
+        report_problems(date_preflights(config, date_column_list))
 
 def check_metadata_for_search_columns(config):
 
     data_column = config["data_column"]
     
-    with open(config["background_metadata"],"r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        header = reader.fieldnames
-        if data_column not in header:
-            sys.stderr.write(cyan(f"{data_column} column not in metadata\n"))
-            sys.exit(-1)
+    store = get_metadata_store(config) #built here if needed, as this is the first look at the background metadata
+    if preflight_ready(config):
+        header = preflight_inputs(config)["background_header"]
+    elif store:
+        header = store.header
+    else:
+        with open(config["background_metadata"],"r", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            header = reader.fieldnames
+
+    if data_column not in header:
+        sys.stderr.write(cyan(f"{data_column} column not in metadata\n"))
+        sys.exit(-1)
 
     config["background_metadata_header"] = header
     
@@ -477,22 +589,20 @@ def check_label_and_tree_and_date_fields(config):
         reader = csv.DictReader(f)
         column_names = reader.fieldnames
 
-        if input_column not in column_names: # Checking input column present in query file
-            sys.stderr.write(cyan(f"Error: Query file missing header field {input_column}\n"))
-            sys.exit(-1)
-        if display_name not in column_names:
-            sys.stderr.write(cyan(f"Error: Query file missing header field {display_name}\n"))
-            sys.exit(-1)
-        else:
-            config["input_column"] = input_column
-            config["display_name"] = display_name
+    if input_column not in column_names: # Checking input column present in query file
+        sys.stderr.write(cyan(f"Error: Query file missing header field {input_column}\n"))
+        sys.exit(-1)
+    if display_name not in column_names:
+        sys.stderr.write(cyan(f"Error: Query file missing header field {display_name}\n"))
+        sys.exit(-1)
+    else:
+        config["input_column"] = input_column
+        config["display_name"] = display_name
 
-        print(green("Input querys to process:"))
-        queries = []
-        for row in reader:
-            queries.append(row[input_column])
-            
-        print(green(f"Number of queries:") + f" {len(queries)}")
+    print(green("Input querys to process:"))
+    queries = preflight_inputs(config)["queries"]
+        
+    print(green(f"Number of queries:") + f" {len(queries)}")
 
     tree_field_str = qc_list_inputs("tree_fields", column_names, config)
     labels_str = qc_list_inputs("label_fields", column_names, config)
@@ -571,72 +681,56 @@ def input_file_qc(minlen_arg,maxambig_arg,config):
 
     if fasta != "":
 
-        queries = []
-        with open(config["query"],"r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                queries.append(row[config["input_column"]])
+        preflight = preflight_inputs(config)
+        queries = set(preflight["queries"])
+        already_in_tree = preflight["queries_in_background"] #everything that passes the other checks is a query
 
-        do_not_run = []
-        passed = []
-        
-        
+        min_length = config["min_length"]
+        max_ambiguity = config["max_ambiguity"]
+        input_column = config["input_column"]
 
-        for record in SeqIO.parse(fasta, "fasta"):
-            if len(record) < config["min_length"]:
-                record.description = record.description + f" fail=seq_len:{len(record)}"
-                do_not_run.append(record)
-                print(cyan(f"    - {record.id}\tsequence too short: Sequence length {len(record)}"))
-            else:
-                num_N = str(record.seq).upper().count("N")
-                prop_N = round((num_N)/len(record.seq), 2)
-                if prop_N > config["max_ambiguity"]: 
-                    record.description = record.description + f" fail=N_content:{prop_N}"
-                    do_not_run.append(record)
-                    print(cyan(f"    - {record.id}\thas an N content of {prop_N}"))
-                else:
-                    if record.id not in queries:
-                        record.description = record.description + f" fail=not_in_query_csv"
-                        do_not_run.append(record)
-                        print(cyan(f"    - {record.id}\tis not in query"))
-                    else:
-                        passed.append(record)
-        
-        passed_ids = [i.id for i in passed]
-        already_in_tree = []
-        with open(config["background_metadata"],"r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row[config["data_column"]] in passed_ids:
-                    already_in_tree.append(row[config["data_column"]])
-        run = []
-
-        for record in passed:
-            if record.id in already_in_tree:
-                record.description = record.description + f" fail=already_in_tree"
-                do_not_run.append(record)
-                print(cyan(f"    - {record.id}\tis already in tree"))
-            else:
-                run.append(record)
-            
-        
         post_qc_query = os.path.join(config["outdir"], 'query.post_qc.fasta')
-        with open(post_qc_query,"w") as fw:
-            SeqIO.write(run, fw, "fasta")
-
         qc_fail = os.path.join(config["outdir"],'query.failed_qc.csv')
 
-        input_column = config["input_column"]
-        with open(qc_fail,"w") as fw:
-            fw.write(f"{input_column},reason_for_failure\n")
-            for record in do_not_run:
-                desc = record.description.split(" ")
-                for i in desc:
-                    if i.startswith("fail="):
-                        fw.write(f"{record.id},{i}\n")
-        
+        def write_failure(fw, record_id, title, reason):
+            #along with any fail= already in the header
+            for i in title.split(" ") + [f"fail={reason}"]:
+                if i.startswith("fail="):
+                    fw.write(f"{record_id},{i}\n")
+
+        in_tree = [] #these have always been reported after the other failures
 
-        num_seqs = len(run)
+        try:
+            with fasta_functions.mapped_fasta(fasta) as data, open(post_qc_query,"w") as passed_fw, open(qc_fail,"w") as failed_fw:
+                failed_fw.write(f"{input_column},reason_for_failure\n")
+
+                for offset, record_end, title, length, num_N in fasta_functions.fasta_record_stats(fasta, config.get("threads", 1)):
+                    record_id = title.split(None, 1)[0] if title else ""
+
+                    if length < min_length:
+                        write_failure(failed_fw, record_id, title, f"seq_len:{length}")
+                        print(cyan(f"    - {record_id}\tsequence too short: Sequence length {length}"))
+                        continue
+
+                    prop_N = round((num_N)/length, 2)
+                    if prop_N > max_ambiguity: 
+                        write_failure(failed_fw, record_id, title, f"N_content:{prop_N}")
+                        print(cyan(f"    - {record_id}\thas an N content of {prop_N}"))
+                    elif record_id not in queries:
+                        write_failure(failed_fw, record_id, title, "not_in_query_csv")
+                        print(cyan(f"    - {record_id}\tis not in query"))
+                    elif record_id in already_in_tree:
+                        in_tree.append((record_id, title))
+                    else:
+                        fasta_functions.write_fasta_record(passed_fw, title, fasta_functions.record_sequence(data, offset, record_end))
+                        num_seqs += 1
+
+                for record_id, title in in_tree:
+                    write_failure(failed_fw, record_id, title, "already_in_tree")
+                    print(cyan(f"    - {record_id}\tis already in tree"))
+        except ValueError as e:
+            sys.stderr.write(cyan(f"Error: cannot parse query fasta: {e}\n"))
+            sys.exit(-1)
 
     config["post_qc_query"] = post_qc_query
     config["qc_fail"] = qc_fail
@@ -708,81 +802,36 @@ Columns that were found:\n{cols}"""))
                 sys.exit(-1)
     return query_dict,column_names
 
-def parse_date_range(metadata,column_name,to_search,rows_to_search):
-    date_range = to_search.split(":")
-    start_date = datetime.strptime(date_range[0], "%Y-%m-%d").date()
-    end_date = datetime.strptime(date_range[1], "%Y-%m-%d").date()
-
-    if rows_to_search == []:
-        with open(metadata, newline="", encoding = "utf-8") as f:
-            reader = csv.DictReader(f)
-            c =0
-            for row in reader:
-                c +=1
-                row_date = row[column_name]
-                
-                check_date = check_date_format(row_date,c,column_name)
-
-                if start_date <= check_date <= end_date:
-                    rows_to_search.append((row,c))
-    else:
-        last_rows_to_search = rows_to_search
-        new_rows_to_search = []
-        for row,c in last_rows_to_search:
-            row_date = row[column_name]
-
-            check_date = check_date_format(row_date,c,column_name)
-
-            if start_date <= check_date <= end_date:
-                new_rows_to_search.append((row,c))
-
-        rows_to_search = new_rows_to_search
-    return rows_to_search
-
-def parse_general_field(metadata,column_name,to_search,rows_to_search):
-    if rows_to_search == []:
-        with open(metadata, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            c =0
-            for row in reader:
-                c +=1
-                row_info = row[column_name]
-                
-                if row_info.upper() == to_search:
-                    rows_to_search.append((row,c))
-    else:
-        last_rows_to_search = rows_to_search
-
-        new_rows_to_search = []
-        for row,c in last_rows_to_search:
-            row_info = row[column_name]
-            
-            if row_info.upper() == to_search:
-
-                new_rows_to_search.append((row,c))
-
-        rows_to_search = new_rows_to_search
-
-    return rows_to_search
-
-def filter_down_metadata(query_dict,metadata):
-    rows_to_search = []
-    
-    for column_name in query_dict:
-        
-        to_search = query_dict[column_name].upper()
-
-        # assumes its a date range if it has a ':' and startswith 2020-, 2019- or 2021-
-        if ':' in to_search:
-            if to_search.startswith("2020-") or to_search.startswith("2019-") or to_search.startswith("2021-"):
-                print(f"Date range detected: {to_search}")
-                rows_to_search = parse_date_range(metadata,column_name,to_search,rows_to_search)
-        else:
-            # parse by exact match 
-            rows_to_search = parse_general_field(metadata,column_name,to_search,rows_to_search)
-
-    return rows_to_search
-
+def get_metadata_bitmap_index(config, metadata):
+    #bitmaps of the metadata's low cardinality columns, if they're switched on with metadata_bitmap_index in the config
+    if config.get("metadata_bitmap_index"):
+        return bitmap_functions.get_bitmap_index(metadata)
+    return None
+
+def filter_down_metadata(query_dict,metadata,store=None,bitmap_index=None):
+    #rows matching every filter, streamed as (fields in header order, row number) with the header, from a single pass over the metadata
+    filters = [MetadataFilter(column_name, to_search) for column_name, to_search in query_dict.items()]
+
+    for metadata_filter in filters:
+        if metadata_filter.is_date_range():
+            print(f"Date range detected: {metadata_filter.value}")
+
+    return matching_rows(metadata, filters, store, invalid_date=check_date_format, bitmap_index=bitmap_index)
+
+def write_metadata_rows(outfile, header, rows, name_column, names_kept=50):
+    #writes rows out as they come, returning how many there were and the names of the first few
+    name_position = metadata_functions.column_positions(header).get(name_column)
+    count = 0
+    names = []
+    with open(outfile,"w") as fw:
+        writer = csv.writer(fw, lineterminator='\n')
+        writer.writerow(header)
+        for row,c in rows:
+            writer.writerow(row)
+            count +=1
+            if name_position is not None and len(names) < names_kept:
+                names.append(row[name_position])
+    return count, names
 
 def from_metadata_checks(config):
     if "query" in config:
@@ -811,30 +860,17 @@ def generate_query_from_metadata(query,from_metadata, metadata, config):
     # checks if field in metadata file and adds to dict: query_dict[country]=Ireland for eg
     query_dict,column_names = get_dict_of_metadata_filters("from_metadata",to_parse, metadata)
     
-    rows_to_search = filter_down_metadata(query_dict,metadata)
-    # if this is empty, for each column to search it'll open the whole file and search them
-    # if it's not empty, it'll only search this list of rows
-    
-    
-
-    with open(query,"w") as fw:
-        writer = csv.DictWriter(fw, fieldnames=column_names,lineterminator='\n')
-        writer.writeheader()
-        count = 0
+    header, rows = filter_down_metadata(query_dict,metadata,get_metadata_store(config, metadata),get_metadata_bitmap_index(config, metadata))
 
-        query_ids = []
-        for row,c in rows_to_search:
-            writer.writerow(row)
-            count +=1
-            query_ids.append(row["sequence_name"])
+    count, query_ids = write_metadata_rows(query, header, rows, "sequence_name")
 
-        if count == 0:
-            sys.stderr.write(cyan(f"Error: No sequences meet the criteria defined with `--from-metadata`.\nPlease check your query is in the correct format (e.g. sample_date=YYYY-MM-DD).\nExiting\n"))
-            sys.exit(-1)
-        print(green(f"Number of sequences matching defined query:") + f" {count}")
-        if len(query_ids) < 50:
-            for i in query_ids:
-                print(f" - {i}")
+    if count == 0:
+        sys.stderr.write(cyan(f"Error: No sequences meet the criteria defined with `--from-metadata`.\nPlease check your query is in the correct format (e.g. sample_date=YYYY-MM-DD).\nExiting\n"))
+        sys.exit(-1)
+    print(green(f"Number of sequences matching defined query:") + f" {count}")
+    if count < 50:
+        for i in query_ids:
+            print(f" - {i}")
     return query
 
 
@@ -856,27 +892,18 @@ def parse_protect(protect_arg,metadata,config):
         
         query_dict,column_names = get_dict_of_metadata_filters("protect",to_parse, metadata)
 
-        rows_to_search = filter_down_metadata(query_dict,metadata)
+        header, rows = filter_down_metadata(query_dict,metadata,get_metadata_store(config, metadata),get_metadata_bitmap_index(config, metadata))
 
         protect = os.path.join(config["outdir"], "protected_background.csv")
 
-        with open(protect,"w") as fw:
-            writer = csv.DictWriter(fw, fieldnames=column_names,lineterminator='\n')
-            writer.writeheader()
-            count = 0
-
-            protect_ids = []
-            for row,c in rows_to_search:
-                writer.writerow(row)
-                count +=1
-                protect_ids.append(row[data_column])
+        count, protect_ids = write_metadata_rows(protect, header, rows, data_column)
 
-            if count == 0:
-                print(cyan(f"Note: No sequences meet the criteria defined with `protect`.\n"))
-                config["protect"] = False
-            else:
-                config["protect"] = protect
-                print(green(f"Number of background sequences to be protected:") + f" {count}")
+        if count == 0:
+            print(cyan(f"Note: No sequences meet the criteria defined with `protect`.\n"))
+            config["protect"] = False
+        else:
+            config["protect"] = protect
+            print(green(f"Number of background sequences to be protected:") + f" {count}")
 
 
 def collapse_config(collapse_threshold,config):
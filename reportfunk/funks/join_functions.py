@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+from reportfunk.funks.pipeline_functions import stage_batches
+
+EMPTY = ("",)
+EMPTY_OR_NA = ("", "NA")
+PRECEDENCES = ("override", "fill")
+GAPS = ("NA", "missing")
+
+#where each target's values are on a taxon
+TARGETS = {"attribute": lambda taxon: taxon.attribute_dict,
+            "table": lambda taxon: taxon.table_dict,
+            "date": lambda taxon: taxon.date_dict}
+
+def join_stage(table, key_position, unmatched=False, name=None):
+    """
+    Pipeline stage joining each row to the entry in table (a dict, i.e. the hash table built on the
+    smaller side) with the same value at key_position, so the larger side is only streamed once.
+    Rows come out as (entry, row). Rows with no entry are dropped, or come out as (None, row) with unmatched.
+    """
+    def join(batch):
+        joined = []
+        for row in batch:
+            entry = table.get(row[key_position])
+            if entry is not None or unmatched:
+                joined.append((entry, row))
+        return joined
+
+    def stage(batches):
+        return stage_batches(batches, join, name)
+    return stage
+
+class FieldRule():
+    """
+    How one column of a row is merged into a taxon. The value goes to field in the taxon's attribute
+    dict, table dict or date dict (target). Empty values are never used. With "override" precedence
+    the value replaces whatever's there, with "fill" it's only used if the taxon has no value yet,
+    i.e. the first non-empty value wins. A gap is a field that's "NA" or not there at all, or just
+    one that's not there with gap="missing". transform(value) can change the value before it's set.
+    Raises ValueError for a target, precedence or gap that isn't one of these.
+    """
+    __slots__ = ("source", "target", "field", "precedence", "empty", "gap", "transform")
+
+    def __init__(self, source, target="attribute", field=None, precedence="override", empty=EMPTY_OR_NA, gap="NA", transform=None):
+        for name, value, allowed in [("target", target, tuple(TARGETS)), ("precedence", precedence, PRECEDENCES), ("gap", gap, GAPS)]:
+            if value not in allowed:
+                raise ValueError(f"FieldRule for {source!r} has {name} {value!r}, it has to be one of {', '.join(allowed)}")
+
+        self.source = source
+        self.target = target
+        self.field = field if field else source
+        self.precedence = precedence
+        self.empty = empty
+        self.gap = gap
+        self.transform = transform
+
+    def __repr__(self):
+        return f"FieldRule({self.source!r} -> {self.target}[{self.field!r}], {self.precedence})"
+
+class FieldPolicy():
+    """
+    Ordered set of FieldRules for merging rows into taxa. merger(index) works out which rules apply
+    to the columns that are there once, and returns a function applying them to a (taxon, row).
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+    def __add__(self, other):
+        return FieldPolicy(self.rules + other.rules)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def merger(self, index):
+        #rules for different targets never touch the same value, so they're grouped by target, keeping their order within it
+        groups = {}
+        for rule in self.rules:
+            if rule.source in index:
+                step = (index[rule.source], rule.field, rule.empty, rule.precedence == "fill", rule.gap == "missing", rule.transform)
+                groups.setdefault(rule.target, []).append(step)
+        groups = [(TARGETS[target], steps) for target, steps in groups.items()]
+
+        def merge(taxon, row):
+            for target_values, steps in groups:
+                values = target_values(taxon)
+                for position, field, empty, fill, missing_gap, transform in steps:
+                    value = row[position]
+                    if value in empty:
+                        continue
+
+                    if fill:
+                        if missing_gap:
+                            if field in values:
+                                continue
+                        elif values.get(field, "NA") != "NA":
+                            continue
+
+                    if transform:
+                        value = transform(value)
+                    values[field] = value
+            return taxon
+
+        return merge
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+import os
+import csv
+import io
+import mmap
+import hashlib
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+CHUNK_SIZE = 64*1024*1024 #bytes of metadata handed to a worker at a time
+
+OFFSET_INDEX_VERSION = "1"
+OFFSET_HEADER_SIZE = 128 #bytes of text at the top of an offset index, describing the csv it was built from
+OFFSET_DTYPE = np.dtype([("key", "<u8"), ("offset", "<u8"), ("length", "<u4")])
+
+chunk_job = {} #what the workers need to parse a chunk, set once per worker process
+
+def read_header(metadata_file):
+    with open(metadata_file, "r", newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+    return header
+
+def column_positions(header):
+    #if a column name is repeated the last one wins, as it does in csv.DictReader
+    return {column:position for position, column in enumerate(header)}
+
+def row_to_dict(header, fields):
+    #same shape as a csv.DictReader row
+    row = dict(zip(header, fields))
+    if len(fields) < len(header):
+        for column in header[len(fields):]:
+            row[column] = None
+    elif len(fields) > len(header):
+        row[None] = fields[len(header):]
+    return row
+
+def complete_records(f):
+    #joins up lines where a quoted field runs over a line break, so each item is one csv record
+    for line in f:
+        while '"' in line and line.count('"') % 2 == 1:
+            next_line = f.readline()
+            if not next_line:
+                break
+            line += next_line
+        yield line
+
+def record_fields(f, header, name_column=None, keep=None):
+    #splits each record into its fields. If keep is given, records whose name isn't in it are skipped before being split up
+    if keep is not None:
+        name_index = column_positions(header)[name_column]
+
+    for line in complete_records(f):
+        if line.strip("\r\n") == "":
+            continue
+
+        if '"' in line: #quoted fields can contain commas, so leave these to the csv module
+            fields = next(csv.reader(io.StringIO(line)))
+            if keep is not None and (len(fields) <= name_index or fields[name_index] not in keep):
+                continue
+        else:
+            if keep is not None:
+                try:
+                    name = line.split(",", name_index+1)[name_index].rstrip("\r\n")
+                except IndexError:
+                    continue
+                if name not in keep:
+                    continue
+            fields = line.rstrip("\r\n").split(",")
+
+        yield fields
+
+def open_metadata(metadata_file):
+    f = open(metadata_file, "r", newline="", encoding="utf-8")
+    header = next(csv.reader([f.readline()]))
+    return f, header
+
+def metadata_reader(metadata_file, name_column, keep):
+    """
+    Reads the header of a metadata csv once, and streams the rows whose name_column value is in keep.
+    The name is pulled out of each line with a plain split, so rows that aren't needed are never
+    parsed into fields. Returns the header and a generator of csv.DictReader-style rows.
+    """
+    f, header = open_metadata(metadata_file)
+
+    def rows():
+        with f:
+            for fields in record_fields(f, header, name_column, keep):
+                yield row_to_dict(header, fields)
+
+    return header, rows()
+
+def projector(positions):
+    #itemgetter hands back a bare value rather than a tuple when there's only one position
+    if len(positions) == 0:
+        return lambda fields: ()
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda fields: (fields[position],)
+    return itemgetter(*positions)
+
+def projected_rows(f, header, projected, name_column=None, keep=None):
+
+    project = projector(projected)
+
+    width = len(header)
+    padding = [None]*width
+
+    for fields in record_fields(f, header, name_column, keep):
+        if len(fields) < width:
+            fields = fields + padding[:width-len(fields)]
+        yield project(fields)
+
+def chunk_ranges(metadata_file, chunk_size):
+    #byte ranges covering the rows of the file, with every boundary moved up to the start of a line
+    with open(metadata_file, "rb") as f:
+        f.readline()
+        start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+
+        ranges = []
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = f.tell()
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+def set_chunk_job(metadata_file, header, projected, name_column, keep):
+    chunk_job.update(metadata_file=metadata_file, header=header, projected=projected, name_column=name_column, keep=keep)
+
+def parse_chunk(byte_range):
+    start, end = byte_range
+    with open(chunk_job["metadata_file"], "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+
+    #a quoted field running over a line break may have been cut by a boundary, so hand the chunk back to be read in order
+    if '"' in text and any(line.count('"') % 2 == 1 for line in text.split("\n")):
+        return None
+
+    f = io.StringIO(text, newline="")
+    return list(projected_rows(f, chunk_job["header"], chunk_job["projected"], chunk_job["name_column"], chunk_job["keep"]))
+
+def parallel_rows(metadata_file, header, projected, name_column, keep, threads, chunk_size):
+    """
+    Parses byte ranges of the file in a process pool, filtering and projecting in the workers.
+    Chunks come back in file order, so the rows are the same as a serial read. If a chunk has a
+    quoted line break in it, everything from the start of that chunk is read serially instead.
+    """
+    ranges = chunk_ranges(metadata_file, chunk_size)
+
+    with ProcessPoolExecutor(max_workers=threads, initializer=set_chunk_job, initargs=(metadata_file, header, projected, name_column, keep)) as executor:
+        for byte_range, chunk_rows in zip(ranges, executor.map(parse_chunk, ranges)):
+            if chunk_rows is None:
+                try:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                except TypeError: #cancel_futures is python 3.9+, before that the queued chunks are just left to finish
+                    executor.shutdown(wait=False)
+                with open(metadata_file, "rb") as f:
+                    f.seek(byte_range[0])
+                    yield from projected_rows(io.TextIOWrapper(f, encoding="utf-8", newline=""), header, projected, name_column, keep)
+                return
+
+            yield from chunk_rows
+
+def projected_reader(metadata_file, columns, name_column=None, keep=None, threads=1, chunk_size=CHUNK_SIZE):
+    """
+    Streams a metadata csv as tuples holding only the given columns that are in the file, in header order.
+    Returns the header, a dict of column name to position in the tuples, and the tuple generator.
+    Short rows are padded with None, as csv.DictReader does. With name_column and keep, only the rows
+    whose name is in keep are read. With threads > 1, files bigger than chunk_size are split up and
+    parsed in that many processes.
+    """
+    f, header = open_metadata(metadata_file)
+
+    positions = column_positions(header)
+    projected = sorted({positions[column] for column in columns if column in positions})
+    index = {header[position]:i for i, position in enumerate(projected)}
+
+    if threads > 1 and os.path.getsize(metadata_file) > chunk_size:
+        f.close()
+        return header, index, parallel_rows(metadata_file, header, projected, name_column, keep, threads, chunk_size)
+
+    def rows():
+        with f:
+            yield from projected_rows(f, header, projected, name_column, keep)
+
+    return header, index, rows()
+
+def name_key(name):
+    #stable 64 bit hash of a sequence name. Rows are checked by name after they're read, so a clash only costs a wasted read
+    if isinstance(name, str):
+        name = name.encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), "little")
+
+def offset_index_path(metadata_file, name_column):
+    return f"{metadata_file}.{name_column}.offsets"
+
+def scan_offsets(metadata_file, name_column):
+    #one pass over the raw bytes, noting where each record starts and how long it is
+    keys, offsets, lengths = [], [], []
+
+    with open(metadata_file, "rb") as f:
+        header = next(csv.reader([f.readline().decode("utf-8")]))
+        name_index = column_positions(header)[name_column]
+        offset = f.tell()
+
+        for line in f:
+            while b'"' in line and line.count(b'"') % 2 == 1:
+                next_line = f.readline()
+                if not next_line:
+                    break
+                line += next_line
+
+            if line.strip(b"\r\n") != b"":
+                if b'"' in line:
+                    fields = next(csv.reader(io.StringIO(line.decode("utf-8"))))
+                    name = fields[name_index] if len(fields) > name_index else None
+                else:
+                    try:
+                        name = line.split(b",", name_index+1)[name_index].rstrip(b"\r\n")
+                    except IndexError:
+                        name = None
+
+                if name is not None:
+                    keys.append(name_key(name))
+                    offsets.append(offset)
+                    lengths.append(len(line))
+
+            offset += len(line)
+
+    index = np.empty(len(keys), dtype=OFFSET_DTYPE)
+    index["key"] = keys
+    index["offset"] = offsets
+    index["length"] = lengths
+
+    return np.sort(index, order=["key", "offset"])
+
+def write_offset_index(index, index_file, stat):
+    header = f"reportfunk offsets {OFFSET_INDEX_VERSION} {stat.st_size} {stat.st_mtime_ns} {len(index)}\n"
+    tmp_file = f"{index_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as fw:
+        fw.write(header.encode("utf-8").ljust(OFFSET_HEADER_SIZE, b" "))
+        index.tofile(fw)
+    os.replace(tmp_file, index_file)
+
+def read_offset_index(index_file, stat):
+    #memory maps the index if it was built from this version of the csv, otherwise None
+    try:
+        with open(index_file, "rb") as f:
+            header = f.read(OFFSET_HEADER_SIZE).decode("utf-8").split()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+    if header[:3] != ["reportfunk", "offsets", OFFSET_INDEX_VERSION] or header[3:5] != [str(stat.st_size), str(stat.st_mtime_ns)]:
+        return None
+
+    count = int(header[5])
+    if count == 0:
+        return np.empty(0, dtype=OFFSET_DTYPE)
+    return np.memmap(index_file, dtype=OFFSET_DTYPE, mode="r", offset=OFFSET_HEADER_SIZE, shape=(count,))
+
+def get_offset_index(metadata_file, name_column):
+    """
+    Loads the sidecar index of name -> byte offset and length for a metadata csv, building and saving it
+    beside the csv first if it's missing or out of date. If it can't be saved there it's just kept in memory.
+    """
+    stat = os.stat(metadata_file)
+    index_file = offset_index_path(metadata_file, name_column)
+
+    index = read_offset_index(index_file, stat)
+    if index is None:
+        index = scan_offsets(metadata_file, name_column)
+        try:
+            write_offset_index(index, index_file, stat)
+        except OSError:
+            pass
+
+    return index
+
+def indexed_reader(metadata_file, columns, name_column, keep):
+    """
+    Same as projected_reader with a keep set, but uses the offset index to decode only the rows
+    whose names are in keep, straight out of a memory map of the csv. Rows come back in file order.
+    """
+    header = read_header(metadata_file)
+    offset_index = get_offset_index(metadata_file, name_column)
+
+    positions = column_positions(header)
+    projected = sorted({positions[column] for column in columns if column in positions})
+    index = {header[position]:i for i, position in enumerate(projected)}
+
+    wanted_keys = np.sort(np.fromiter((name_key(name) for name in keep), dtype=np.uint64, count=len(keep)))
+    keys = offset_index["key"]
+    starts = np.searchsorted(keys, wanted_keys, side="left")
+    counts = np.searchsorted(keys, wanted_keys, side="right") - starts
+
+    #positions of every matching entry, as a name can be on more than one row
+    firsts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    matches = offset_index[firsts + np.arange(counts.sum())]
+    offsets, first_match = np.unique(matches["offset"], return_index=True)
+    lengths = matches["length"][first_match]
+
+    def rows():
+        if len(offsets) == 0:
+            return
+        with open(metadata_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            text = b"".join(mm[offset:offset+length] for offset, length in zip(offsets.tolist(), lengths.tolist())).decode("utf-8")
+        yield from projected_rows(io.StringIO(text, newline=""), header, projected, name_column, keep)
+
+    return header, index, rows()
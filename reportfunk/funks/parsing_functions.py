@@ -5,19 +5,23 @@ import pandas as pd
 import csv
 from tabulate import tabulate
 import reportfunk.funks.baltic as bt
+import reportfunk.funks.metadata_functions as metadata_functions
+import reportfunk.funks.store_functions as store_functions
+import reportfunk.funks.date_functions as date_functions
 import os
-import datetime as dt
+import re
 import math
+from functools import lru_cache
 import matplotlib.pyplot as plt
-from epiweeks import Week,Year
 
-from reportfunk.funks.class_definitions import taxon,lineage
+from reportfunk.funks.class_definitions import taxon,lineage,TreeTipIndex,TaxonTable,shared_value
+from reportfunk.funks.stage_functions import timed_stage, write_stage_summary
+from reportfunk.funks.pipeline_functions import run_pipeline, filter_stage, map_stage, batch_stage
+from reportfunk.funks.join_functions import join_stage, FieldRule, FieldPolicy, EMPTY, EMPTY_OR_NA
 
 def convert_date(date_string):
     try:
-        bits = date_string.split("-")
-        date_dt = dt.date(int(bits[0]),int(bits[1]), int(bits[2]))
-        return date_dt
+        return date_functions.parse_date(date_string)
     except ValueError:
         print("The wrong date format was supplied. Please re-run with YYYY-MM-DD")
     
@@ -44,32 +48,27 @@ def parse_tree_tips(tree_dir, collapsed_node_file):
 
     collapsed_node_dict = parse_collapsed_nodes(collapsed_node_file)
 
-    present_in_tree = [] #for pulling out the correct sequences from the background metadata to make objects
-    tip_to_tree = {} #for finding which subtree the queries are in
-    tree_to_all_tip = defaultdict(list) #for summarising trees when they are too big
-    inserted_node_dict = defaultdict(dict) #for node summaries
-    protected_sequences = []
+    tip_index = TreeTipIndex()
 
     for fn in os.listdir(tree_dir):
         tree_name = fn.split(".")[0]
-        if tree_name not in tree_to_all_tip: #for summarising trees when they are too big - contains subtrees
-            all_tips = []
-        else:
-            all_tips = tree_to_all_tip[tree_name]
+        all_tips = tip_index.tree_to_all_tip[tree_name] #contains subtrees as well as tips
         
         if fn.endswith("tree"):
             tree = bt.loadNewick(tree_dir + "/" + fn, absoluteTime=False)
             for k in tree.Objects: 
                 if k.branchType == 'leaf' and "inserted" not in k.name and "subtree" not in k.name:
                     if "collapsed" not in k.name:
-                        present_in_tree.append(k.name)
+                        tip_index.present_in_tree.add(k.name)
                         all_tips.append(k.name)
-                        tip_to_tree[k.name] = tree_name
-                        protected_sequences.append(k.name)
+                        tip_index.tip_to_tree[k.name] = tree_name
+                        tip_index.protected_sequences.add(k.name)
                     else:
                         in_collapsed = collapsed_node_dict[k.name]
-                        present_in_tree.extend(in_collapsed)
+                        tip_index.present_in_tree.update(in_collapsed)
                         all_tips.extend(in_collapsed)
+                        for member in in_collapsed:
+                            tip_index.tip_to_collapsed_node[member] = k.name
 
                 if k.branchType == 'leaf' and "subtree" in k.name:
                     all_tips.append(k.name)
@@ -85,22 +84,23 @@ def parse_tree_tips(tree_dir, collapsed_node_file):
                     node_name = l.strip("\n").split("\t")[0]
                     for tip in tip_list:
                         if "collapsed" not in tip:
-                            present_in_tree.append(tip)
+                            tip_index.present_in_tree.add(tip)
                             all_tips.append(tip)
                             list_of_tips.append(tip)
+                            tip_index.tip_to_collapsed_node[tip] = node_name
                         else:
                             in_collapsed = collapsed_node_dict[tip]
-                            present_in_tree.extend(in_collapsed)
+                            tip_index.present_in_tree.update(in_collapsed)
                             all_tips.extend(in_collapsed)
                             list_of_tips.extend(in_collapsed)
+                            for member in in_collapsed:
+                                tip_index.tip_to_collapsed_node[member] = tip
 
                     node_dict[node_name] = list_of_tips
 
-            inserted_node_dict[tree_name] = node_dict
-
-        tree_to_all_tip[tree_name] = all_tips
+            tip_index.inserted_node_dict[tree_name] = node_dict
 
-    return present_in_tree, tip_to_tree, tree_to_all_tip, inserted_node_dict, protected_sequences
+    return tip_index
 
 def parse_filtered_metadata(metadata_file, tip_to_tree, label_fields, tree_fields, table_fields, database_date_column):
     
@@ -111,326 +111,389 @@ def parse_filtered_metadata(metadata_file, tip_to_tree, label_fields, tree_field
 
     tree_to_tip = defaultdict(list)
 
-    with open(metadata_file, "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        headers = reader.fieldnames   
+    columns = ["country", "query_id", "query", "closest", database_date_column, "SNPdistance", "SNPs"]
+    header, index, in_data = metadata_functions.projected_reader(metadata_file, columns)
 
-    with open(metadata_file, "r", encoding="utf-8") as f:
-        in_data = csv.DictReader(f)
-        for sequence in in_data:
-            
-            country = sequence["country"]
-            query_id = sequence['query_id']
-            query_name = sequence['query']
-            closest_name = sequence["closest"]
-            
-            sample_date = sequence[database_date_column] #this may need to be flexible if using a different background database
+    country_i, query_id_i, query_i, closest_i, date_i, distance_i, snps_i = [index[column] for column in columns]
 
-            closest_distance = sequence["SNPdistance"]
-            snps = sequence['SNPs']
+    for sequence in in_data:
+        
+        country = sequence[country_i]
+        query_id = sequence[query_id_i]
+        query_name = sequence[query_i]
+        closest_name = sequence[closest_i]
+        
+        sample_date = sequence[date_i] #this may need to be flexible if using a different background database
 
-            if query_id not in query_id_dict: #it's in the fasta file and in the db, this should take the db
-               
-                new_taxon = taxon(query_name, country, label_fields, tree_fields, table_fields)
+        closest_distance = sequence[distance_i]
+        snps = sequence[snps_i]
 
-                new_taxon.query_id = query_id
+        if query_id not in query_id_dict: #it's in the fasta file and in the db, this should take the db
+           
+            new_taxon = taxon(query_name, country, label_fields, tree_fields, table_fields)
 
-                if query_name == closest_name: #if it's in database, get its sample date
-                    new_taxon.in_db = True
-                    new_taxon.sample_date = sample_date
-                    new_taxon.epiweek = Week.fromdate(convert_date(sample_date))
-                    new_taxon.closest = "NA"
-                else:
-                    new_taxon.closest = closest_name
-                    new_taxon.closest_distance = closest_distance
-                    new_taxon.snps = snps
-                    closest_seqs.add(closest_name)
-                    
-                if query_name in tip_to_tree:
-                    relevant_tree = tip_to_tree[query_name]
-                else:
-                    relevant_tree = "NA"
-                new_taxon.tree = relevant_tree
+            new_taxon.query_id = query_id
 
-                tree_to_tip[relevant_tree].append(new_taxon)
-            
-                query_dict[query_name] = new_taxon
-                query_id_dict[query_id] = new_taxon
-            
+            if query_name == closest_name: #if it's in database, get its sample date
+                new_taxon.in_db = True
+                new_taxon.sample_date = sample_date
+                if sample_date != "" and sample_date != "NA":
+                    new_taxon.epiweek = date_functions.epiweek(sample_date)
+                new_taxon.closest = "NA"
+            else:
+                new_taxon.closest = closest_name
+                new_taxon.closest_distance = closest_distance
+                new_taxon.snps = snps
+                closest_seqs.add(closest_name)
+                
+            if query_name in tip_to_tree:
+                relevant_tree = tip_to_tree[query_name]
+            else:
+                relevant_tree = "NA"
+            new_taxon.tree = relevant_tree
+
+            tree_to_tip[relevant_tree].append(new_taxon)
+        
+            query_dict[query_name] = new_taxon
+            query_id_dict[query_id] = new_taxon
+        
     return query_dict, query_id_dict, tree_to_tip, closest_seqs
 
-def UK_adm1(query_name, input_value):
-    
-    contract_dict = {"SCT":"Scotland", "WLS": "Wales", "ENG":"England", "NIR": "Northern_Ireland"}
-    cleaning = {"SCOTLAND":"Scotland", "WALES":"Wales", "ENGLAND":"England", "NORTHERN_IRELAND": "Northern_Ireland", "NORTHERN IRELAND": "Northern_Ireland"}
+ADM1_CODES = {"SCT":"Scotland", "WLS": "Wales", "ENG":"England", "NIR": "Northern_Ireland"}
+ADM1_NAMES = {"SCOTLAND":"Scotland", "WALES":"Wales", "ENGLAND":"England", "NORTHERN_IRELAND": "Northern_Ireland", "NORTHERN IRELAND": "Northern_Ireland"}
+
+#every spelling that's known up front, so most values are a single lookup
+ADM1_VARIANTS = {f"UK-{code}":adm1 for code, adm1 in ADM1_CODES.items()}
+ADM1_VARIANTS.update(ADM1_NAMES)
+ADM1_VARIANTS.update({adm1:adm1 for adm1 in ADM1_CODES.values()})
 
-    adm1 = input_value
+#codes and names that can turn up in a sequence name. The lookahead finds overlapping ones too, as substring checks would
+ADM1_NAME_PARTS = {part:(rank, adm1) for rank, (code, adm1) in enumerate(ADM1_CODES.items()) for part in (code, adm1)}
+ADM1_NAME_PATTERN = re.compile("(?=(" + "|".join(re.escape(part) for part in ADM1_NAME_PARTS) + "))")
 
+ADM1_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=ADM1_CACHE_SIZE)
+def adm1_from_value(input_value):
+    #the adm1 an input value stands for on its own, None if the sequence name has to be looked at
+    if input_value in ADM1_VARIANTS:
+        return ADM1_VARIANTS[input_value]
     if "UK" in input_value:
-        adm1_prep = input_value.split("-")[1]
-        adm1 = contract_dict[adm1_prep]
-    else:
-        if input_value.upper() in cleaning.keys():
-            adm1 = cleaning[input_value.upper()]
-        else:
-            for k,v in contract_dict.items():
-                if k in query_name or v in query_name: #if any part of any country name is in the query name it will pick it up assign it
-                    adm1 = v
+        return ADM1_CODES[input_value.split("-")[1]]
+    return ADM1_NAMES.get(input_value.upper())
+
+def adm1_from_name(query_name, input_value):
+    #if a country code or name is anywhere in the sequence name it's used. If there's more than one, the last in ADM1_CODES wins
+    matches = ADM1_NAME_PATTERN.findall(query_name)
+    if not matches:
+        return input_value
+    if len(matches) == 1:
+        return ADM1_NAME_PARTS[matches[0]][1]
+    return max(ADM1_NAME_PARTS[part] for part in matches)[1]
+
+def UK_adm1(query_name, input_value):
+
+    adm1 = adm1_from_value(input_value)
+    if adm1 is None:
+        adm1 = adm1_from_name(query_name, input_value)
 
     return adm1
 
-def parse_input_csv(input_csv, query_id_dict, input_column, display_name, sample_date_column, tree_fields, label_fields, table_fields, context_table_summary_field, date_fields=None, UK_adm2_dict=None, patient_id_col=None, reinfection=False): 
+#background rows have their adm2 sorted and location label worked out before merging, and these go on the end of the row under these names
+SORTED_ADM2 = "<sorted adm2>"
+LOCATION_LABEL = "<location label>"
+
+def input_csv_policy(input_column, tree_fields, label_fields, table_fields, context_table_summary_field, date_fields):
+    #values given in the input csv take precedence over what came from the background database
+    rules = [FieldRule(field, "date", transform=convert_date) for field in date_fields]
+
+    if context_table_summary_field:
+        rules.append(FieldRule(context_table_summary_field, field="context_table_summary_field", empty=EMPTY))
+
+    rules += [FieldRule(field, "table", empty=EMPTY) for field in table_fields]
+    rules += [FieldRule(field, empty=EMPTY) for field in label_fields]
+    rules += [FieldRule(field, empty=EMPTY) for field in tree_fields if field != input_column and field != "adm1"] #adm1 depends on the country, see parse_input_csv
+
+    return FieldPolicy(rules)
+
+def background_query_policy(tree_fields, label_fields, table_fields, context_table_summary_field, date_fields):
+    #queries only have gaps filled from the background database, so the first non-empty value wins
+    rules = [FieldRule(SORTED_ADM2, field="adm2", precedence="fill", empty=EMPTY, gap="missing"),
+            FieldRule(LOCATION_LABEL, field="location_label", precedence="fill", empty=EMPTY, gap="missing")]
+
+    if context_table_summary_field:
+        rules.append(FieldRule(context_table_summary_field, field="context_table_summary_field", precedence="fill", empty=EMPTY))
+
+    rules += [FieldRule(field, "date", precedence="fill", gap="missing", transform=convert_date) for field in date_fields]
+    rules += [FieldRule(field, precedence="fill") for field in tree_fields if field != "adm1"] #adm1 depends on the country, see parse_background_metadata
+    rules += [FieldRule(field, precedence="fill") for field in label_fields]
+    rules += [FieldRule(field, "table", precedence="fill") for field in table_fields]
+
+    return FieldPolicy(rules)
+
+def background_taxon_policy(label_fields, table_fields, context_table_summary_field):
+    #sequences that are only in the background database just take what's there
+    rules = [FieldRule(field) for field in label_fields]
+
+    if context_table_summary_field:
+        rules.append(FieldRule(context_table_summary_field, field="context_table_summary_field", empty=EMPTY))
+
+    rules += [FieldRule(field, "table") for field in table_fields]
+
+    return FieldPolicy(rules)
+
+def sorted_adm2(adm2):
+    if "|" in adm2:
+        adm2 = "|".join(sorted(adm2.split("|")))
+    return adm2
+
+def parse_input_csv(input_csv, query_id_dict, input_column, display_name, sample_date_column, tree_fields, label_fields, table_fields, context_table_summary_field, date_fields=None, UK_adm2_dict=None, patient_id_col=None, reinfection=False, field_policy=None): 
     
     full_query_count = 0
     new_query_dict = {}
-    
-    with open(input_csv, 'r') as f:
-        reader = csv.DictReader(f)
-        col_name_prep = next(reader)
-        col_names = list(col_name_prep.keys())
-    
-    with open(input_csv, 'r') as f:
-        in_data = csv.DictReader(f)
-        #in_data = [r for r in reader]
-        for sequence in in_data:
-            full_query_count += 1
-            name = sequence[input_column]
 
-            if name in query_id_dict.keys():
-                taxon = query_id_dict[name]
-
-                if reinfection:
-                    taxon.attribute_dict["patient"] = sequence[patient_id_col]
-                    
-                taxon.input_display_name = sequence[display_name]
-
-                if reinfection:
-                    taxon.attribute_dict["patient"] = sequence[patient_id_col]
-
-                for field in date_fields:
-                    if field in reader.fieldnames:
-                        if sequence[field] != "" and sequence[field] != "NA":
-                            date_dt = convert_date(sequence[field])
-                            taxon.date_dict[field] = date_dt 
-
-                if sample_date_column in col_names: #if it's not in the background database or there is no date in the background database but date is provided in the input query
-                    if sequence[sample_date_column] != "":
-                        taxon.sample_date = sequence[sample_date_column]
-                        taxon.epiweek = Week.fromdate(convert_date(sequence[sample_date_column]))
-
-                if context_table_summary_field and context_table_summary_field in col_names:
-                    if sequence["context_table_summary_field"] != "":
-                        taxon.attribute_dict["context_table_summary_field"] = sequence[context_table_summary_field]
-                     
-                for col in col_names: #Add other metadata fields provided
-                    if col in table_fields:
-                        if sequence[col] != "":
-                            taxon.table_dict[col] = sequence[col]
-                    
-                    if col in label_fields:
-                        if sequence[col] != "":
-                            taxon.attribute_dict[col] = sequence[col]
-                    
-                    if col in tree_fields and col != input_column and col != "adm1":
-                        if sequence[col] != "":
-                            taxon.attribute_dict[col] = sequence[col]
-                    
-                    if taxon.country == "UK": 
-                        if col == "adm1":
-                            adm1 = UK_adm1(name, sequence[col])
-                            taxon.attribute_dict["adm1"] = adm1
-
-                        if col == "adm2":
-
-                            adm2 = sequence["adm2"] 
-                            if "|" in adm2:
-                                adm2 = "|".join(sorted(adm2.split("|")))
-                            
-                            taxon.attribute_dict["adm2"] = adm2 
-
-                            if "location" in col_names:
-                               location_label = sequence["location"]
-                            else:
-                                location_label = adm2
-
-                            taxon.attribute_dict["location_label"] = location_label
-                            
-                            if "adm1" not in col_names and "adm1" in tree_fields:
-                                if sequence[col] in UK_adm2_dict.keys():
-                                    adm1 = UK_adm2_dict[sequence[col]]
-                                    taxon.attribute_dict["adm1"] = adm1               
-
-                new_query_dict[taxon.name] = taxon
-
-      
+    if not date_fields:
+        date_fields = []
+
+    if not field_policy:
+        field_policy = input_csv_policy(input_column, tree_fields, label_fields, table_fields, context_table_summary_field, date_fields)
+
+    columns = [input_column, display_name, sample_date_column, context_table_summary_field, patient_id_col, "adm1", "adm2", "location"] + date_fields + tree_fields + label_fields + table_fields
+    col_names, index, in_data = metadata_functions.projected_reader(input_csv, columns)
+
+    name_i = index[input_column]
+    merge_fields = field_policy.merger(index)
+
+    def count_rows(batch):
+        nonlocal full_query_count
+        full_query_count += len(batch)
+        return batch
+
+    def merge(joined):
+        taxon, sequence = joined
+        name = sequence[name_i]
+        attributes = taxon.attribute_dict
+
+        if reinfection:
+            attributes["patient"] = sequence[index[patient_id_col]]
+            
+        taxon.input_display_name = sequence[index[display_name]]
+
+        if sample_date_column in index: #if it's not in the background database or there is no date in the background database but date is provided in the input query
+            if sequence[index[sample_date_column]] != "":
+                taxon.sample_date = sequence[index[sample_date_column]]
+                taxon.epiweek = date_functions.epiweek(sequence[index[sample_date_column]])
+
+        merge_fields(taxon, sequence)
+
+        if taxon.country == "UK": 
+            if "adm1" in index:
+                attributes["adm1"] = UK_adm1(name, sequence[index["adm1"]])
+
+            if "adm2" in index:
+                value = sequence[index["adm2"]]
+                attributes["adm2"] = sorted_adm2(value)
+                attributes["location_label"] = sequence[index["location"]] if "location" in index else sorted_adm2(value)
+                
+                if "adm1" not in index and "adm1" in tree_fields:
+                    if value in UK_adm2_dict.keys():
+                        attributes["adm1"] = UK_adm2_dict[value]
+
+        return taxon
+
+    def sink(batch):
+        for taxon in batch:
+            new_query_dict[taxon.name] = taxon
+
+    #the queries are the hash table and the input csv is streamed past it once
+    stages = [batch_stage(count_rows),
+            join_stage(query_id_dict, name_i, name="input_csv_join"),
+            map_stage(merge, "input_csv_merge")]
+    run_pipeline(in_data, stages, sink)
+
     return new_query_dict, full_query_count 
 
-def parse_background_metadata(query_dict, label_fields, tree_fields, table_fields, background_metadata, present_in_tree, closest_sequences, node_summary_option, tip_to_tree, database_name_column, database_sample_date_column, protected_sequences,context_table_summary_field, date_fields, virus):
+def parse_background_metadata(query_dict, label_fields, tree_fields, table_fields, background_metadata, present_in_tree, closest_sequences, node_summary_option, tip_to_tree, database_name_column, database_sample_date_column, protected_sequences,context_table_summary_field, date_fields, virus, threads=1, store=None, offset_index=False, query_policy=None):
 
     full_tax_dict = query_dict.copy()
 
-    with open(background_metadata, 'r') as f:
-        reader = csv.DictReader(f)
-        col_name_prep = next(reader)
-        col_names = list(col_name_prep.keys())
+    #hashed lookups, as these are checked against every row of the background metadata
+    present_in_tree = set(present_in_tree)
+    closest_sequences = set(closest_sequences)
+    protected_sequences = set(protected_sequences)
+
+    if not date_fields:
+        date_fields = []
+
+    if not query_policy:
+        query_policy = background_query_policy(tree_fields, label_fields, table_fields, context_table_summary_field, date_fields)
+    taxon_policy = background_taxon_policy(label_fields, table_fields, context_table_summary_field)
+
+    #only rows for sequences in the trees, closest sequences or queries are ever parsed
+    wanted = present_in_tree | closest_sequences | set(query_dict.keys())
+    columns = [database_name_column, database_sample_date_column, "country", "adm2", "location", node_summary_option, context_table_summary_field] + label_fields + tree_fields + table_fields + date_fields
+    if store:
+        col_names, index, in_data = store.projected_reader(columns, database_name_column, wanted)
+    elif offset_index: #jumps straight to the wanted rows using the sidecar index of row offsets
+        col_names, index, in_data = metadata_functions.indexed_reader(background_metadata, columns, database_name_column, wanted)
+    else:
+        col_names, index, in_data = metadata_functions.projected_reader(background_metadata, columns, database_name_column, wanted, threads=threads)
 
-    old_data = False
-    with open(background_metadata, 'r') as f:
-        in_data = csv.DictReader(f)
-        for sequence in in_data:
-            
-            seq_name = sequence[database_name_column]
-            date = sequence[database_sample_date_column] 
-            country = sequence["country"]
+    old_data = "adm2_raw" not in col_names ##for civet
+    adm2_present_in_background = "adm2" in col_names
 
-            if "adm2_raw" not in col_names: ##for civet
-                old_data = True
+    name_i = index[database_name_column]
 
-            if "adm2" in col_names:
-                adm2 = sequence['adm2']
-                if "|" in adm2:
-                    adm2 = "|".join(sorted(adm2.split("|")))
+    merge_index = dict(index)
+    merge_index[SORTED_ADM2] = len(index)
+    merge_index[LOCATION_LABEL] = len(index) + 1
+    fill_query_fields = query_policy.merger(merge_index)
+    fill_taxon_fields = taxon_policy.merger(index)
 
-                if "location" in col_names:
-                    location_label = sequence["location"]
-                else:
-                    location_label = adm2
+    def normalise(joined):
+        #the values every background row is used for, tidied up
+        tax_object, sequence = joined
+        seq_name = sequence[name_i]
+        date = sequence[index[database_sample_date_column]] 
+        country = sequence[index["country"]]
 
-                adm2_present_in_background = True
-            else:
-                adm2 = ""
-                location_label = ""
-                adm2_present_in_background = False
-
-            # if virus == "sars-cov-2":	
-            #     uk_lineage = sequence["uk_lineage"]	
-            #     global_lineage = sequence["lineage"]	
-            #     phylotype = sequence["phylotype"]	
-
-            if node_summary_option == "adm2":
-                if country != "UK":
-                    node_summary_trait = country 
-                else:
-                    node_summary_trait = sequence["adm2"] 
+        if adm2_present_in_background:
+            adm2 = sorted_adm2(sequence[index["adm2"]])
+
+            if "location" in index:
+                location_label = sequence[index["location"]]
             else:
-                node_summary_trait = sequence[node_summary_option]
+                location_label = adm2
+        else:
+            adm2 = ""
+            location_label = ""
 
-            if (seq_name in present_in_tree or seq_name in closest_sequences) and seq_name not in query_dict.keys():
-                
-                # if virus == "sars-cov-2":	
-                #     new_taxon = taxon(seq_name, country, label_fields, tree_fields, table_fields, global_lineage=global_lineage, uk_lineage=uk_lineage, phylotype=phylotype)	
-                # else:	
-                new_taxon = taxon(seq_name, country, label_fields, tree_fields, table_fields)
+        # if virus == "sars-cov-2":	
+        #     uk_lineage = sequence["uk_lineage"]	
+        #     global_lineage = sequence["lineage"]	
+        #     phylotype = sequence["phylotype"]	
 
-                if date == "":
-                    date = "NA"
-                
-                new_taxon.sample_date = date
-                new_taxon.node_summary = node_summary_trait
-                new_taxon.epiweek = Week.fromdate(convert_date(date))
+        if node_summary_option == "adm2":
+            if country != "UK":
+                node_summary_trait = country 
+            else:
+                node_summary_trait = sequence[index["adm2"]] 
+        else:
+            node_summary_trait = sequence[index[node_summary_option]]
 
-                if new_taxon.name in protected_sequences:
-                    new_taxon.protected = True
+        return tax_object, seq_name, date, country, adm2, location_label, node_summary_trait, sequence
 
-                if seq_name in tip_to_tree.keys():
-                    new_taxon.tree = tip_to_tree[seq_name]
+    def new_background_taxon(seq_name, date, country, adm2, location_label, node_summary_trait, sequence):
+            
+        # if virus == "sars-cov-2":	
+        #     new_taxon = taxon(seq_name, country, label_fields, tree_fields, table_fields, global_lineage=global_lineage, uk_lineage=uk_lineage, phylotype=phylotype)	
+        # else:	
+        new_taxon = taxon(seq_name, country, label_fields, tree_fields, table_fields)
 
-                new_taxon.attribute_dict["adm2"] = adm2
-                new_taxon.attribute_dict["location_label"] = location_label
+        if date == "":
+            date = "NA"
+        
+        new_taxon.sample_date = shared_value(date) #dates and summary traits repeat across rows, so keep one copy of each
+        new_taxon.node_summary = shared_value(node_summary_trait)
+        if date != "NA":
+            new_taxon.epiweek = date_functions.epiweek(date)
 
-                new_taxon.input_display_name = seq_name
+        if new_taxon.name in protected_sequences:
+            new_taxon.protected = True
 
-                for field in label_fields:
-                    if field in col_names:
-                        if sequence[field] != "NA" and sequence[field] != "": #this means it's not in the input file
-                            new_taxon.attribute_dict[field] = sequence[field]
+        if seq_name in tip_to_tree.keys():
+            new_taxon.tree = tip_to_tree[seq_name]
 
-                if context_table_summary_field and context_table_summary_field in col_names:
-                    if sequence[context_table_summary_field] != "":
-                        new_taxon.attribute_dict["context_table_summary_field"] = sequence[context_table_summary_field]
+        attributes = new_taxon.attribute_dict
+        attributes["adm2"] = adm2
+        attributes["location_label"] = location_label
 
-                for field in table_fields:
-                    if field in col_names:
-                        if sequence[field] != "NA" and sequence[field] != "":
-                            new_taxon.table_dict[field] = sequence[field]
+        new_taxon.input_display_name = seq_name
 
-                full_tax_dict[seq_name] = new_taxon
+        return fill_taxon_fields(new_taxon, sequence)
 
-            
+    def fill_query(tax_object, date, country, adm2, location_label, sequence):
+        #There may be sequences not in COG tree but that are in the full metadata, so we want to pull out the additional information if it's not in the input csv
+        attributes = tax_object.attribute_dict
 
-            #There may be sequences not in COG tree but that are in the full metadata, so we want to pull out the additional information if it's not in the input csv
-            if seq_name in query_dict.keys(): 
-                tax_object = query_dict[seq_name]
-                if tax_object.sample_date == "NA" and date != "" and date != "NA":
-                    tax_object.sample_date = date
-                    converted = convert_date(date)
-                    tax_object.all_dates.append(converted)
-                    tax_object.epiweek = Week.fromdate(converted)
+        if tax_object.sample_date == "NA" and date != "" and date != "NA":
+            tax_object.sample_date = date
+            converted = convert_date(date)
+            tax_object.all_dates.append(converted)
+            tax_object.epiweek = date_functions.epiweek(date)
 
+        if "adm1" in tree_fields and "adm1" in index:
+            value = sequence[index["adm1"]]
+            if attributes["adm1"] == "NA" and value != "NA" and value != "": #this means it's not in the input file
+                if country == "UK":
+                    attributes["adm1"] = UK_adm1(tax_object.name, value)
+                else:
+                    attributes["adm1"] = "Other"
+
+        # if virus == "sars-cov-2":
+        #     tax_object.global_lineage = global_lineage
+        #     tax_object.uk_lineage = uk_lineage
+        #     tax_object.phylotype = phylotype
+
+        return fill_query_fields(tax_object, sequence + (adm2, location_label))
+
+    def merge(record):
+        #queries keep what they were given and only have gaps filled, other sequences get a new taxon
+        tax_object, seq_name, date, country, adm2, location_label, node_summary_trait, sequence = record
+        if tax_object is not None:
+            return fill_query(tax_object, date, country, adm2, location_label, sequence)
+        return new_background_taxon(seq_name, date, country, adm2, location_label, node_summary_trait, sequence)
+
+    def sink(batch):
+        for tax in batch:
+            full_tax_dict[tax.name] = tax
+
+    #the queries are the hash table and the background metadata is streamed past it once, keeping the rows with no query too
+    stages = [filter_stage(lambda sequence: sequence[name_i] in wanted, "background_filter"),
+            join_stage(query_dict, name_i, unmatched=True, name="background_join"),
+            map_stage(normalise, "background_normalise"),
+            map_stage(merge, "background_merge")]
+    run_pipeline(in_data, stages, sink)
                 
-                if "adm2" not in tax_object.attribute_dict.keys() and adm2 != "":
-                    tax_object.attribute_dict["adm2"] = adm2
-                if "location_label" not in tax_object.attribute_dict.keys() and location_label != "":
-                    tax_object.attribute_dict["location_label"] = location_label
-
-                if context_table_summary_field and context_table_summary_field in col_names:
-                    if sequence[context_table_summary_field] != "" and tax_object.attribute_dict["context_table_summary_field"] == "NA":
-                        tax_object.attribute_dict["context_table_summary_field"] = sequence[context_table_summary_field]
-
-                for field in date_fields:
-                    if field in reader.fieldnames:
-                        if sequence[field] != "" and sequence[field] != "NA" and field not in tax_object.date_dict.keys():
-                            date_dt = convert_date(sequence[field])
-                            tax_object.date_dict[field] = date_dt 
-                    
-
-                for field in tree_fields:
-                    if field in col_names:
-                        if tax_object.attribute_dict[field] == "NA" and sequence[field] != "NA" and sequence[field] != "": #this means it's not in the input file
-                            if field != "adm1":
-                                tax_object.attribute_dict[field] = sequence[field]
-                            else:
-                                if country == "UK":
-                                    adm1 = UK_adm1(tax_object.name,sequence[field])
-                                else:
-                                    adm1 = "Other"
-                                tax_object.attribute_dict[field] = adm1
-
-                for field in label_fields:
-                    if field in col_names:
-                        if tax_object.attribute_dict[field] == "NA" and sequence[field] != "NA" and sequence[field] != "": #this means it's not in the input file
-                                tax_object.attribute_dict[field] = sequence[field]
-
-                for field in table_fields:
-                    if field in col_names:
-                        if tax_object.table_dict[field] == "NA" and sequence[field] != "NA" and sequence[field] != "": #this means it's not in the input file
-                                tax_object.table_dict[field] = sequence[field]
-
-
-                # if virus == "sars-cov-2":
-                #     tax_object.global_lineage = global_lineage
-                #     tax_object.uk_lineage = uk_lineage
-                #     tax_object.phylotype = phylotype
-
-
-                full_tax_dict[seq_name] = tax_object
-                    
     return full_tax_dict, adm2_present_in_background, old_data
 
-def parse_all_metadata(treedir, collapsed_node_file, filtered_background_metadata, background_metadata_file, input_csv, input_column, database_column, database_sample_date_column, display_name, sample_date_column, label_fields, tree_fields, table_fields, node_summary_option, context_table_summary_field, date_fields=None, UK_adm2_adm1_dict=None, reinfection=False, patient_id_col=None, virus="sars-cov-2"):
+def parse_all_metadata(treedir, collapsed_node_file, filtered_background_metadata, background_metadata_file, input_csv, input_column, database_column, database_sample_date_column, display_name, sample_date_column, label_fields, tree_fields, table_fields, node_summary_option, context_table_summary_field, date_fields=None, UK_adm2_adm1_dict=None, reinfection=False, patient_id_col=None, virus="sars-cov-2", threads=1, metadata_store=False, metadata_store_dir=None, offset_index=False, stage_summary_dir=None):
 
-    present_in_tree, tip_to_tree, tree_to_all_tip, inserted_node_dict, protected_sequences = parse_tree_tips(treedir, collapsed_node_file)
+    #each stage is timed, and if stage_summary_dir is given the timings are written there as json
+    with timed_stage("parse_tree_tips") as stage:
+        tip_index = parse_tree_tips(treedir, collapsed_node_file)
+        stage["tips"] = len(tip_index.present_in_tree)
+    tip_to_tree = tip_index.tip_to_tree
     
     #parse the metadata with just those queries found in cog
-    query_dict, query_id_dict, tree_to_tip, closest_sequences = parse_filtered_metadata(filtered_background_metadata, tip_to_tree, label_fields, tree_fields, table_fields, database_sample_date_column) 
+    with timed_stage("parse_filtered_metadata") as stage:
+        query_dict, query_id_dict, tree_to_tip, closest_sequences = parse_filtered_metadata(filtered_background_metadata, tip_to_tree, label_fields, tree_fields, table_fields, database_sample_date_column) 
+        stage["rows"] = len(query_dict)
 
     #Any query information they have provided
-    query_dict, full_query_count = parse_input_csv(input_csv, query_id_dict, input_column, display_name, sample_date_column, tree_fields, label_fields, table_fields, context_table_summary_field, date_fields=date_fields, UK_adm2_dict=UK_adm2_adm1_dict, patient_id_col=patient_id_col, reinfection=reinfection)
+    with timed_stage("parse_input_csv") as stage:
+        query_dict, full_query_count = parse_input_csv(input_csv, query_id_dict, input_column, display_name, sample_date_column, tree_fields, label_fields, table_fields, context_table_summary_field, date_fields=date_fields, UK_adm2_dict=UK_adm2_adm1_dict, patient_id_col=patient_id_col, reinfection=reinfection)
+        stage["rows"] = full_query_count
     
+    store = None
+    if metadata_store: #indexed copy of the background metadata, so only the rows needed are looked up
+        with timed_stage("metadata_store"):
+            store = store_functions.get_store(background_metadata_file, metadata_store_dir, threads)
+
     #parse the full background metadata
-    full_tax_dict, adm2_present_in_background, old_data = parse_background_metadata(query_dict, label_fields, tree_fields, table_fields, background_metadata_file, present_in_tree, closest_sequences, node_summary_option, tip_to_tree, database_column, database_sample_date_column, protected_sequences, context_table_summary_field, date_fields=date_fields, virus=virus)
+    with timed_stage("parse_background_metadata", tips=len(tip_index.present_in_tree)) as stage:
+        full_tax_dict, adm2_present_in_background, old_data = parse_background_metadata(query_dict, label_fields, tree_fields, table_fields, background_metadata_file, tip_index.present_in_tree, closest_sequences, node_summary_option, tip_to_tree, database_column, database_sample_date_column, tip_index.protected_sequences, context_table_summary_field, date_fields=date_fields, virus=virus, threads=threads, store=store, offset_index=offset_index)
+        stage["rows"] = len(full_tax_dict)
+
+    if stage_summary_dir:
+        write_stage_summary(stage_summary_dir)
 
-    return full_tax_dict, query_dict, tree_to_tip, tree_to_all_tip, inserted_node_dict, adm2_present_in_background, full_query_count, old_data 
+    return full_tax_dict, query_dict, tree_to_tip, tip_index.tree_to_all_tip, tip_index.inserted_node_dict, adm2_present_in_background, full_query_count, old_data
+
+def build_taxon_table(full_tax_dict, query_dict):
+    #columns of the taxa parse_all_metadata returns, for the summaries to use instead of looping over the objects
+    with timed_stage("taxon_table", rows=len(full_tax_dict)):
+        return TaxonTable.from_taxa(full_tax_dict, query_dict)
 
 def investigate_QC_fails(QC_file, input_column):
 
@@ -471,7 +534,10 @@ def investigate_missing_sequences(missing_seq_file):
     return missing_list
 
 
-def find_new_introductions(query_dict, min_date): #will only be called for the COG sitrep, and the query dict will already be filtered to the most recent sequences
+def find_new_introductions(query_dict, min_date, taxon_table=None): #will only be called for the COG sitrep, and the query dict will already be filtered to the most recent sequences
+
+    if taxon_table is not None:
+        return new_introductions_from_columns(query_dict, min_date, taxon_table)
 
     lin_to_tax = defaultdict(list)
     intro_to_regions = defaultdict(dict)
@@ -535,6 +601,59 @@ def find_new_introductions(query_dict, min_date): #will only be called for the C
     df.set_index("Name", inplace=True)
 
     return new_intros, df
+
+def distinct_pairs(frame, first, second):
+    pairs = frame[[first, second]].drop_duplicates()
+    return zip(pairs[first].tolist(), pairs[second].tolist())
+
+def new_introductions_from_columns(query_dict, min_date, taxon_table):
+    """
+    Same as find_new_introductions, with the queries grouped by uk_lineage in one pass over the
+    table's columns. lineage objects are only made for the new lineages.
+    """
+    taxa = taxon_table.rows(query_dict).reset_index()
+
+    #lineages in the order they first turn up in the queries, as they were added to the dict before
+    first_dates = taxa.groupby("uk_lineage", sort=False, observed=True)["date"].min()
+    new_lineages = first_dates[first_dates.notna() & (first_dates > taxon_table.day_number(min_date))].index
+
+    new_taxa = taxa[taxa["uk_lineage"].isin(new_lineages)]
+
+    #one pass over just the new lineages' rows, keeping the order things first turn up in
+    names = defaultdict(list)
+    dates = defaultdict(list)
+    for lin, name, date in zip(new_taxa["uk_lineage"].tolist(), new_taxa["name"].tolist(), taxon_table.to_dates(new_taxa["date"])):
+        names[lin].append(name)
+        if date is not None:
+            dates[lin].append(date)
+
+    global_lineages = defaultdict(list)
+    for lin, global_lin in distinct_pairs(new_taxa, "uk_lineage", "global_lineage"):
+        global_lineages[lin].append(global_lin)
+    trees = defaultdict(list)
+    for lin, tree in distinct_pairs(new_taxa, "uk_lineage", "tree"):
+        trees[lin].append(tree)
+
+    place_counts = defaultdict(str)
+    with_adm2 = new_taxa[new_taxa["adm2"] != ""]
+    for (lin, place), count in with_adm2.groupby(["uk_lineage", "adm2"], sort=False, observed=True).size().items():
+        place_counts[lin] += place + " (" + str(count) + ") "
+
+    new_intros = []
+    df_dict = defaultdict(list)
+    for lin, lin_names in names.items():
+        new_intros.append(lineage(lin, [query_dict[name] for name in lin_names], dates=dates[lin], global_lins=set(global_lineages[lin])))
+
+        df_dict["Name"].append(lin)
+        df_dict["Size"].append(len(lin_names))
+        df_dict["Locations"].append(place_counts[lin])
+        df_dict["Global lineage"].append(", ".join(global_lineages[lin]))
+        df_dict["Trees"].append(", ".join(trees[lin]))
+
+    df = pd.DataFrame(df_dict, columns=["Name", "Size", "Locations", "Global lineage", "Trees"])
+    df.set_index("Name", inplace=True)
+
+    return new_intros, df
                 
 
 
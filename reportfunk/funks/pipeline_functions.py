@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+from itertools import islice
+
+from reportfunk.funks.stage_functions import timed_stage
+
+BATCH_SIZE = 5000 #rows handed from one stage to the next at a time
+
+def row_batches(rows, batch_size=BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def stage_batches(batches, step, name):
+    #applies step to each batch. Named stages are timed (just the step, not the stages before it) under their name
+    for batch in batches:
+        if name:
+            with timed_stage(name, rows=len(batch)):
+                batch = step(batch)
+        else:
+            batch = step(batch)
+        if batch:
+            yield batch
+
+def filter_stage(keep, name=None):
+    #drops the rows keep is False for
+    def stage(batches):
+        return stage_batches(batches, lambda batch: [row for row in batch if keep(row)], name)
+    return stage
+
+def map_stage(transform, name=None):
+    #replaces each row with transform(row)
+    def stage(batches):
+        return stage_batches(batches, lambda batch: [transform(row) for row in batch], name)
+    return stage
+
+def batch_stage(step, name=None):
+    #step takes a whole batch and returns the batch to pass on, for stages that work row by row in order with state of their own
+    def stage(batches):
+        return stage_batches(batches, step, name)
+    return stage
+
+def pipeline(rows, stages, batch_size=BATCH_SIZE):
+    """
+    Chains the stages over rows, returning a generator of the batches that come out of the last one.
+    Each stage is a function from a generator of batches to a generator of batches, so nothing is
+    read or worked out until the batches are asked for, and only a batch at a time is held.
+    """
+    batches = row_batches(rows, batch_size)
+    for stage in stages:
+        batches = stage(batches)
+    return batches
+
+def run_pipeline(rows, stages, sink, batch_size=BATCH_SIZE):
+    #streams rows through the stages, handing each batch that comes out to sink
+    for batch in pipeline(rows, stages, batch_size):
+        sink(batch)
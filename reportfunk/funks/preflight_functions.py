@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import reportfunk.funks.metadata_functions as metadata_functions
+from reportfunk.funks.pipeline_functions import row_batches
+
+class Preflight():
+    """
+    Checks on one input csv, registered up front so they can all be run in a single pass over its rows.
+    Each check is on a column, and is called as check(first_row, values) with the column's values
+    for each batch of rows, first_row being the row number of the first of them. If a required
+    column isn't in the header that's a problem, otherwise checks on missing columns are just skipped.
+    Problems are collected rather than stopping at the first one, and what the checks find out about
+    the file can be put in summary for later stages to use.
+    """
+    def __init__(self, label):
+        self.label = label
+        self.checks = []
+        self.problems = []
+        self.summary = {}
+
+    def add_check(self, column, check=None, required=False, missing=None):
+        #missing is the problem to report if a required column isn't there
+        self.checks.append((column, check, required, missing))
+
+    def problem(self, message):
+        self.problems.append(message)
+
+    def columns(self):
+        return [column for column, check, required, missing in self.checks]
+
+    def check_header(self, header):
+        #reports required columns that aren't in header, returning the checks that can be run
+        self.summary["header"] = header
+        running = []
+        for column, check, required, missing in self.checks:
+            if column not in header:
+                if required:
+                    self.problem(missing if missing else f"{column} column not in {self.label}")
+            elif check:
+                running.append((column, check))
+        return running
+
+    def run(self, header, index, rows, first_row=1):
+        #rows are tuples of the columns in index, as metadata_functions.projected_reader gives them
+        running = [(index[column], check) for column, check in self.check_header(header)]
+
+        row_count = 0
+        for batch in row_batches(rows):
+            if running:
+                columns = list(zip(*batch))
+                for position, check in running:
+                    check(first_row + row_count, columns[position])
+            row_count += len(batch)
+
+        self.summary["rows"] = row_count
+        return self.summary
+
+    def run_file(self, csv_file):
+        header, index, rows = metadata_functions.projected_reader(csv_file, self.columns())
+        return self.run(header, index, rows)
+
+    def run_distinct(self, header, distinct_values, value_rows=None):
+        """
+        For when each distinct value of a column can be checked once rather than on every row, e.g.
+        from a metadata store. distinct_values(column) gives (value, first row it's on) pairs. Problems
+        are reported at the first row of each value that has them, or with value_rows(column, values)
+        giving (value, row number) pairs in row order, at every row it's on.
+        """
+        for column, check in self.check_header(header):
+            failing = []
+            for value, row_number in distinct_values(column):
+                problem_count = len(self.problems)
+                check(row_number, (value,))
+                if value_rows and value is not None and len(self.problems) > problem_count: #rows missing the column can't be looked up by value
+                    failing.append(value)
+                    del self.problems[problem_count:]
+
+            if failing:
+                for value, row_number in value_rows(column, failing):
+                    check(row_number, (value,))
+        return self.summary
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: #not available on windows
+    resource = None
+
+stage_stats = {} #stage -> totals over every time it's been run, in the order stages first ran
+traced_stages = [] #peak traced memory of each stage that's running, innermost last
+figure_stats = defaultdict(dict) #stage -> figures made, peak open figures and peak memory, kept by figure_functions.record_figure
+
+def peak_resident_memory_mb():
+    #highest resident set size the process has reached so far, None where we can't tell
+    if not resource:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin": #bytes on mac, kilobytes on linux
+        peak = peak/1024
+    return round(peak/1024, 1)
+
+def resident_memory_mb():
+    #current resident set size from /proc where we have it, otherwise the process peak
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return round(pages*os.sysconf("SC_PAGE_SIZE")/(1024*1024), 1)
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    peak = peak_resident_memory_mb()
+    return peak if peak is not None else 0.0
+
+def add_figure_stats(stage, stats):
+    #merges in stats recorded somewhere else, e.g. in a worker process drawing figures
+    totals = figure_stats[stage]
+    totals["figures"] = totals.get("figures", 0) + stats.get("figures", 0)
+    for peak in ["peak_open_figures", "peak_memory_mb"]:
+        totals[peak] = max(totals.get(peak, 0), stats.get(peak, 0))
+
+def child_cpu_seconds():
+    #cpu time of worker processes that have finished, e.g. the metadata reading pool
+    if not resource:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def start_traced_stage():
+    current, peak = tracemalloc.get_traced_memory()
+    if traced_stages:
+        traced_stages[-1] = max(traced_stages[-1], peak)
+    if hasattr(tracemalloc, "reset_peak"): #python 3.9+. Before that the peak is the highest since tracing started, so only an upper bound
+        tracemalloc.reset_peak()
+    traced_stages.append(current)
+    return current
+
+def end_traced_stage(start):
+    current, peak = tracemalloc.get_traced_memory()
+    stage_peak = max(traced_stages.pop(), peak)
+    if traced_stages: #so the stage this one ran inside still sees its peak
+        traced_stages[-1] = max(traced_stages[-1], stage_peak)
+    return current - start, stage_peak - start
+
+def add_stage_run(stage, counts, run):
+
+    stats = stage_stats[stage]
+    stats["runs"] += 1
+
+    for count, value in counts.items():
+        if value is not None:
+            stats[count] = stats.get(count, 0) + value
+
+    for measure in ["wall_seconds", "cpu_seconds", "child_cpu_seconds", "traced_change_mb"]:
+        if measure in run:
+            stats[measure] = round(stats.get(measure, 0.0) + run[measure], 3)
+
+    for measure in ["peak_memory_mb", "peak_rss_increase_mb", "traced_peak_mb"]:
+        if run.get(measure) is not None:
+            stats[measure] = max(stats.get(measure, 0.0), run[measure])
+
+@contextmanager
+def timed_stage(stage, rows=None, tips=None):
+    """
+    Times the code inside it, adding wall and cpu time, rows and tips to the totals for stage.
+    Yields a dict of the counts, so ones only known at the end can be filled in then.
+    Memory is recorded as the resident peak and how far the stage pushed it up, and, if
+    tracemalloc is tracing (e.g. PYTHONTRACEMALLOC=1), the peak and change in traced memory.
+    """
+    counts = {"rows": rows, "tips": tips}
+    stage_stats.setdefault(stage, {"runs": 0})
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        traced_start = start_traced_stage()
+
+    peak_before = peak_resident_memory_mb()
+    child_cpu_before = child_cpu_seconds()
+    cpu_before = time.process_time()
+    wall_before = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        run = {"wall_seconds": time.perf_counter() - wall_before,
+                "cpu_seconds": time.process_time() - cpu_before,
+                "child_cpu_seconds": child_cpu_seconds() - child_cpu_before,
+                "peak_memory_mb": resident_memory_mb()}
+
+        peak_after = peak_resident_memory_mb()
+        if peak_after is not None:
+            run["peak_memory_mb"] = max(run["peak_memory_mb"], peak_after)
+            run["peak_rss_increase_mb"] = round(peak_after - peak_before, 1)
+
+        if tracing:
+            change, peak = end_traced_stage(traced_start)
+            run["traced_change_mb"] = change/(1024*1024)
+            run["traced_peak_mb"] = round(peak/(1024*1024), 1)
+
+        add_stage_run(stage, counts, run)
+
+def stage_summary(figures=True):
+    summary = {"stages": {stage:dict(stats) for stage,stats in stage_stats.items() if stats["runs"]}} #stages still running have nothing to show yet
+    if figures:
+        summary["figures"] = {stage:dict(stats) for stage,stats in figure_stats.items()}
+    return summary
+
+def write_stage_summary(outdir, filename="stage_summary.json", figures=True):
+    outfile = os.path.join(outdir, filename)
+    with open(outfile, "w") as fw:
+        json.dump(stage_summary(figures), fw, indent=4)
+    return outfile
+
+def stage_report(outfile=None, figures=True):
+
+    summary = stage_summary(figures)
+
+    for stage, stats in summary["stages"].items():
+        counts = "".join(f", {stats[count]} {count}" for count in ["rows", "tips"] if count in stats)
+        print(f"{stage}: {stats['runs']} runs{counts}, {stats['wall_seconds']}s wall, {stats['cpu_seconds']}s cpu, peak memory {stats['peak_memory_mb']} MB")
+
+    if outfile:
+        with open(outfile, "w") as fw:
+            json.dump(summary, fw, indent=4)
+
+    return summary
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+import os
+import io
+import json
+import hashlib
+import sqlite3
+
+import reportfunk.funks.metadata_functions as metadata_functions
+
+STORE_VERSION = "2"
+
+open_stores = {} #(metadata file, size, mtime, store dir, incremental) -> MetadataStore, so each process only checks a store once
+
+def default_store_dir():
+    cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser(os.path.join("~", ".cache")))
+    return os.path.join(cache_dir, "reportfunk")
+
+def update_hash(sha1, f, size=None):
+    #feeds the next size bytes of f (or the rest of it) into sha1, returning how many there were
+    read = 0
+    while size is None or read < size:
+        block = f.read(1024*1024 if size is None else min(1024*1024, size - read))
+        if not block:
+            break
+        sha1.update(block)
+        read += len(block)
+    return read
+
+def file_hash(metadata_file):
+    sha1 = hashlib.sha1()
+    with open(metadata_file, "rb") as f:
+        update_hash(sha1, f)
+    return sha1.hexdigest()
+
+def store_path(metadata_file, store_dir):
+    #one store per metadata path, which gets rebuilt when the file behind that path changes
+    path_key = hashlib.sha1(os.path.abspath(metadata_file).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(store_dir, f"{os.path.basename(metadata_file)}.{path_key}.sqlite")
+
+def py_upper(value):
+    #sqlite's own upper() only folds ascii, this is str.upper so matches agree with the csv path
+    return value.upper() if value is not None else None
+
+def connect(store_file, **kwargs):
+    #the indexes on upper cased columns use py_upper, so any connection writing to the store needs it
+    con = sqlite3.connect(store_file, **kwargs)
+    con.create_function("py_upper", 1, py_upper, deterministic=True)
+    return con
+
+def read_store_info(store_file):
+    try:
+        con = sqlite3.connect(f"file:{store_file}?mode=ro", uri=True)
+        try:
+            info = dict(con.execute("SELECT key, value FROM info"))
+        finally:
+            con.close()
+    except sqlite3.Error:
+        return None
+    return info
+
+def store_is_current(store_file, metadata_file, info=None):
+    #size and mtime are enough to trust it, if the mtime has moved the contents are hashed before rebuilding
+    if info is None:
+        info = read_store_info(store_file)
+    if not info or info.get("version") != STORE_VERSION:
+        return False
+
+    stat = os.stat(metadata_file)
+    if int(info["size"]) != stat.st_size:
+        return False
+    if int(info["mtime_ns"]) == stat.st_mtime_ns:
+        return True
+
+    if info["sha1"] != file_hash(metadata_file):
+        return False
+
+    con = sqlite3.connect(store_file)
+    with con:
+        con.execute("UPDATE info SET value = ? WHERE key = 'mtime_ns'", (str(stat.st_mtime_ns),))
+    con.close()
+    return True
+
+def insert_rows(con, header, index, rows, first_row):
+    #adds projected rows to the metadata table, numbered on from first_row. Returns how many there were
+
+    #duplicated column names are only projected once, so fill the store columns back out from the header
+    order = [index[column] for column in header]
+    if order != list(range(len(header))):
+        rows = (tuple(row[i] for i in order) for row in rows)
+
+    count = 0
+    def numbered():
+        nonlocal count
+        for count, row in enumerate(rows, 1):
+            yield (first_row + count - 1,) + row
+
+    placeholders = ", ".join("?" for i in range(len(header) + 1))
+    con.executemany(f"INSERT INTO metadata VALUES ({placeholders})", numbered())
+    return count
+
+def build_store(metadata_file, store_file, threads=1):
+    """
+    Copies every row of a metadata csv into an sqlite table, with columns c0, c1... in header order
+    and the row number (counting from 1, as the csv checks do) as the key. Written to a temporary
+    file first, so a half built store is never picked up by another process.
+    """
+    stat = os.stat(metadata_file)
+    header = metadata_functions.read_header(metadata_file)
+    sql_columns = [f"c{position}" for position in range(len(header))]
+
+    tmp_file = f"{store_file}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    con = sqlite3.connect(tmp_file)
+    con.execute("PRAGMA journal_mode = OFF")
+    con.execute("PRAGMA synchronous = OFF")
+
+    column_defs = ", ".join(f"{column} TEXT" for column in sql_columns)
+    con.execute(f"CREATE TABLE metadata (row_number INTEGER PRIMARY KEY, {column_defs})")
+    con.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+
+    header, index, rows = metadata_functions.projected_reader(metadata_file, list(dict.fromkeys(header)), threads=threads)
+    positions = metadata_functions.column_positions(header)
+
+    with con:
+        row_count = insert_rows(con, header, index, rows, 1)
+
+        info = {"version": STORE_VERSION,
+                "source": os.path.abspath(metadata_file),
+                "size": str(stat.st_size),
+                "mtime_ns": str(stat.st_mtime_ns),
+                "sha1": file_hash(metadata_file),
+                "rows": str(row_count),
+                "header": json.dumps(header),
+                "positions": json.dumps(positions)}
+        con.executemany("INSERT INTO info VALUES (?, ?)", info.items())
+
+    con.close()
+    os.replace(tmp_file, store_file)
+
+def append_to_store(metadata_file, store_file, info):
+    """
+    Brings a store up to date with a metadata csv that has only had rows added to the end since it
+    was built, parsing just the new rows. The old contents are checked byte for byte against the
+    checksum of what was ingested last time. Returns False, having changed nothing, if the csv
+    isn't the old one with rows on the end, so it can be rebuilt instead.
+    """
+    if not info or info.get("version") != STORE_VERSION:
+        return False
+
+    stat = os.stat(metadata_file)
+    old_size = int(info["size"])
+    if stat.st_size <= old_size:
+        return False
+
+    sha1 = hashlib.sha1()
+    with open(metadata_file, "rb") as f:
+        if update_hash(sha1, f, old_size) != old_size or sha1.hexdigest() != info["sha1"]:
+            return False
+
+        f.seek(old_size - 1)
+        if f.read(1) != b"\n": #the last row ingested could carry on into the new bytes
+            return False
+
+        update_hash(sha1, f)
+
+        header = json.loads(info["header"])
+        projected = sorted(json.loads(info["positions"]).values())
+        index = {header[position]:i for i, position in enumerate(projected)}
+
+        f.seek(old_size)
+        text = io.TextIOWrapper(f, encoding="utf-8", newline="")
+        rows = metadata_functions.projected_rows(text, header, projected)
+
+        con = connect(store_file, isolation_level=None)
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            current = dict(con.execute("SELECT key, value FROM info"))
+            if current["size"] != info["size"] or current["sha1"] != info["sha1"]: #another process got here first
+                con.execute("ROLLBACK")
+                return store_is_current(store_file, metadata_file)
+
+            row_count = int(current["rows"])
+            row_count += insert_rows(con, header, index, rows, row_count + 1)
+
+            updates = {"size": str(stat.st_size), "mtime_ns": str(stat.st_mtime_ns), "sha1": sha1.hexdigest(), "rows": str(row_count)}
+            con.executemany("UPDATE info SET value = ? WHERE key = ?", ((value, key) for key, value in updates.items()))
+            con.execute("COMMIT")
+        except BaseException:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+
+    return True
+
+class MetadataStore():
+    """
+    Indexed copy of a background metadata csv. Columns are indexed the first time they're searched
+    on and the indexes are kept in the store, so later runs don't have to build them again.
+    """
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.con = connect(store_file)
+
+        info = dict(self.con.execute("SELECT key, value FROM info"))
+        self.header = json.loads(info["header"])
+        self.positions = json.loads(info["positions"])
+
+    def __contains__(self, column):
+        return column in self.positions
+
+    def sql_column(self, column):
+        return f"c{self.positions[column]}"
+
+    def index_column(self, column, upper=False):
+        sql_column = self.sql_column(column)
+        if upper:
+            name, expression = f"py_upper_{sql_column}_index", f"py_upper({sql_column})"
+        else:
+            name, expression = f"{sql_column}_index", sql_column
+
+        with self.con:
+            self.con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON metadata ({expression})")
+        return sql_column
+
+    def load_names(self, names):
+        #names go into a temp table, which can be joined on however many there are
+        with self.con:
+            self.con.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (name TEXT PRIMARY KEY)")
+            self.con.execute("DELETE FROM wanted")
+            self.con.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((name,) for name in names))
+
+    def names_present(self, name_column, names):
+        name_sql = self.index_column(name_column)
+        self.load_names(names)
+        return {name for (name,) in self.con.execute(f"SELECT DISTINCT {name_sql} FROM metadata WHERE {name_sql} IN (SELECT name FROM wanted)")}
+
+    def projected_reader(self, columns, name_column=None, keep=None):
+        """
+        Same as metadata_functions.projected_reader, but rows are looked up by name in the store
+        rather than read through. Without keep, every row comes back.
+        """
+        projected = sorted({self.positions[column] for column in columns if column in self.positions})
+        index = {self.header[position]:i for i, position in enumerate(projected)}
+        selected = ", ".join(f"c{position}" for position in projected) or "NULL"
+
+        if keep is None:
+            cursor = self.con.execute(f"SELECT {selected} FROM metadata ORDER BY row_number")
+        else:
+            name_sql = self.index_column(name_column)
+            self.load_names(keep)
+            cursor = self.con.execute(f"SELECT {selected} FROM metadata WHERE {name_sql} IN (SELECT name FROM wanted) ORDER BY row_number")
+
+        if not projected:
+            cursor = (() for row in cursor)
+
+        return self.header, index, cursor
+
+    def distinct_values(self, column):
+        #each value in a column, with the first row it's on, in the order they first turn up
+        sql_column = self.index_column(column)
+        return self.con.execute(f"SELECT {sql_column}, MIN(row_number) AS first_row FROM metadata GROUP BY {sql_column} ORDER BY first_row")
+
+    def value_rows(self, column, values):
+        #(value, row number) of each row where column is one of values, in row order
+        sql_column = self.index_column(column)
+        self.load_names(values)
+        return self.con.execute(f"SELECT {sql_column}, row_number FROM metadata WHERE {sql_column} IN (SELECT name FROM wanted) ORDER BY row_number")
+
+    def last_combinations(self, columns, where_column, where_value):
+        #each combination of values for columns in rows where where_column == where_value, ordered by the last row it's on
+        selected = ", ".join(self.sql_column(column) for column in columns)
+        where_sql = self.index_column(where_column)
+        return self.con.execute(f"SELECT {selected}, MAX(row_number) AS last_row FROM metadata WHERE {where_sql} = ? GROUP BY {selected} ORDER BY last_row", (where_value,))
+
+    def numbered_rows(self, cursor):
+        for row in cursor:
+            yield row[1:], row[0]
+
+    def rows_matching(self, column, value):
+        #rows where the upper cased column matches value, streamed as (fields in header order, row number)
+        sql_column = self.index_column(column, upper=True)
+        cursor = self.con.execute(f"SELECT * FROM metadata WHERE py_upper({sql_column}) = ? ORDER BY row_number", (value,))
+        return self.numbered_rows(cursor)
+
+    def rows_in(self, column, values):
+        sql_column = self.index_column(column)
+        self.load_names(values)
+        cursor = self.con.execute(f"SELECT * FROM metadata WHERE {sql_column} IN (SELECT name FROM wanted) ORDER BY row_number")
+        return self.numbered_rows(cursor)
+
+def get_store(metadata_file, store_dir=None, threads=1, incremental=True):
+    """
+    Opens the store for a metadata csv, building it first if there isn't one or the csv has changed.
+    With incremental, a csv that has only had rows added since the store was made just has those
+    rows added to it, rather than the whole store being rebuilt.
+    """
+    if not store_dir:
+        store_dir = default_store_dir()
+
+    stat = os.stat(metadata_file)
+    key = (os.path.abspath(metadata_file), stat.st_size, stat.st_mtime_ns, os.path.abspath(store_dir), incremental)
+    if key in open_stores:
+        return open_stores[key]
+
+    os.makedirs(store_dir, exist_ok=True)
+
+    store_file = store_path(metadata_file, store_dir)
+    info = read_store_info(store_file)
+    if not store_is_current(store_file, metadata_file, info):
+        if not (incremental and append_to_store(metadata_file, store_file, info)):
+            build_store(metadata_file, store_file, threads=threads)
+
+    store = MetadataStore(store_file)
+    open_stores[key] = store
+    return store
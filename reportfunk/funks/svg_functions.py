@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import math
+from collections import defaultdict
+from xml.sax.saxutils import escape
+
+from matplotlib.colors import to_hex
+
+POINTS_PER_INCH = 72
+MARGIN = 15 #points of white space around the plot, in place of tight_layout
+
+anchors = {"left":"start", "center":"middle", "right":"end"}
+baselines = {"center":"central", "bottom":"text-after-edge", "top":"text-before-edge", "baseline":"auto"}
+weights = {"ultralight":200, "light":300, "normal":400, "bold":700}
+dashes = {"-":None, "--":(3.7,1.6), ":":(1,1.65), "-.":(6.4,1.6,1,1.6)} #matplotlib's dash patterns, scaled by line width
+
+def hex_colour(colour):
+    return to_hex(colour, keep_alpha=False)
+
+def text_height(text, text_kwargs):
+    #rough extent of rotated labels, which sit above the top of the axes
+    if text_kwargs.get("rotation", 0) == 90:
+        return len(str(text))*text_kwargs.get("size", 12)*0.6
+    return 0
+
+def path_string(segments, sx, sy):
+    return " ".join(f"M{sx(x0):.2f} {sy(y0):.2f}L{sx(x1):.2f} {sy(y1):.2f}" for (x0,y0),(x1,y1) in segments)
+
+def write_tree_svg(layout, savefile):
+    """
+    Writes a catchment tree layout (see tree_functions.scaled_tree_layout) straight to svg elements,
+    skipping matplotlib's font layout, transforms and glyph paths.
+    """
+    plot_width = layout["figsize"][0]*POINTS_PER_INCH
+    width = plot_width + 2*MARGIN
+    plot_height = layout["figsize"][1]*POINTS_PER_INCH
+
+    top_space = max([text_height(text, text_kwargs) for x, y, text, text_kwargs in layout["texts"]] + [0]) + MARGIN
+    height = plot_height + top_space + MARGIN
+
+    x_min, x_max = layout["xlim"]
+    y_min, y_max = layout["ylim"]
+
+    sx = lambda x: MARGIN + (x - x_min)/(x_max - x_min)*plot_width
+    sy = lambda y: top_space + (y_max - y)/(y_max - y_min)*plot_height
+
+    elements = [] # (zorder, svg element), drawn in zorder like matplotlib does
+
+    branch_groups = defaultdict(list)
+    for start, end, colour, branch_width in layout["branches"]:
+        branch_groups[(hex_colour(colour), branch_width)].append((start, end))
+    for (colour, branch_width), segments in branch_groups.items():
+        elements.append((1, f'<path d="{path_string(segments, sx, sy)}" stroke="{colour}" stroke-width="{branch_width}" stroke-linecap="square" fill="none"/>'))
+
+    for x, y, size, colour, zorder, marker, edged in layout["points"]:
+        if size <= 0:
+            continue
+        side = math.sqrt(size) #marker sizes are areas in points^2, as in scatter
+        if edged:
+            side += 1 #scatter's default edge line width
+        if marker == "s":
+            elements.append((zorder, f'<rect x="{sx(x)-side/2:.2f}" y="{sy(y)-side/2:.2f}" width="{side:.2f}" height="{side:.2f}" fill="{hex_colour(colour)}"/>'))
+        else:
+            elements.append((zorder, f'<circle cx="{sx(x):.2f}" cy="{sy(y):.2f}" r="{side/2:.2f}" fill="{hex_colour(colour)}"/>'))
+
+    line_groups = defaultdict(list)
+    for xs, ys, colour, line_width, linestyle in layout["lines"]:
+        line_groups[(hex_colour(colour), line_width, linestyle)].append(((xs[0],ys[0]),(xs[1],ys[1])))
+    for (colour, line_width, linestyle), segments in line_groups.items():
+        dash = ""
+        if dashes.get(linestyle):
+            dash = ' stroke-dasharray="' + ",".join(str(round(i*line_width, 2)) for i in dashes[linestyle]) + '"'
+        elements.append((2, f'<path d="{path_string(segments, sx, sy)}" stroke="{colour}" stroke-width="{line_width}"{dash} fill="none"/>'))
+
+    for x, y, text, text_kwargs in layout["texts"]:
+        anchor = anchors[text_kwargs.get("ha", "left")]
+        baseline = baselines[text_kwargs.get("va", "baseline")]
+        weight = weights.get(text_kwargs.get("fontweight", "normal"), 400)
+        size = text_kwargs.get("size", 12)
+        px, py = sx(x), sy(y)
+
+        if text_kwargs.get("rotation", 0) == 90: #reads upwards from the anchor, centred on it
+            attributes = f'x="{px:.2f}" y="{py:.2f}" transform="rotate(-90 {px:.2f} {py:.2f})" text-anchor="start" dominant-baseline="central"'
+        else:
+            attributes = f'x="{px:.2f}" y="{py:.2f}" text-anchor="{anchor}" dominant-baseline="{baseline}"'
+
+        elements.append((3, f'<text {attributes} font-size="{size}" font-weight="{weight}">{escape(str(text))}</text>'))
+
+    elements.sort(key=lambda element: element[0])
+
+    with open(savefile, "w") as fw:
+        fw.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}pt" height="{height:.0f}pt" viewBox="0 0 {width:.2f} {height:.2f}" font-family="DejaVu Sans, Arial, Helvetica, sans-serif">\n')
+        fw.write('<rect width="100%" height="100%" fill="white"/>\n')
+        for zorder, element in elements:
+            fw.write(element + "\n")
+        fw.write("</svg>\n")
@@ -68,7 +68,7 @@ def make_custom_table(query_dict, taxa_dict, table_fields, remove_snp_table):
     elif incogs and not seqprovideds:
         return df_indb
 
-def context_table(query_dict, taxa_dict, summarise_by):
+def context_table(query_dict, taxa_dict, summarise_by, taxon_table=None):
 
     df_dict = defaultdict(list)
     values = []
@@ -93,6 +93,9 @@ def context_table(query_dict, taxa_dict, summarise_by):
     summary = defaultdict(list)
     summary_dates = defaultdict(list)
 
+    if taxon_table is not None:
+        return context_table_from_columns(value_count, taxon_table, summarise_by), closest_values, no_values
+
     for value, count in value_count.items():
         for taxon in taxa_dict.values():
             if taxon.attribute_dict["context_table_summary_field"] == value and taxon.country == "UK":
@@ -117,6 +120,35 @@ def context_table(query_dict, taxa_dict, summarise_by):
 
     return df, closest_values, no_values
 
+def context_table_from_columns(value_count, taxon_table, summarise_by):
+    #the UK taxa with each value are counted and dated in one group by, rather than a pass over every taxon per value
+
+    frame = taxon_table.frame
+    uk = frame[(frame["country"] == "UK") & frame["context_table_summary_field"].isin(list(value_count))]
+    grouped = uk.groupby("context_table_summary_field", observed=True)
+    totals = grouped.size()
+    min_dates = grouped["date"].min()
+    max_dates = grouped["date"].max()
+
+    df_dict = defaultdict(list)
+    for value in value_count:
+        if value not in totals.index:
+            continue
+        if pd.isna(min_dates[value]):
+            date_range = "NA"
+        else:
+            date_range = f"{taxon_table.date_string(min_dates[value])} to {taxon_table.date_string(max_dates[value])}"
+
+        df_dict[summarise_by].append(value)
+        df_dict["Date range"].append(date_range)
+        df_dict["Number in dataset"].append(value_count[value])
+        df_dict["Total in COG"].append(int(totals[value]))
+
+    df = pd.DataFrame(df_dict)
+    df.set_index(summarise_by, inplace=True)
+
+    return df
+
 
 
 
@@ -1,9 +1,15 @@
 import datetime as dt 
 import matplotlib.pyplot as plt
 from matplotlib import cm
+from matplotlib.collections import LineCollection
+import matplotlib.dates as mdates
 import numpy as np
 import matplotlib.ticker as plticker
 import math
+from collections import defaultdict
+
+from reportfunk.funks.figure_functions import managed_figure
+from reportfunk.funks.stage_functions import write_stage_summary
 
 try:
     import civetfunks as cfunks
@@ -68,33 +74,18 @@ def find_colour_dict(date_fields):
 
     return colour_dict
 
-def plot_time_series(tips, query_dict, overall_max_date, overall_min_date, date_fields, custom_tip_fields, tree_name, figdir, safety_level=None):
-
-    colour_dict = find_colour_dict(date_fields)    
-
-    time_len = (overall_max_date - overall_min_date).days
-
-    height = math.sqrt(len(tips))*2 + 1
+def collect_time_series(tips, query_dict, custom_tip_fields, safety_level=None):
+    #groups every date to be plotted by its date type, so each type can be drawn in one go
 
-    if time_len > 20:
-        tick_loc_base = float(math.ceil(time_len/5))
-    else:
-        tick_loc_base = 1.0
-
-    loc = plticker.MultipleLocator(base=tick_loc_base) #Sets a tick on each integer multiple of a base within the view interval
+    queries = set(query_dict.values())
 
-    fig, ax1 = plt.subplots(1,1, figsize=(20,height))
-    ax2 = ax1.twinx()
-    
-    if time_len > 10:
-        offset = dt.timedelta(time_len/10)
-    else:
-        offset = dt.timedelta(time_len/3)
+    date_points = defaultdict(lambda: ([], [])) #date type: (dates, rows)
+    spans = [] #(first date, last date, row)
+    labels = []
 
     count = 1
-
     for tax in tips:
-        if tax.date_dict != {} and tax in query_dict.values():
+        if tax.date_dict != {} and tax in queries:
         
             first_date_type = min(tax.date_dict.keys(), key=lambda k: tax.date_dict[k])
             last_date_type = max(tax.date_dict.keys(), key=lambda k: tax.date_dict[k])
@@ -102,61 +93,120 @@ def plot_time_series(tips, query_dict, overall_max_date, overall_min_date, date_
             first_date = tax.date_dict[first_date_type]
             last_date = tax.date_dict[last_date_type]
 
-            other_dates = {}
+            for date_type, date in [(first_date_type, first_date), (last_date_type, last_date)]:
+                date_points[date_type][0].append(date)
+                date_points[date_type][1].append(count)
+
             for date_type, date in tax.date_dict.items():
                 if date != first_date and date != last_date:
-                    other_dates[date_type] = date
-            
+                    date_points[date_type][0].append(date)
+                    date_points[date_type][1].append(count)
+
             if safety_level:
                 label = cfunks.generate_labels(tax,safety_level, custom_tip_fields)    
             else:   
                 label = display_name(tax, custom_tip_fields)
-            
-            x = [first_date, last_date]
-            y = [count, count]
-            
-            ax1.scatter(first_date, count, color=colour_dict[first_date_type], s=200, zorder=2, label=first_date_type)
-            ax1.scatter(last_date, count, color=colour_dict[last_date_type], s=200, zorder=2, label=last_date_type)
 
-            for date_option, date in other_dates.items():
-                ax1.scatter(date, count, color=colour_dict[date_option], s=200, zorder=2, label=date_option)
+            spans.append((first_date, last_date, count))
+            labels.append(label)
             
-            if first_date != last_date:
-                ax1.plot(x,y, color="dimgrey",zorder=1)
+            count += 1
 
-            # ax2.plot([last_date, overall_max_date+offset],y,ls='dotted',lw=1,color="dimgrey")
-            if x != overall_max_date:
-                ax1.plot([last_date, overall_max_date+offset],y,ls='--',lw=1,color="dimgrey", zorder=1)
+    return date_points, spans, labels
 
-            ax2.text(overall_max_date+offset, count, label,size=15)
-            
-            count += 1
-        
-    ylim = ax1.get_ylim()
-    ax2.set_ylim(ylim)
-        
+def plot_time_density(date_points, colour_dict, loc, ax1):
+    #too many queries to give each one a row, so show how many of each date type there are per day instead
+
+    all_dates = [date for dates, rows in date_points.values() for date in dates]
+    first_day = mdates.date2num(min(all_dates))
+    last_day = mdates.date2num(max(all_dates))
+    bins = np.arange(first_day, last_day + 2) - 0.5
+
+    for date_type, (dates, rows) in date_points.items():
+        ax1.hist(mdates.date2num(dates), bins=bins, histtype="step", lw=2, color=colour_dict[date_type], label=date_type)
+
+    ax1.xaxis_date()
     ax1.spines['top'].set_visible(False) ## make axes invisible
     ax1.spines['right'].set_visible(False)
-    ax1.spines['left'].set_visible(False)
-    ax1.spines['bottom'].set_visible(False)
-    ax1.set_yticks([])
-    ax2.spines['top'].set_visible(False) ## make axes invisible
-    ax2.spines['right'].set_visible(False)
-    ax2.spines['left'].set_visible(False)
-    ax2.set_yticks([])
+    ax1.set_ylabel("Number of sequences", size=20)
 
     ax1.tick_params(labelsize=20, rotation=90)
     ax1.xaxis.set_major_locator(loc)
+    ax1.legend()
+
+def plot_time_lines(tips, date_points, spans, labels, colour_dict, loc, overall_max_date, time_len, savefile):
+
+    height = math.sqrt(len(tips))*2 + 1
+
+    with managed_figure("time_series", 1, 1, figsize=(20,height), savefile=savefile) as (fig, ax1):
+        ax2 = ax1.twinx()
+    
+        if time_len > 10:
+            offset = dt.timedelta(time_len/10)
+        else:
+            offset = dt.timedelta(time_len/3)
+
+        for date_type, (dates, rows) in date_points.items():
+            ax1.scatter(dates, rows, color=colour_dict[date_type], s=200, zorder=2, label=date_type)
+
+        label_x = mdates.date2num(overall_max_date+offset)
+        first_last = [((mdates.date2num(first_date), count), (mdates.date2num(last_date), count)) for first_date, last_date, count in spans if first_date != last_date]
+        to_labels = [((mdates.date2num(last_date), count), (label_x, count)) for first_date, last_date, count in spans]
+
+        ax1.add_collection(LineCollection(first_last, color="dimgrey", zorder=1))
+        ax1.add_collection(LineCollection(to_labels, linestyles='--', lw=1, color="dimgrey", zorder=1))
+        ax1.xaxis_date()
+        ax1.autoscale_view()
+
+        ylim = ax1.get_ylim()
+        ax2.set_ylim(ylim)
+        
+        ax1.spines['top'].set_visible(False) ## make axes invisible
+        ax1.spines['right'].set_visible(False)
+        ax1.spines['left'].set_visible(False)
+        ax1.spines['bottom'].set_visible(False)
+        ax1.set_yticks([])
+        ax2.spines['top'].set_visible(False) ## make axes invisible
+        ax2.spines['right'].set_visible(False)
+        ax2.spines['left'].set_visible(False)
 
-    handles, labels = ax1.get_legend_handles_labels()
-    unique = [(h, l) for i, (h, l) in enumerate(zip(handles, labels)) if l not in labels[:i]]
-    ax1.legend(*zip(*unique))
+        #labels go on as tick labels of the right hand axis rather than one text object each
+        ax2.set_yticks(range(1, len(labels)+1))
+        ax2.set_yticklabels(labels, size=15)
+        ax2.tick_params(axis="y", length=0)
 
-    fig.tight_layout()
+        ax1.tick_params(labelsize=20, rotation=90)
+        ax1.xaxis.set_major_locator(loc)
 
-    plt.savefig(figdir + "/" + tree_name + "_time_plot.svg", format="svg")
+        if date_points:
+            ax1.legend()
 
+        fig.tight_layout()
 
+def plot_time_series(tips, query_dict, overall_max_date, overall_min_date, date_fields, custom_tip_fields, tree_name, figdir, safety_level=None, density_threshold=500, stage_summary_dir=None):
+    #if stage_summary_dir is given, the stage and figure stats so far are written there once the plot is drawn
 
+    colour_dict = find_colour_dict(date_fields)    
+
+    time_len = (overall_max_date - overall_min_date).days
 
+    if time_len > 20:
+        tick_loc_base = float(math.ceil(time_len/5))
+    else:
+        tick_loc_base = 1.0
+
+    loc = plticker.MultipleLocator(base=tick_loc_base) #Sets a tick on each integer multiple of a base within the view interval
+
+    date_points, spans, labels = collect_time_series(tips, query_dict, custom_tip_fields, safety_level)
+
+    savefile = figdir + "/" + tree_name + "_time_plot.svg"
+
+    if len(spans) > density_threshold:
+        with managed_figure("time_series", 1, 1, figsize=(20,8), savefile=savefile) as (fig, ax1):
+            plot_time_density(date_points, colour_dict, loc, ax1)
+            fig.tight_layout()
+    else:
+        plot_time_lines(tips, date_points, spans, labels, colour_dict, loc, overall_max_date, time_len, savefile)
 
+    if stage_summary_dir:
+        write_stage_summary(stage_summary_dir)
@@ -5,18 +5,24 @@ from matplotlib import font_manager as fm, rcParams
 import re
 import copy
 import reportfunk.funks.baltic as bt
+from reportfunk.funks.figure_functions import managed_figure
+from reportfunk.funks.stage_functions import timed_stage, write_stage_summary, figure_stats, add_figure_stats
+import reportfunk.funks.svg_functions as svg_functions
+import reportfunk.funks.date_functions as date_functions
 import matplotlib as mpl
 from matplotlib import pyplot as plt
 from matplotlib import cm
+from matplotlib.collections import LineCollection
 
 import numpy as np
+import pandas as pd
 import math
 
 from collections import defaultdict
 
-import datetime as dt
 from collections import Counter
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     import civetfunks as cfunks
@@ -154,10 +160,8 @@ def find_colour_dict(query_dict, trait, colour_scheme):
     return colour_dict
 
     
-def make_scaled_tree(My_Tree, tree_name, inserted_node_dict, num_tips, colour_dict_dict, desired_fields, tallest_height, taxon_dict, query_dict, custom_tip_labels, graphic_dict, safety_level, figdir):
-
-    display_name(My_Tree, tree_name, inserted_node_dict, taxon_dict, query_dict, custom_tip_labels, safety_level) 
-    My_Tree.uncollapseSubtree()
+def scaled_tree_layout(My_Tree, num_tips, colour_dict_dict, desired_fields, tallest_height, query_dict, graphic_dict):
+    #works out where every branch, tip, label and trait blob of a catchment tree goes, so the drawing backends only have to draw
 
     if num_tips < 10:
         page_height = num_tips
@@ -172,29 +176,23 @@ def make_scaled_tree(My_Tree, tree_name, inserted_node_dict, num_tips, colour_di
     c_func=lambda k: 'dimgrey' ## colour of branches
     l_func=lambda k: 'lightgrey' ## colour of dotted lines
     s_func = lambda k: tipsize*5 if k.name in query_dict.keys() else (0 if k.node_number > 1 else tipsize)
-    z_func=lambda k: 100
     b_func=lambda k: 2.0 #branch width
     so_func=lambda k: tipsize*5 if k.name in query_dict.keys() else 0
-    zo_func=lambda k: 99
-    zb_func=lambda k: 98
-    zt_func=lambda k: 97
     font_size_func = lambda k: 25 if k.name in query_dict.keys() else 15
-    kwargs={'ha':'left','va':'center','size':12}
 
     #Colour by specified trait. If no trait is specified, they will be coloured by UK country
     #The first trait will colour the tips, and additional dots are added to the right of the tip
     
     if len(graphic_dict) == 1 and "adm1" in graphic_dict.keys(): #if they didn't specify any graphics
-        trait = "adm1"
+        first_trait = "adm1"
     else:
         key_iterator = iter(graphic_dict.keys())
-        trait = next(key_iterator) #so always have the first trait as the first colour dot
+        first_trait = next(key_iterator) #so always have the first trait as the first colour dot
 
-    first_trait = trait
-    colour_dict = colour_dict_dict[trait]
-    cn_func = lambda k: colour_dict[query_dict[k.name].attribute_dict[trait]] if k.name in query_dict.keys() else 'dimgrey'
-    co_func=lambda k: colour_dict[query_dict[k.name].attribute_dict[trait]] if k.name in query_dict.keys() else 'dimgrey' 
-    outline_colour_func = lambda k: colour_dict[query_dict[k.name].attribute_dict[trait]] if k.name in query_dict.keys() else 'dimgrey' 
+    colour_dict = colour_dict_dict[first_trait]
+    cn_func = lambda k: colour_dict[query_dict[k.name].attribute_dict[first_trait]] if k.name in query_dict.keys() else 'dimgrey'
+    co_func=lambda k: colour_dict[query_dict[k.name].attribute_dict[first_trait]] if k.name in query_dict.keys() else 'dimgrey' 
+    outline_colour_func = lambda k: colour_dict[query_dict[k.name].attribute_dict[first_trait]] if k.name in query_dict.keys() else 'dimgrey' 
 
     x_attr=lambda k: k.height + offset
     y_attr=lambda k: k.y
@@ -205,21 +203,36 @@ def make_scaled_tree(My_Tree, tree_name, inserted_node_dict, num_tips, colour_di
     min_y_prep = min(y_values)
     max_y_prep = max(y_values)
     vertical_spacer = 0.5 
-    full_page = page_height + vertical_spacer + vertical_spacer
     min_y,max_y = min_y_prep-vertical_spacer,max_y_prep+vertical_spacer
 
     x_values = []
     for k in My_Tree.Objects:
         x_values.append(x_attr(k))
     max_x = max(x_values)
-    
-    
-    fig,ax = plt.subplots(figsize=(20,page_height),facecolor='w',frameon=False, dpi=200)
-    
-    My_Tree.plotTree(ax, colour_function=c_func, x_attr=x_attr, y_attr=y_attr, branchWidth=b_func)
-    
-    My_Tree.plotPoints(ax, x_attr=x_attr, colour_function=cn_func,y_attr=y_attr, size_function=s_func, outline_colour=outline_colour_func)
-    My_Tree.plotPoints(ax, x_attr=x_attr, colour_function=co_func, y_attr=y_attr, size_function=so_func, outline_colour=outline_colour_func)
+
+    layout = {"figsize": (20,page_height),
+            "xlim": (-space_offset,absolute_x_axis_size),
+            "ylim": (min_y-1,max_y),
+            "branches": [], # (start, end, colour, width)
+            "points": [], # (x, y, size, colour, zorder, marker, edged)
+            "lines": [], # (xs, ys, colour, width, linestyle)
+            "texts": []} # (x, y, text, text kwargs)
+
+    for k in My_Tree.Objects: #rectangular branches, as in baltic's plotTree
+        x = x_attr(k)
+        xp = x_attr(k.parent) if k.parent else x
+        y = y_attr(k)
+        layout["branches"].append(((xp,y),(x,y),c_func(k),b_func(k)))
+        if k.branchType == 'node':
+            yl,yr = y_attr(k.children[0]),y_attr(k.children[-1])
+            layout["branches"].append(((x,yl),(x,yr),c_func(k),b_func(k)))
+
+    leaves = [k for k in My_Tree.Objects if k.branchType == 'leaf']
+    for size_func, colour_func in [(s_func, cn_func), (so_func, co_func)]: #tip circles and their outlines, as in baltic's plotPoints
+        for k in leaves:
+            layout["points"].append((x_attr(k),y_attr(k),size_func(k),colour_func(k),3,"o",False))
+        for k in leaves:
+            layout["points"].append((x_attr(k),y_attr(k),size_func(k)*2,outline_colour_func(k),2,"o",False))
 
     blob_dict = {}
 
@@ -232,9 +245,8 @@ def make_scaled_tree(My_Tree, tree_name, inserted_node_dict, num_tips, colour_di
         
             if k.node_number > 1:
                 new_dot_size = tipsize*(1+math.log(k.node_number)) 
-                ax.scatter(x, y, s=new_dot_size, marker="s", zorder=3, color="dimgrey")
+                layout["points"].append((x,y,new_dot_size,"dimgrey",3,"s",True))
 
-            height = My_Tree.treeHeight+offset
             text_start = tallest_height+space_offset+space_offset
 
             if len(desired_fields) > 1:
@@ -256,33 +268,21 @@ def make_scaled_tree(My_Tree, tree_name, inserted_node_dict, num_tips, colour_di
                             option = query_dict[k.name].attribute_dict[trait]
                             
                             if trait in graphic_dict.keys():
-                                colour_dict = colour_dict_dict[trait]
-                                trait_blob = ax.scatter(x_value, y, tipsize*5, color=colour_dict[option])  
+                                trait_colour_dict = colour_dict_dict[trait]
+                                layout["points"].append((x_value,y,tipsize*5,trait_colour_dict[option],1,"o",True))
                             else:
-                                trait_text = ax.text(x_value, y, option, size=15, ha="left", va="center", fontweight="light")
+                                layout["texts"].append((x_value, y, option, {"size":15, "ha":"left", "va":"center", "fontweight":"light"}))
                             
                             blob_dict[trait] = x_value
 
-                    ax.text(text_start+division, y, name, size=font_size_func(k), ha="left", va="center", fontweight="light")
+                layout["texts"].append((text_start+division, y, name, {"size":font_size_func(k), "ha":"left", "va":"center", "fontweight":"light"}))
                     
-                    if x != max_x:
-                        ax.plot([x+space_offset,tallest_height],[y,y],ls='--',lw=1,color=l_func(k))
-
-                else:
-
-                    ax.text(text_start+division, y, name, size=font_size_func(k), ha="left", va="center", fontweight="light")
-                    if x != max_x:
-                        ax.plot([x+space_offset,tallest_height],[y,y],ls='--',lw=1,color=l_func(k))
-
-                #This section adds a line in between each trait in the tree
-                # for blob_x in blob_dict.values():
-                #     line_x = blob_x - (division/2)
-                #     ax.plot([line_x,line_x],[min_y,max_y],ls='--',lw=3,color=l_func(k))
-            
+                if x != max_x:
+                    layout["lines"].append(([x+space_offset,tallest_height],[y,y],l_func(k),1,'--'))
             
             else:
-                ax.text(text_start, y, name, size=font_size_func(k), ha="left", va="center", fontweight="ultralight")
-                ax.plot([x+space_offset,tallest_height+space_offset],[y,y],ls='--',lw=1,color=l_func(k))
+                layout["texts"].append((text_start, y, name, {"size":font_size_func(k), "ha":"left", "va":"center", "fontweight":"ultralight"}))
+                layout["lines"].append(([x+space_offset,tallest_height+space_offset],[y,y],l_func(k),1,'--'))
 
     #Adds labels to the top of the tree to indicate what each labelled trait is
     if len(desired_fields) > 1:
@@ -290,28 +290,69 @@ def make_scaled_tree(My_Tree, tree_name, inserted_node_dict, num_tips, colour_di
         blob_dict[first_trait] = tallest_height
         
         for trait, blob_x in blob_dict.items():
-            y = max_y
-            x = blob_x
-
-            ax.text(x,y,trait, rotation=90, size=15,ha="center", va="bottom")
+            layout["texts"].append((blob_x, max_y, trait, {"rotation":90, "size":15, "ha":"center", "va":"bottom"}))
     
-    ax.plot([0,0.00003], [-0.5,-0.5], ls='-', lw=2, color="dimgrey")
-    ax.text(0.000015,-1.15,"1 SNP",size=20, ha="center", va="center")
+    #scale bar
+    layout["lines"].append(([0,0.00003], [-0.5,-0.5], "dimgrey", 2, '-'))
+    layout["texts"].append((0.000015, -1.15, "1 SNP", {"size":20, "ha":"center", "va":"center"}))
+
+    return layout
+
+def draw_tree_layout(layout, savefile):
+
+    with managed_figure("catchment_trees", figsize=layout["figsize"],facecolor='w',frameon=False, dpi=200, savefile=savefile) as (fig, ax):
+
+        segments = [(start, end) for start, end, colour, width in layout["branches"]]
+        colours = [colour for start, end, colour, width in layout["branches"]]
+        widths = [width for start, end, colour, width in layout["branches"]]
+        ax.add_collection(LineCollection(segments,lw=widths,ls='-',color=colours,capstyle='projecting'))
 
-    ax.spines['top'].set_visible(False) ## make axes invisible
-    ax.spines['right'].set_visible(False)
-    ax.spines['left'].set_visible(False)
-    ax.spines['bottom'].set_visible(False)
-    ax.set_xticks([])
-    ax.set_yticks([])
+        #one scatter per layer rather than one per tip
+        point_groups = defaultdict(list)
+        for x, y, size, colour, zorder, marker, edged in layout["points"]:
+            point_groups[(zorder, marker, edged)].append((x, y, size, colour))
 
-    ax.set_xlim(-space_offset,absolute_x_axis_size)
-    ax.set_ylim(min_y-1,max_y)
+        for (zorder, marker, edged), points in point_groups.items():
+            xs, ys, sizes, colours = zip(*points)
+            if edged:
+                ax.scatter(xs, ys, s=sizes, color=list(colours), marker=marker, zorder=zorder)
+            else:
+                ax.scatter(xs, ys, s=sizes, facecolor=list(colours), edgecolor='none', marker=marker, zorder=zorder)
+
+        line_groups = defaultdict(list)
+        for xs, ys, colour, width, linestyle in layout["lines"]:
+            line_groups[(colour, width, linestyle)].append(list(zip(xs, ys)))
+
+        for (colour, width, linestyle), lines in line_groups.items():
+            ax.add_collection(LineCollection(lines, lw=width, ls=linestyle, color=colour, zorder=2))
 
+        for x, y, text, text_kwargs in layout["texts"]:
+            ax.text(x, y, text, **text_kwargs)
 
-    fig.tight_layout()
+        ax.spines['top'].set_visible(False) ## make axes invisible
+        ax.spines['right'].set_visible(False)
+        ax.spines['left'].set_visible(False)
+        ax.spines['bottom'].set_visible(False)
+        ax.set_xticks([])
+        ax.set_yticks([])
 
-    plt.savefig(figdir + "/" + tree_name + ".svg", format="svg")
+        ax.set_xlim(*layout["xlim"])
+        ax.set_ylim(*layout["ylim"])
+
+        fig.tight_layout()
+
+def make_scaled_tree(My_Tree, tree_name, inserted_node_dict, num_tips, colour_dict_dict, desired_fields, tallest_height, taxon_dict, query_dict, custom_tip_labels, graphic_dict, safety_level, figdir, backend="matplotlib"):
+
+    display_name(My_Tree, tree_name, inserted_node_dict, taxon_dict, query_dict, custom_tip_labels, safety_level) 
+    My_Tree.uncollapseSubtree()
+
+    layout = scaled_tree_layout(My_Tree, num_tips, colour_dict_dict, desired_fields, tallest_height, query_dict, graphic_dict)
+
+    savefile = figdir + "/" + tree_name + ".svg"
+    if backend == "svg": #writes the svg elements directly, much quicker and smaller files for large reports
+        svg_functions.write_tree_svg(layout, savefile)
+    else:
+        draw_tree_layout(layout, savefile)
 
 def sort_trees_index(tree_dir):
     b_list = []
@@ -327,7 +368,8 @@ def sort_trees_index(tree_dir):
         
     return c
 
-def make_all_of_the_trees(input_dir, tree_name_stem, taxon_dict, query_dict, desired_fields, custom_tip_labels, graphic_dict, tree_to_all_tip, tree_to_querys, inserted_node_dict, svg_figdir,  safety_level=None, min_uk_taxa=3):
+def make_all_of_the_trees(input_dir, tree_name_stem, taxon_dict, query_dict, desired_fields, custom_tip_labels, graphic_dict, tree_to_all_tip, tree_to_querys, inserted_node_dict, svg_figdir,  safety_level=None, min_uk_taxa=3, tree_backend="matplotlib", taxon_table=None, stage_summary_dir=None):
+    #if stage_summary_dir is given, the stage and figure stats so far are written there once the trees are drawn
 
     tallest_height = find_tallest_tree(input_dir)
 
@@ -385,21 +427,26 @@ def make_all_of_the_trees(input_dir, tree_name_stem, taxon_dict, query_dict, des
             overall_tree_count += 1      
             
             if len(tips) < 500:
-                df_dict = summarise_node_table(input_dir, treename, taxon_dict)
-                overall_df_dict[treename] = df_dict
-                
-                make_scaled_tree(tree, treename, inserted_node_dict, len(tips), colour_dict_dict, desired_fields, tallest_height, taxon_dict, query_dict, custom_tip_labels, graphic_dict, safety_level, svg_figdir)     
+                with timed_stage("tree_rendering", tips=len(tips)):
+                    df_dict = summarise_node_table(input_dir, treename, taxon_dict, taxon_table=taxon_table)
+                    overall_df_dict[treename] = df_dict
+                    
+                    make_scaled_tree(tree, treename, inserted_node_dict, len(tips), colour_dict_dict, desired_fields, tallest_height, taxon_dict, query_dict, custom_tip_labels, graphic_dict, safety_level, svg_figdir, backend=tree_backend)     
             
             else:
-                fig,ax = plt.subplots(1,1)
-                ax.text(0.3,0.5,"Tree to large to be rendered")
-                too_tall_trees.append(treename)
-                tips = tree_to_all_tip[treename]
-                too_large_tree_dict = summarise_large_tree(tips, treename, query_dict, taxon_dict, too_large_tree_dict, tree_to_querys)
+                with timed_stage("large_tree_summary", tips=len(tree_to_all_tip[treename])):
+                    with managed_figure("catchment_trees", 1, 1) as (fig, ax):
+                        ax.text(0.3,0.5,"Tree to large to be rendered")
+                    too_tall_trees.append(treename)
+                    tips = tree_to_all_tip[treename]
+                    too_large_tree_dict = summarise_large_tree(tips, treename, query_dict, taxon_dict, too_large_tree_dict, tree_to_querys, taxon_table=taxon_table)
+
+    if stage_summary_dir:
+        write_stage_summary(stage_summary_dir)
                 
     return too_tall_trees, overall_tree_count, colour_dict_dict, overall_df_dict, tree_order, too_large_tree_dict, tallest_height, tree_to_num_tips
 
-def summarise_large_tree(tips, treename, query_dict, full_tax_dict, df_dict, tree_to_querys):
+def summarise_large_tree(tips, treename, query_dict, full_tax_dict, df_dict, tree_to_querys, taxon_table=None):
 
     #want number of nodes total, list of queries in the tree, countries present, date range
     query_count = 0
@@ -413,7 +460,17 @@ def summarise_large_tree(tips, treename, query_dict, full_tax_dict, df_dict, tre
 
     query_count = len(queries)
 
-    for tip in tips:
+    if taxon_table is not None:
+        subtrees = [tip for tip in tips if "subtree" in tip]
+        rows = taxon_table.rows([tip for tip in tips if "subtree" not in tip])
+        countries = set(rows["country"][rows["country"] != "NA"])
+        if rows["date"].notna().any():
+            dates = [taxon_table.date_string(rows["date"].min()), taxon_table.date_string(rows["date"].max())]
+        tips_to_read = []
+    else:
+        tips_to_read = tips
+
+    for tip in tips_to_read:
         if "subtree" not in tip:
             # if tip in query_dict:
             #     query_count += 1
@@ -507,10 +564,13 @@ def summarise_collapsed_node_for_label(inserted_node_dict, focal_node, focal_tre
 
     return info, len(member_list)
 
-def summarise_node_table(tree_dir, focal_tree, full_tax_dict):
+def summarise_node_table(tree_dir, focal_tree, full_tax_dict, taxon_table=None):
 
     focal_tree_file = focal_tree + ".txt"
 
+    if taxon_table is not None:
+        return summarise_node_table_from_columns(tree_dir + "/" + focal_tree_file, taxon_table)
+
     df_dict = defaultdict(list)
 
     with open(tree_dir + "/" + focal_tree_file) as f:
@@ -534,7 +594,7 @@ def summarise_node_table(tree_dir, focal_tree, full_tax_dict):
                     taxon_obj = full_tax_dict[tax]
                     if taxon_obj.sample_date != "NA":
                         date_string = taxon_obj.sample_date
-                        date = dt.datetime.strptime(date_string, "%Y-%m-%d").date()
+                        date = date_functions.parse_date(date_string)
                         dates.append(date)
                     
                     countries.append(taxon_obj.country)
@@ -600,7 +660,65 @@ def summarise_node_table(tree_dir, focal_tree, full_tax_dict):
 
     return df_dict
 
-def make_legend(colour_dict_dict):
+def counts_string(counts):
+    return ", ".join(f"{value} ({count})" for value, count in counts)
+
+def summarise_node_table_from_columns(node_file, taxon_table):
+    #same table as summarise_node_table, with the members of every node looked up and counted together
+
+    node_names = []
+    node_sizes = []
+    member_nodes = []
+    member_names = []
+
+    with open(node_file) as f:
+        next(f)
+        for l in f:
+            toks = l.strip("\n").split("\t")
+            member_list = toks[1].split(",")
+            node_names.append(toks[0])
+            node_sizes.append(len(member_list))
+            member_nodes.extend([len(node_names) - 1]*len(member_list))
+            member_names.extend(member_list)
+
+    rows = taxon_table.row_numbers(member_names)
+    found = rows != -1
+    members = taxon_table.frame.iloc[rows[found]][["country", "adm2", "date"]].reset_index(drop=True)
+    members["node"] = np.array(member_nodes, dtype=int)[found]
+
+    #groups come out in the order they're first seen, which is the order Counter keeps
+    country_counts = members.groupby(["node", "country"], sort=False, observed=True).size()
+    uk_adm2 = members[(members["country"] == "UK") & ~members["adm2"].isin(["", "NA"])]
+    adm2_counts = uk_adm2.groupby(["node", "adm2"], sort=False, observed=True).size()
+    min_dates = members.groupby("node")["date"].min()
+    max_dates = members.groupby("node")["date"].max()
+
+    node_countries = defaultdict(list)
+    for (node, country), count in country_counts.items():
+        node_countries[node].append((country, int(count)))
+    node_adm2s = defaultdict(list)
+    for (node, adm2), count in adm2_counts.items():
+        node_adm2s[node].append((adm2, int(count)))
+
+    df_dict = defaultdict(list)
+    for node, node_name in enumerate(node_names):
+        countries = sorted(node_countries[node], key=lambda x: x[1], reverse=True)[:5] #as Counter.most_common(5)
+
+        if node in min_dates.index and not pd.isna(min_dates[node]):
+            date_range = taxon_table.date_string(min_dates[node]) + " to " + taxon_table.date_string(max_dates[node])
+        else:
+            date_range = "no_date to no_date"
+
+        df_dict["Node number"].append(node_name.lstrip("inserted_node"))
+        df_dict["UK present"].append(any(country == "UK" for country, count in node_countries[node]))
+        df_dict["Number of sequences"].append(node_sizes[node])
+        df_dict["Date range"].append(date_range)
+        df_dict["Countries"].append(counts_string(countries))
+        df_dict["Admin 2 regions"].append(counts_string(node_adm2s[node]) or "NA")
+
+    return df_dict
+
+def make_legend(colour_dict_dict, stage_summary_dir=None):
     
     num_colours = []
     num_traits = 0
@@ -614,57 +732,60 @@ def make_legend(colour_dict_dict):
         
     max_colours = sorted(num_colours, reverse=True)[0]
     height = math.sqrt(num_traits)*0.75
-    fig,ax = plt.subplots(figsize=(max_colours+1,height), dpi=700)
+    with managed_figure("legend", figsize=(max_colours+1,height), dpi=700) as (fig, ax):
     
-    for trait, colour_dict in colour_dict_dict.items():
-        y +=2
-        plt.text(-0.5,y,trait, fontsize=5, ha="right",va="center")
-        last_option = ""
-        for option in sorted(colour_dict):
-            if option == "NA":
-                last_option = "NA"
-            else:
+        for trait, colour_dict in colour_dict_dict.items():
+            y +=2
+            plt.text(-0.5,y,trait, fontsize=5, ha="right",va="center")
+            last_option = ""
+            for option in sorted(colour_dict):
+                if option == "NA":
+                    last_option = "NA"
+                else:
+                    x += 1
+                    col = c=np.array([colour_dict[option]])
+                    plt.scatter([x], [y], s =10, c=col) #((xloc, yloc), radius) relative to overall plot size
+                    # ax.add_artist(circle)
+                    plt.text(x,y-1,option, fontsize=5,ha="center",va="center")
+                
+            if last_option != "":
                 x += 1
-                col = c=np.array([colour_dict[option]])
-                plt.scatter([x], [y], s =10, c=col) #((xloc, yloc), radius) relative to overall plot size
+                col = c=np.array([colour_dict["NA"]])
+                plt.scatter([x], [y], s = 10, c=col) #((xloc, yloc), radius) relative to overall plot size
                 # ax.add_artist(circle)
-                plt.text(x,y-1,option, fontsize=5,ha="center",va="center")
-                
-        if last_option != "":
-            x += 1
-            col = c=np.array([colour_dict["NA"]])
-            plt.scatter([x], [y], s = 10, c=col) #((xloc, yloc), radius) relative to overall plot size
-            # ax.add_artist(circle)
-            plt.text(x,y-1,"NA", fontsize=5,ha="center",va="center")
-        x = 0
+                plt.text(x,y-1,"NA", fontsize=5,ha="center",va="center")
+            x = 0
         
-    plt.xlim(-1,max_colours+1)
-    plt.ylim(0,y+1)
+        plt.xlim(-1,max_colours+1)
+        plt.ylim(0,y+1)
 
-    ax.spines['top'].set_visible(False) ## make axes invisible
-    ax.spines['right'].set_visible(False)
-    ax.spines['left'].set_visible(False)
-    ax.spines['bottom'].set_visible(False)
+        ax.spines['top'].set_visible(False) ## make axes invisible
+        ax.spines['right'].set_visible(False)
+        ax.spines['left'].set_visible(False)
+        ax.spines['bottom'].set_visible(False)
 
-    plt.yticks([])
-    plt.xticks([])
-    plt.tight_layout()
-    plt.show()
+        plt.yticks([])
+        plt.xticks([])
+        plt.tight_layout()
 
-def describe_collapsed_nodes(full_tax_dict, tree_name_stem, tree_dir, node_summary): #this is describe each collapsed node in turn
+    if stage_summary_dir:
+        write_stage_summary(stage_summary_dir)
 
-    tree_lst = sort_trees_index(tree_dir)
+def summarise_collapsed_nodes(full_tax_dict, tree_name_stem, tree_dir, node_summary):
+    #counts each node_summary option in each collapsed node, as a node by option matrix per tree
 
-    hidden_options = defaultdict(list)
+    tree_lst = sort_trees_index(tree_dir)
 
-    figure_count = 0
+    summaries = []
 
     for fn in tree_lst:
         focal_tree = f"{tree_name_stem}_{fn}"
         focal_tree_file = f"{tree_dir}/{focal_tree}.txt"
-        pretty_focal = "Tree " + str(fn)
 
-        collapsed_dict = defaultdict(list)
+        node_names = []
+        node_index = []
+        option_index = []
+        option_codes = {}
 
         with open(focal_tree_file) as f:
             next(f)
@@ -673,141 +794,146 @@ def describe_collapsed_nodes(full_tax_dict, tree_name_stem, tree_dir, node_summa
                 seqs = toks[1].split(",")
 
                 node_number = toks[0].lstrip("inserted_node")
-                new_name = "Collapsed node" + node_number
-                collapsed_dict[new_name] = seqs
-    
-            ndes_option_counts = defaultdict(dict)
-            nodes = []
+                node_names.append("Collapsed node" + node_number)
 
-            for nde, seqs in collapsed_dict.items():
-                options = []
                 for i in seqs:
-                    if i in full_tax_dict.keys():
-                        obj = full_tax_dict[i]
-                        options.append(obj.node_summary)
-
-                    else:
-                        pass
-
-                option_counts = Counter(options)
-
-                                
-                if len(option_counts) > 10:
-                    keep_options = dict(option_counts.most_common(10))
-                    if node_summary == "country":
-                        if "UK" in options and "UK" not in keep_options.keys():
-                            keep_options["UK"] = option_counts["UK"]
-
-                    hidden_options[focal_tree].append(nde)
-                    
-                else:
-                    keep_options = option_counts
-                    
-                if len(option_counts) > 1:
-                    
-                    ndes_option_counts[nde] = keep_options
-                    nodes.append(nde)
-                            
-            if len(ndes_option_counts) > 1:
-                
-                figure_count += 1
-
-                plt.rc('ytick', labelsize=5)
-                
-                count = 0
-
-                rows = math.ceil(len(ndes_option_counts)/5)
-                
-                # fig.tight_layout()
+                    if i in full_tax_dict:
+                        option = full_tax_dict[i].node_summary
+                        if option not in option_codes:
+                            option_codes[option] = len(option_codes)
+                        node_index.append(len(node_names)-1)
+                        option_index.append(option_codes[option])
+
+        options = list(option_codes)
+        counts = np.zeros((len(node_names), len(options)), dtype=int)
+        np.add.at(counts, (np.array(node_index, dtype=int), np.array(option_index, dtype=int)), 1)
+
+        #keep the ten most common options in each node, plus the UK if summarising by country
+        present = counts > 0
+        hidden = present.sum(axis=1) > 10
+        if hidden.any():
+            rank = np.argsort(np.argsort(-counts, axis=1, kind="stable"), axis=1, kind="stable")
+            keep = rank < 10
+            if node_summary == "country" and "UK" in option_codes:
+                keep[:, option_codes["UK"]] = True
+            counts = np.where(hidden[:,None] & ~keep, 0, counts)
+
+        described = present.sum(axis=1) > 1
+
+        summaries.append({"tree": focal_tree,
+                        "title": "Tree " + str(fn),
+                        "nodes": [node for node, keep_node in zip(node_names, described) if keep_node],
+                        "options": options,
+                        "counts": counts[described],
+                        "hidden_options": [node for node, hide in zip(node_names, hidden) if hide]})
+
+    return summaries
+
+def plot_collapsed_nodes(summary, heatmap=False, savefile=None):
+    #draws one tree's collapsed node summary, either as small multiples of bar charts or a single heatmap
+
+    nodes = summary["nodes"]
+    counts = summary["counts"]
+    options = np.array(summary["options"], dtype=object)
+
+    if heatmap:
+        used = counts.sum(axis=0) > 0
+        height = max(2, len(nodes)*0.3)
+        with managed_figure("collapsed_nodes", figsize=(max(4, used.sum()*0.3), height), dpi=250, savefile=savefile) as (fig, ax):
+            image = ax.imshow(np.where(counts[:,used] > 0, counts[:,used], np.nan), cmap="YlOrBr", aspect="auto")
+            ax.set_xticks(range(used.sum()))
+            ax.set_xticklabels(options[used], rotation=90, size=5)
+            ax.set_yticks(range(len(nodes)))
+            ax.set_yticklabels(nodes, size=5)
+            ax.set_title(summary["title"], size=8)
+            fig.colorbar(image, ax=ax)
+            fig.tight_layout()
+        return
+
+    if len(nodes) == 1:
+        row = counts[0]
+        shown = np.flatnonzero(row)
+        with managed_figure("collapsed_nodes", figsize=(2,2), dpi=250, savefile=savefile) as (fig, ax):
+            ax.bar(range(len(shown)), row[shown], tick_label=options[shown], color="goldenrod")
+            ax.spines['top'].set_visible(False) ## make axes invisible
+            ax.spines['right'].set_visible(False)
+            ax.tick_params(axis="x", labelsize=5, labelrotation=90)
+            ax.tick_params(axis="y", labelsize=5)
+            ax.set_title(summary["title"] + ": " + nodes[0], size=5)
+        return
+
+    rows = math.ceil(len(nodes)/5)
+    if rows == 1:
+        figsize = (10,2)
+        rotation = 90
+    else:
+        figsize = (10,10)
+        rotation = 70
+
+    with managed_figure("collapsed_nodes", figsize=figsize, dpi=250, axes=False, savefile=savefile) as (fig, ax):
+        for position, (nde, row) in enumerate(zip(nodes, counts)): #only adds the axes that are needed
+            shown = np.flatnonzero(row)
+            ax = fig.add_subplot(rows, 5, position+1)
+            ax.bar(range(len(shown)), row[shown], tick_label=options[shown], color="goldenrod")
+            ax.set_title(nde, size=8)
+            ax.tick_params(axis="x", labelsize=5, labelrotation=rotation)
+            ax.tick_params(axis="y", labelsize=5)
+            ax.spines['top'].set_visible(False) ## make axes invisible
+            ax.spines['right'].set_visible(False)
 
+        if rows == 1:
+            fig.tight_layout()
+            fig.suptitle(summary["title"],y=1.1,x=0.05, size=10)
+        else:
+            fig.subplots_adjust(hspace=1.0, wspace=0.7)
+            fig.suptitle(summary["title"],y=0.95,x=0.1, size=10)
 
-                if rows == 1:
-                    fig, axs = plt.subplots(rows,5, figsize=(10,2), dpi=250)
+def plot_collapsed_nodes_job(summary, heatmap, savefile):
+    #worker job: the figure stats only this plot recorded, for the parent to merge. Peak memory is the worker's
+    figure_stats.pop("collapsed_nodes", None)
+    plot_collapsed_nodes(summary, heatmap, savefile)
+    return figure_stats.pop("collapsed_nodes", {})
 
-                    fig.tight_layout()
-                    count = 0      
-                    for nde, country_counts in ndes_option_counts.items():
+def describe_collapsed_nodes(full_tax_dict, tree_name_stem, tree_dir, node_summary, heatmap=False, figdir=None, threads=1, stage_summary_dir=None): #this is describe each collapsed node in turn
 
-                        x = country_counts.keys()
-                        y = country_counts.values()
+    summaries = [summary for summary in summarise_collapsed_nodes(full_tax_dict, tree_name_stem, tree_dir, node_summary) if len(summary["nodes"]) > 0]
 
-                        # print("1 counts" + str(count))
-                        axs[count].bar(x,y, color="goldenrod")
-                        axs[count].set_title(nde, size=8)
-                        axs[count].set_xticklabels(x,rotation=90, size=5)
-                        #axs[count].set_yticklabels(size=5)
-                        axs[count].spines['top'].set_visible(False) ## make axes invisible
-                        axs[count].spines['right'].set_visible(False)
-                        count += 1
+    figure_count = len(summaries)
 
-                 
-                    fig.suptitle(pretty_focal,y=1.1,x=0.05, size=10)
-                
-                else:
-                    fig, axs = plt.subplots(rows,5,figsize=(10,10), dpi=250)
-                    fig.subplots_adjust(hspace=1.0, wspace=0.7)
-                    # fig.tight_layout()
-                    
-                    
-                    for nrow in range(0,rows):
-                        for i in range(0,5):
-                            try:
-                                relevant_nde = nodes[(nrow*5) + i]
-                                
-                                x = ndes_option_counts[relevant_nde].keys()
-                                y = ndes_option_counts[relevant_nde].values()
-
-                                axs[nrow][i].bar(x,y, color="goldenrod")
-                                axs[nrow][i].set_title(relevant_nde, size=8)
-                                axs[nrow][i].set_xticklabels(x,rotation=70, size=5)
-                                # axs[nrow][i].set_yticklabels(y, size=5)
-                                axs[nrow][i].spines['top'].set_visible(False) ## make axes invisible
-                                axs[nrow][i].spines['right'].set_visible(False)
-                            except IndexError:
-                                continue
-
-               
-                    fig.suptitle(pretty_focal,y=0.95,x=0.1, size=10)
-
-                if len(ndes_option_counts) != rows*5:
-                    number_empty_ones = rows*5 - len(ndes_option_counts)
-                    for_removal = [i for i in range((rows*5-number_empty_ones),rows*5)]
-
-                    for j in for_removal:
-                         fig.delaxes(axs.flatten()[j])
+    if figdir and threads > 1: #the summaries are small, so trees can be drawn in separate processes when they're being written out
+        with ProcessPoolExecutor(max_workers=threads) as executor:
+            jobs = [executor.submit(plot_collapsed_nodes_job, summary, heatmap, f"{figdir}/{summary['tree']}_collapsed_nodes.svg") for summary in summaries]
+            for job in jobs:
+                add_figure_stats("collapsed_nodes", job.result())
+    else:
+        for summary in summaries:
+            if figdir:
+                savefile = f"{figdir}/{summary['tree']}_collapsed_nodes.svg"
+            else:
+                savefile = None
+            plot_collapsed_nodes(summary, heatmap, savefile)
 
-                    
-            elif len(ndes_option_counts) == 1:
-                
-                figure_count += 1
-                fig, ax = plt.subplots(figsize=(2,2), dpi=250)
-
-                for nde, country_counts in ndes_option_counts.items():
-                    
-                    x = country_counts.keys()
-                    y = country_counts.values()
-
-                    plt.bar(x,y, color="goldenrod")
-                    ax.spines['top'].set_visible(False) ## make axes invisible
-                    ax.spines['right'].set_visible(False)
-                    # plt.title(nde)
-                    plt.xticks(size=5, rotation=90)
-                    plt.yticks(size=5)
-                    
-                    plt.title(pretty_focal + ": " + nde, size=5)
+    if stage_summary_dir:
+        write_stage_summary(stage_summary_dir)
 
     return figure_count
 
-def describe_traits(full_tax_dict, node_summary, query_dict): #describe the whole tree in one chart
+def describe_traits(full_tax_dict, node_summary, query_dict, taxon_table=None, stage_summary_dir=None): #describe the whole tree in one chart
 ##more used in llama than civet
 
     trait_prep = defaultdict(list)
     trait_present = defaultdict(dict)
 
-    for tax in full_tax_dict.values():
-        if tax.tree != "NA" and tax not in query_dict.values():
-            key = tax.tree 
-            trait_prep[key].append(tax.node_summary)
+    if taxon_table is not None:
+        frame = taxon_table.frame
+        background = frame[(frame["tree"] != "NA") & ~frame["query"]]
+        for (tree, trait), count in background.groupby(["tree", "node_summary"], sort=False, observed=True).size().items():
+            trait_present.setdefault(tree, Counter())[trait] = int(count)
+    else:
+        for tax in full_tax_dict.values():
+            if tax.tree != "NA" and tax not in query_dict.values():
+                key = tax.tree 
+                trait_prep[key].append(tax.node_summary)
 
     for tree, traits in trait_prep.items():
         counts = Counter(traits)
@@ -819,8 +945,6 @@ def describe_traits(full_tax_dict, node_summary, query_dict): #describe the whol
     for tree, counts in trait_present.items():
         if len(counts) > 2:
 
-            fig, ax = plt.subplots(1,1, figsize=(5,2.5), dpi=250)
-            
             if len(counts) <= 5:
                 sorted_counts = sorted(counts, key = lambda x : counts[x], reverse = True)
                 x = list(sorted_counts)
@@ -830,16 +954,19 @@ def describe_traits(full_tax_dict, node_summary, query_dict): #describe the whol
                 x = list(selected)
                 y = [counts[i] for i in x]
 
-            ax.bar(x,y, color="#924242")
-            ax.set_xticklabels(x, rotation=90)
-            ax.spines['top'].set_visible(False) ## make axes invisible
-            ax.spines['right'].set_visible(False)
-            ax.set_ylabel("Number of sequences")
-            ax.set_xlabel(node_summary)
+            with managed_figure("traits", 1, 1, figsize=(5,2.5), dpi=250) as (fig, ax):
+                ax.bar(x,y, color="#924242")
+                ax.set_xticklabels(x, rotation=90)
+                ax.spines['top'].set_visible(False) ## make axes invisible
+                ax.spines['right'].set_visible(False)
+                ax.set_ylabel("Number of sequences")
+                ax.set_xlabel(node_summary)
             
             tree_to_trait_fig[tree] = fig_count
             fig_count += 1
 
+    if stage_summary_dir:
+        write_stage_summary(stage_summary_dir)
 
     return tree_to_trait_fig, trait_present
 
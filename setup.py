@@ -19,7 +19,19 @@ setup(name='reportfunk',
             "reportfunk/funks/io_functions.py",
             "reportfunk/funks/class_definitions.py",
             "reportfunk/funks/tree_functions.py",
-            "reportfunk/funks/table_functions.py"],
+            "reportfunk/funks/table_functions.py",
+            "reportfunk/funks/figure_functions.py",
+            "reportfunk/funks/svg_functions.py",
+            "reportfunk/funks/metadata_functions.py",
+            "reportfunk/funks/store_functions.py",
+            "reportfunk/funks/date_functions.py",
+            "reportfunk/funks/stage_functions.py",
+            "reportfunk/funks/pipeline_functions.py",
+            "reportfunk/funks/join_functions.py",
+            "reportfunk/funks/preflight_functions.py",
+            "reportfunk/funks/filter_functions.py",
+            "reportfunk/funks/bitmap_functions.py",
+            "reportfunk/funks/fasta_functions.py"],
       install_requires=[
             "biopython>=1.70",
             "matplotlib>=3.2.1",
@@ -0,0 +1,57 @@
+import io
+
+import pytest
+from Bio import SeqIO
+
+from reportfunk.funks.fasta_functions import mapped_fasta, fasta_record_stats, record_sequence, write_fasta_record
+
+FASTA = (">EDB001 fail=seq_len:20 something\nACGTNNNNAC\nGTACGTnnAC\n"
+        ">EDB002\r\nACGTACGTAC\r\nACGTAC\r\n"
+        ">EDB003 spaces in the sequence\nACG TAC GTN\n\nNNNN\n"
+        ">EDB004 empty\n"
+        ">EDB005\n" + "ACGTN"*50 + "\n"
+        ">EDB006 no newline at the end\nACGTACGTNN")
+
+@pytest.fixture
+def fasta_file(tmp_path):
+    path = tmp_path / "query.fasta"
+    path.write_bytes(FASTA.encode("utf-8"))
+    return str(path)
+
+def seqio_stats(fasta):
+    #what input_file_qc worked out from each SeqRecord before it read the bytes itself
+    return [(record.description, len(record), str(record.seq).upper().count("N"), str(record.seq)) for record in SeqIO.parse(fasta, "fasta")]
+
+def byte_stats(fasta, **kwargs):
+    with mapped_fasta(fasta) as data:
+        return [(title, length, num_N, record_sequence(data, offset, record_end).decode("ascii")) for offset, record_end, title, length, num_N in fasta_record_stats(fasta, **kwargs)]
+
+def test_record_stats_match_seqio(fasta_file):
+    assert byte_stats(fasta_file) == seqio_stats(fasta_file)
+
+def test_chunked_record_stats_match_seqio(fasta_file):
+    #chunks small enough that every boundary lands in the middle of a record
+    assert byte_stats(fasta_file, threads=2, chunk_size=16) == seqio_stats(fasta_file)
+
+def test_written_records_match_seqio(fasta_file):
+    expected = io.StringIO()
+    SeqIO.write(SeqIO.parse(fasta_file, "fasta"), expected, "fasta")
+
+    written = io.StringIO()
+    with mapped_fasta(fasta_file) as data:
+        for offset, record_end, title, length, num_N in fasta_record_stats(fasta_file):
+            write_fasta_record(written, title, record_sequence(data, offset, record_end))
+    assert written.getvalue() == expected.getvalue()
+
+def test_empty_fasta(tmp_path):
+    path = tmp_path / "empty.fasta"
+    path.write_bytes(b"")
+    assert list(fasta_record_stats(str(path))) == []
+
+def test_fasta_must_start_with_a_record(tmp_path):
+    path = tmp_path / "bad.fasta"
+    path.write_bytes(b"ACGT\n>EDB001\nACGT\n")
+    with pytest.raises(ValueError):
+        list(fasta_record_stats(str(path)))
+    with pytest.raises(ValueError):
+        list(SeqIO.parse(str(path), "fasta"))
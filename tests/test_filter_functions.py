@@ -0,0 +1,70 @@
+import pytest
+
+from reportfunk.funks.filter_functions import MetadataFilter, matching_rows
+from reportfunk.funks.bitmap_functions import build_bitmap_index
+from reportfunk.funks.store_functions import get_store
+
+METADATA = """sequence_name,country,adm1,lineage,sample_date
+EDB001,UK,UK-SCT,B.1.1.7,2020-03-02
+EDB002,UK,UK-ENG,B.1,2020-03-15
+EDB003,France,,B.1,2020/03/02
+EDB004,UK,UK-SCT,B.1.1.7,2020-04-01
+EDB005,France,,B.1.1.7,2020-03-20
+EDB006,UK,UK-WLS,B.1,NA
+EDB007,UK,UK-ENG,B.1.1.7,03/03/2020
+EDB008,UK,UK-SCT,B.1,2020-03-31
+EDB009,Curaçao,,B.1,2020-03-05
+EDB010,CURAÇAO,,B.1.1.7,2020-03-06
+EDB011,curaçao,,B.1,2020/03/07
+"""
+
+QUERIES = [
+    [("country", "UK")],
+    [("country", "uk"), ("sample_date", "2020-03-01:2020-03-31")],
+    [("sample_date", "2020-03-01:2020-03-31")],
+    [("country", "France"), ("lineage", "B.1.1.7")],
+    [("country", "UK"), ("sequence_name", "EDB008"), ("sample_date", "2020-03-01:2020-03-31")],
+    [("lineage", "B.1"), ("sample_date", "2020-03-01:2020-03-15")],
+    [("country", "Spain")],
+    [("country", "Curaçao")],
+    [("country", "curaçao"), ("sample_date", "2020-03-01:2020-03-31")],
+]
+
+@pytest.fixture
+def metadata_file(tmp_path):
+    path = tmp_path / "metadata.csv"
+    path.write_text(METADATA)
+    return str(path)
+
+def run_query(metadata_file, query, bitmap_index=None, store=None):
+    reported = []
+    def invalid_date(value, row_number, column):
+        reported.append((value, row_number, column))
+
+    filters = [MetadataFilter(column, value) for column, value in query]
+    header, rows = matching_rows(metadata_file, filters, store=store, invalid_date=invalid_date, bitmap_index=bitmap_index)
+    return header, [(tuple(row), row_number) for row, row_number in rows], reported
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_bitmap_index_matches_csv(metadata_file, query):
+    index = build_bitmap_index(metadata_file)
+    assert run_query(metadata_file, query, index) == run_query(metadata_file, query)
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_store_matches_csv(metadata_file, query, tmp_path):
+    store = get_store(metadata_file, str(tmp_path / "store"))
+    assert run_query(metadata_file, query, store=store) == run_query(metadata_file, query)
+
+def test_non_ascii_values_match_on_every_path(metadata_file, tmp_path):
+    #sqlite's upper() only folds ascii, the store has to upper case the way str.upper does
+    query = [("country", "Curaçao")]
+    csv_result = run_query(metadata_file, query)
+    assert [row[0] for row, row_number in csv_result[1]] == ["EDB009", "EDB010", "EDB011"]
+    assert run_query(metadata_file, query, store=get_store(metadata_file, str(tmp_path / "store"))) == csv_result
+    assert run_query(metadata_file, query, build_bitmap_index(metadata_file)) == csv_result
+
+def test_bad_dates_only_reported_on_matching_rows(metadata_file):
+    index = build_bitmap_index(metadata_file)
+    header, rows, reported = run_query(metadata_file, [("country", "UK"), ("sample_date", "2020-03-01:2020-03-31")], index)
+    assert [row[0] for row, row_number in rows] == ["EDB001", "EDB002", "EDB008"]
+    assert reported == [("03/03/2020", 7, "sample_date")]
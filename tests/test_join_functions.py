@@ -0,0 +1,130 @@
+import random
+
+import pytest
+
+from reportfunk.funks.class_definitions import taxon
+from reportfunk.funks.join_functions import FieldRule, FieldPolicy
+from reportfunk.funks.parsing_functions import convert_date, sorted_adm2, input_csv_policy, background_query_policy, SORTED_ADM2, LOCATION_LABEL
+
+INPUT_COLUMN = "name"
+LABEL_FIELDS = ["lineage", "uk_lineage"]
+TREE_FIELDS = ["name", "adm1", "adm2", "lineage", "phylotype"]
+TABLE_FIELDS = ["lineage", "source"]
+DATE_FIELDS = ["onset", "test"]
+CONTEXT_FIELD = "care_home"
+
+HEADER = ["name", "adm1", "adm2", "location", "lineage", "uk_lineage", "phylotype", "source", "onset", "test", "care_home"]
+INDEX = {column:position for position, column in enumerate(HEADER)}
+
+VALUES = ["", "NA", "B.1", "B.1.1.7", "FIFE|EDINBURGH"]
+DATES = ["", "NA", "2020-03-01", "2020-04-02"]
+
+def random_rows(rng, count):
+    rows = []
+    for i in range(count):
+        row = [rng.choice(DATES) if column in DATE_FIELDS else rng.choice(VALUES) for column in HEADER]
+        row[INDEX["name"]] = f"EDB{i % 5}"
+        rows.append(row)
+    return rows
+
+def new_taxon(name, rng):
+    #queries turn up with some fields already set and some still NA
+    tax = taxon(name, "UK", LABEL_FIELDS, TREE_FIELDS, TABLE_FIELDS)
+    for field in LABEL_FIELDS + TREE_FIELDS + ["context_table_summary_field"]:
+        if rng.random() < 0.3:
+            tax.attribute_dict[field] = rng.choice(VALUES[2:])
+    for field in TABLE_FIELDS:
+        if rng.random() < 0.3:
+            tax.table_dict[field] = rng.choice(VALUES[2:])
+    return tax
+
+def fields(tax):
+    return dict(tax.attribute_dict), dict(tax.table_dict), dict(tax.date_dict)
+
+def hand_override(tax, row):
+    #the merge parse_input_csv did before it used a policy, less adm1 and the UK adm2 handling it still does itself
+    for field in DATE_FIELDS:
+        value = row[INDEX[field]]
+        if value != "" and value != "NA":
+            tax.date_dict[field] = convert_date(value)
+
+    if row[INDEX[CONTEXT_FIELD]] != "":
+        tax.attribute_dict["context_table_summary_field"] = row[INDEX[CONTEXT_FIELD]]
+
+    for col, position in INDEX.items():
+        value = row[position]
+        if col in TABLE_FIELDS and value != "":
+            tax.table_dict[col] = value
+        if col in LABEL_FIELDS and value != "":
+            tax.attribute_dict[col] = value
+        if col in TREE_FIELDS and col != INPUT_COLUMN and col != "adm1" and value != "":
+            tax.attribute_dict[col] = value
+
+def hand_fill(tax, row):
+    #the merge parse_background_metadata did for queries before it used a policy, less adm1 and the sample date
+    attributes = tax.attribute_dict
+    adm2 = sorted_adm2(row[INDEX["adm2"]])
+    location_label = row[INDEX["location"]]
+
+    if "adm2" not in attributes.keys() and adm2 != "":
+        attributes["adm2"] = adm2
+    if "location_label" not in attributes.keys() and location_label != "":
+        attributes["location_label"] = location_label
+
+    value = row[INDEX[CONTEXT_FIELD]]
+    if value != "" and attributes["context_table_summary_field"] == "NA":
+        attributes["context_table_summary_field"] = value
+
+    for field in DATE_FIELDS:
+        value = row[INDEX[field]]
+        if value != "" and value != "NA" and field not in tax.date_dict.keys():
+            tax.date_dict[field] = convert_date(value)
+
+    for fields, values in [([field for field in TREE_FIELDS if field != "adm1"], attributes), (LABEL_FIELDS, attributes), (TABLE_FIELDS, tax.table_dict)]:
+        for field in fields:
+            value = row[INDEX[field]]
+            if values[field] == "NA" and value != "NA" and value != "":
+                values[field] = value
+
+@pytest.mark.parametrize("seed", range(5))
+def test_override_policy_matches_hand_merge(seed):
+    rng = random.Random(seed)
+    rows = random_rows(rng, 50)
+    merge = input_csv_policy(INPUT_COLUMN, TREE_FIELDS, LABEL_FIELDS, TABLE_FIELDS, CONTEXT_FIELD, DATE_FIELDS).merger(INDEX)
+
+    for row in rows:
+        tax = new_taxon(row[INDEX["name"]], random.Random(seed))
+        expected = new_taxon(row[INDEX["name"]], random.Random(seed))
+        merge(tax, row)
+        hand_override(expected, row)
+        assert fields(tax) == fields(expected)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_fill_policy_matches_hand_merge(seed):
+    rng = random.Random(seed)
+    rows = random_rows(rng, 50)
+    merge_index = dict(INDEX, **{SORTED_ADM2: len(INDEX), LOCATION_LABEL: len(INDEX) + 1})
+    merge = background_query_policy(TREE_FIELDS, LABEL_FIELDS, TABLE_FIELDS, CONTEXT_FIELD, DATE_FIELDS).merger(merge_index)
+
+    queries = {f"EDB{i}":new_taxon(f"EDB{i}", random.Random(seed + i)) for i in range(5)}
+    expected = {f"EDB{i}":new_taxon(f"EDB{i}", random.Random(seed + i)) for i in range(5)}
+    for row in rows: #several rows for each query, so the first non-empty value has to win
+        name = row[INDEX["name"]]
+        merge(queries[name], row + [sorted_adm2(row[INDEX["adm2"]]), row[INDEX["location"]]])
+        hand_fill(expected[name], row)
+
+    for name in queries:
+        assert fields(queries[name]) == fields(expected[name])
+
+def test_fill_keeps_first_value():
+    merge = FieldPolicy([FieldRule("lineage", precedence="fill"), FieldRule("source", "table")]).merger({"lineage": 0, "source": 1})
+    tax = taxon("EDB1", "UK", ["lineage"], [], ["source"])
+    for row in [["NA", "a"], ["B.1", ""], ["B.1.1.7", "b"]]:
+        merge(tax, row)
+    assert tax.attribute_dict["lineage"] == "B.1"
+    assert tax.table_dict["source"] == "b"
+
+@pytest.mark.parametrize("bad", [{"precedence": "Fill"}, {"target": "attributes"}, {"gap": "none"}])
+def test_field_rule_rejects_unknown_options(bad):
+    with pytest.raises(ValueError):
+        FieldRule("lineage", **bad)
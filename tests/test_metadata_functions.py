@@ -0,0 +1,92 @@
+import csv
+import os
+
+import pytest
+
+from reportfunk.funks.metadata_functions import projected_reader, indexed_reader, chunk_ranges, set_chunk_job, parse_chunk, offset_index_path
+
+HEADER = ["sequence_name", "country", "adm2", "lineage", "sample_date"]
+
+def metadata_text(row_count=60):
+    #plain rows, with quoted commas, a quoted line break, short rows, a repeated name and a blank line mixed in
+    lines = [",".join(HEADER)]
+    for i in range(row_count):
+        if i % 7 == 3:
+            lines.append(f'EDB{i:03},UK,"FIFE, NORTH",B.1,2020-03-{i % 28 + 1:02}')
+        elif i % 11 == 5:
+            lines.append(f'EDB{i:03},UK,"LEEDS\nBRADFORD",B.1.1.7,2020-04-01')
+        elif i % 13 == 8:
+            lines.append(f"EDB{i:03},France")
+        else:
+            lines.append(f"EDB{i:03},UK,EDINBURGH,B.1,2020-03-02")
+    lines.append("EDB010,Spain,MADRID,B.1,2020-05-01")
+    lines.append("")
+    lines.append("EDB999,UK,GLASGOW,B.1,2020-05-02")
+    return "\n".join(lines) + "\n"
+
+@pytest.fixture
+def metadata_file(tmp_path):
+    path = tmp_path / "metadata.csv"
+    path.write_text(metadata_text())
+    return str(path)
+
+def dict_reader_rows(metadata_file, columns, name_column=None, keep=None):
+    #what the readers replaced: every row through csv.DictReader, then projected
+    with open(metadata_file, newline="") as f:
+        reader = csv.DictReader(f)
+        projected = [column for column in reader.fieldnames if column in columns]
+        return [tuple(row[column] for column in projected) for row in reader if keep is None or row[name_column] in keep]
+
+COLUMNS = [["sequence_name", "adm2", "sample_date"], ["lineage"], HEADER, ["not_there"]]
+KEEP = {"EDB003", "EDB005", "EDB010", "EDB021", "EDB999", "missing"}
+
+@pytest.mark.parametrize("columns", COLUMNS)
+def test_projected_reader_matches_dict_reader(metadata_file, columns):
+    header, index, rows = projected_reader(metadata_file, columns)
+    assert list(rows) == dict_reader_rows(metadata_file, columns)
+
+    header, index, rows = projected_reader(metadata_file, columns, "sequence_name", KEEP)
+    assert list(rows) == dict_reader_rows(metadata_file, columns, "sequence_name", KEEP)
+
+def test_quoted_line_break_across_a_chunk_is_read_serially(metadata_file):
+    #a chunk that starts inside a quoted field can't be parsed on its own, so it and the rest of the file are read in order
+    chunk_size = 200
+    set_chunk_job(metadata_file, HEADER, list(range(len(HEADER))), None, None)
+    assert any(parse_chunk(byte_range) is None for byte_range in chunk_ranges(metadata_file, chunk_size))
+
+    for keep in [None, KEEP]:
+        header, index, rows = projected_reader(metadata_file, HEADER, "sequence_name", keep, threads=2, chunk_size=chunk_size)
+        assert list(rows) == dict_reader_rows(metadata_file, HEADER, "sequence_name", keep)
+
+def test_parallel_rows_match_serial(tmp_path):
+    path = tmp_path / "plain.csv"
+    path.write_text(",".join(HEADER) + "\n" + "".join(f"EDB{i:04},UK,FIFE,B.1,2020-03-02\n" for i in range(500)))
+    for keep in [None, {f"EDB{i:04}" for i in range(0, 500, 3)}]:
+        header, index, rows = projected_reader(str(path), ["sequence_name", "lineage"], "sequence_name", keep, threads=2, chunk_size=1000)
+        assert list(rows) == dict_reader_rows(str(path), ["sequence_name", "lineage"], "sequence_name", keep)
+
+@pytest.mark.parametrize("columns", COLUMNS)
+def test_indexed_reader_matches_projected_reader(metadata_file, columns):
+    header, index, rows = indexed_reader(metadata_file, columns, "sequence_name", KEEP)
+    expected_header, expected_index, expected_rows = projected_reader(metadata_file, columns, "sequence_name", KEEP)
+    assert (header, index, list(rows)) == (expected_header, expected_index, list(expected_rows))
+    assert os.path.exists(offset_index_path(metadata_file, "sequence_name"))
+
+def test_offset_index_is_rebuilt_when_the_csv_changes(metadata_file):
+    list(indexed_reader(metadata_file, HEADER, "sequence_name", KEEP)[2])
+    index_file = offset_index_path(metadata_file, "sequence_name")
+    first_index = open(index_file, "rb").read()
+
+    #same size but different rows, and then rows on the end
+    with open(metadata_file) as f:
+        text = f.read()
+    with open(metadata_file, "w") as fw:
+        fw.write(text.replace("EDB003", "EDB300").replace("EDB005", "EDB003"))
+    stat = os.stat(metadata_file)
+    os.utime(metadata_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    with open(metadata_file, "a") as fw:
+        fw.write("EDB021,Wales,CARDIFF,B.1,2020-06-01\n")
+
+    rows = list(indexed_reader(metadata_file, HEADER, "sequence_name", KEEP)[2])
+    assert rows == dict_reader_rows(metadata_file, HEADER, "sequence_name", KEEP)
+    assert open(index_file, "rb").read() != first_index
@@ -0,0 +1,158 @@
+import csv
+import os
+
+import pytest
+
+from reportfunk.funks import store_functions
+from reportfunk.funks.store_functions import get_store, store_path
+from reportfunk.funks.prep_data_functions import prepping_adm2_adm1_data
+
+HEADER = ["sequence_name", "country", "adm1", "adm2", "lineage", "sample_date"]
+
+METADATA = """sequence_name,country,adm1,adm2,lineage,sample_date
+EDB001,UK,UK-SCT,FIFE,B.1,2020-03-02
+EDB002,UK,UK-ENG,"LEEDS, WEST",B.1.1.7,2020-03-15
+EDB003,France,,PARIS,B.1,2020-03-02
+EDB004,UK,Scotland,HIGHLANDS,B.1.1.7,2020-04-01
+EDB005,UK,UK-WLS,"CARDIFF
+NORTH",B.1,NA
+EDB006,UK,UK-ENG,HIGHLANDS,B.1,2020-03-31
+EDB007,UK,UK-NIR,unknown,B.1,2020-03-31
+EDB008,Spain
+EDB002,UK,UK-SCT,FIFE,B.1,2020-05-01
+"""
+
+@pytest.fixture
+def metadata_file(tmp_path):
+    path = tmp_path / "metadata.csv"
+    path.write_text(METADATA)
+    return str(path)
+
+@pytest.fixture
+def store_dir(tmp_path):
+    return str(tmp_path / "store")
+
+def dict_reader_rows(metadata_file, columns, name_column=None, keep=None):
+    with open(metadata_file, newline="") as f:
+        reader = csv.DictReader(f)
+        projected = [column for column in reader.fieldnames if column in columns]
+        return [tuple(row[column] for column in projected) for row in reader if keep is None or row[name_column] in keep]
+
+def store_rows(store, columns, name_column=None, keep=None):
+    header, index, rows = store.projected_reader(columns, name_column, keep)
+    return [tuple(row) for row in rows]
+
+def bump_mtime(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+@pytest.mark.parametrize("columns", [HEADER, ["adm2", "sequence_name"], ["lineage"]])
+def test_store_rows_match_dict_reader(metadata_file, store_dir, columns):
+    store = get_store(metadata_file, store_dir)
+    assert store.header == HEADER
+    assert store_rows(store, columns) == dict_reader_rows(metadata_file, columns)
+
+    keep = {"EDB002", "EDB005", "EDB008", "missing"}
+    assert store_rows(store, columns, "sequence_name", keep) == dict_reader_rows(metadata_file, columns, "sequence_name", keep)
+
+def test_store_lookups(metadata_file, store_dir):
+    store = get_store(metadata_file, store_dir)
+    assert store.names_present("sequence_name", {"EDB002", "EDB008", "missing"}) == {"EDB002", "EDB008"}
+    assert list(store.distinct_values("adm1")) == [("UK-SCT", 1), ("UK-ENG", 2), ("", 3), ("Scotland", 4), ("UK-WLS", 5), ("UK-NIR", 7), (None, 8)]
+    assert list(store.value_rows("adm2", ["FIFE", "PARIS"])) == [("FIFE", 1), ("PARIS", 3), ("FIFE", 9)]
+
+def test_adm2_adm1_from_store_matches_csv(metadata_file, store_dir):
+    store = get_store(metadata_file, store_dir)
+    expected = prepping_adm2_adm1_data(metadata_file, HEADER)
+    assert prepping_adm2_adm1_data(metadata_file, HEADER, store) == expected
+    assert expected["HIGHLANDS"] == "England"
+    assert expected["CARDIFF\nNORTH"] == "Wales"
+
+def test_stale_store_is_rebuilt(metadata_file, store_dir):
+    get_store(metadata_file, store_dir)
+
+    #same size, so only the mtime and checksum give it away
+    with open(metadata_file, "w") as fw:
+        fw.write(METADATA.replace("EDB001,UK,UK-SCT,FIFE", "EDB001,UK,UK-SCT,BUTE"))
+    bump_mtime(metadata_file)
+
+    store = get_store(metadata_file, store_dir)
+    assert store_rows(store, HEADER) == dict_reader_rows(metadata_file, HEADER)
+    assert store.names_present("adm2", {"BUTE", "FIFE"}) == {"BUTE", "FIFE"}
+
+def test_touched_csv_keeps_its_store(metadata_file, store_dir, monkeypatch):
+    get_store(metadata_file, store_dir)
+    bump_mtime(metadata_file)
+
+    def build_store(*args, **kwargs):
+        raise AssertionError("store rebuilt for a csv whose contents haven't changed")
+    monkeypatch.setattr(store_functions, "build_store", build_store)
+
+    store = get_store(metadata_file, store_dir)
+    assert store_rows(store, HEADER) == dict_reader_rows(metadata_file, HEADER)
+    assert store_functions.read_store_info(store_path(metadata_file, store_dir))["mtime_ns"] == str(os.stat(metadata_file).st_mtime_ns)
+
+def no_rebuilds(monkeypatch):
+    def build_store(*args, **kwargs):
+        raise AssertionError("store rebuilt when the new rows could have been added")
+    monkeypatch.setattr(store_functions, "build_store", build_store)
+
+def count_rebuilds(monkeypatch):
+    builds = []
+    build_store = store_functions.build_store
+    def counted(*args, **kwargs):
+        builds.append(args)
+        return build_store(*args, **kwargs)
+    monkeypatch.setattr(store_functions, "build_store", counted)
+    return builds
+
+def test_appended_rows_are_added_to_the_store(metadata_file, store_dir, monkeypatch):
+    get_store(metadata_file, store_dir)
+    no_rebuilds(monkeypatch)
+
+    with open(metadata_file, "a") as fw:
+        fw.write('EDB009,UK,UK-SCT,"DUNDEE, EAST",B.1,2020-06-01\nEDB010,UK,UK-ENG,YORK,B.1.1.7,2020-06-02\n')
+    store = get_store(metadata_file, store_dir)
+    assert store_rows(store, HEADER) == dict_reader_rows(metadata_file, HEADER)
+    assert list(store.rows_matching("adm2", "YORK")) == [(("EDB010", "UK", "UK-ENG", "YORK", "B.1.1.7", "2020-06-02"), 11)]
+
+    #and again, checked against the checksum of everything ingested so far
+    with open(metadata_file, "a") as fw:
+        fw.write("EDB011,UK,UK-WLS,CARDIFF,B.1,2020-06-03\n")
+    store = get_store(metadata_file, store_dir)
+    assert store_rows(store, HEADER) == dict_reader_rows(metadata_file, HEADER)
+    assert store_functions.read_store_info(store_path(metadata_file, store_dir))["rows"] == "12"
+
+def test_changed_rows_with_rows_appended_rebuild_the_store(metadata_file, store_dir, monkeypatch):
+    get_store(metadata_file, store_dir)
+    builds = count_rebuilds(monkeypatch)
+
+    with open(metadata_file, "w") as fw:
+        fw.write(METADATA.replace("EDB003,France", "EDB003,Norway") + "EDB009,UK,UK-SCT,FIFE,B.1,2020-06-01\n")
+    store = get_store(metadata_file, store_dir)
+    assert len(builds) == 1
+    assert store_rows(store, HEADER) == dict_reader_rows(metadata_file, HEADER)
+
+def test_row_carried_on_by_the_new_bytes_rebuilds_the_store(tmp_path, store_dir, monkeypatch):
+    #the last row ingested had no line ending, so the appended bytes change it
+    path = tmp_path / "metadata.csv"
+    path.write_text(METADATA.rstrip("\n"))
+    metadata_file = str(path)
+    get_store(metadata_file, store_dir)
+    builds = count_rebuilds(monkeypatch)
+
+    with open(metadata_file, "a") as fw:
+        fw.write("_B,,,,\nEDB009,UK,UK-SCT,FIFE,B.1,2020-06-01\n")
+    store = get_store(metadata_file, store_dir)
+    assert len(builds) == 1
+    assert store_rows(store, HEADER) == dict_reader_rows(metadata_file, HEADER)
+
+def test_appends_can_be_switched_off(metadata_file, store_dir, monkeypatch):
+    get_store(metadata_file, store_dir)
+    builds = count_rebuilds(monkeypatch)
+
+    with open(metadata_file, "a") as fw:
+        fw.write("EDB009,UK,UK-SCT,FIFE,B.1,2020-06-01\n")
+    store = get_store(metadata_file, store_dir, incremental=False)
+    assert len(builds) == 1
+    assert store_rows(store, HEADER) == dict_reader_rows(metadata_file, HEADER)